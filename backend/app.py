@@ -1,21 +1,29 @@
 import os
-import psycopg2
-import requests
-from routes.notify import send_notify
 from flask import Flask, send_from_directory
 from flask_cors import CORS
+from flask_jwt_extended import JWTManager
 from dotenv import load_dotenv
 from database import db
 from routes.campaign import campaign_bp
 from routes.poster import poster_bp
 from routes.shop import shop_bp
 from routes.fencinglogic import fence_logic
-from app.routes.geofence import geofence_bp, get_device_connectivity_status, get_device_location, create_geofence_subscription
+from app.routes.geofence import geofence_bp
 from routes.devices import device_bp
 from routes.product import product_bp
 # from routes.fencinglogic import fence_logic
-from app.routes.geofence import geofence_bp, get_device_location, create_geofence_subscription
 from app.routes.recommendation_route import recommend_bp
+from services.spatial_index import load_shop_index
+from services.active_offers import ensure_active_offers
+from services.geofence_sweep import sweep_all_devices
+from services.geofence_scheduler import geofence_scheduler, GEOFENCE_SCHEDULER_MODE
+from routes.sweep import sweep_bp
+from models.geofence_subscription_model import GeofenceSubscriptionModel  # noqa: F401  (registers the table for create_all)
+from models.device_location_model import DeviceLocationModel  # noqa: F401  (registers the table for create_all)
+from models.notification_ledger_model import NotificationLedgerModel  # noqa: F401  (registers the table for create_all)
+from models.rate_limit_bucket_model import RateLimitBucketModel  # noqa: F401  (registers the table for create_all)
+from services.callback_queue import callback_workers, CALLBACK_WORKER_MODE
+from services.campaign_discovery import init_discovery
 # Load environment variables
 load_dotenv(".env")
 
@@ -34,9 +42,23 @@ os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
 # Initialize DB
 db.init_app(app)
+# JWT for the operator endpoints (e.g. POST /shops/index/rebuild)
+JWTManager(app)
+init_discovery(app)
 with app.app_context():
     print("✅ Using DB:", app.config["SQLALCHEMY_DATABASE_URI"])
     db.create_all()
+    try:
+        print(f"🗺️ Shop spatial index loaded: {load_shop_index()} shops")
+    except Exception as e:
+        db.session.rollback()
+        print("⚠️ Shop spatial index not loaded, /shops/nearby will use SQL:", e)
+    try:
+        action, count = ensure_active_offers()
+        print(f"🏷️ Active offers {action}: {count} rows")
+    except Exception as e:
+        db.session.rollback()
+        print("⚠️ Active offers not prepared:", e)
 
 @app.route("/uploads/<path:filename>")
 def serve_upload(filename):
@@ -53,92 +75,14 @@ app.register_blueprint(device_bp, url_prefix="/device")
 app.register_blueprint(product_bp, url_prefix="/api/products")
 """ app.register_blueprint(recommend_bp, url_prefix="/api") """
 app.register_blueprint(fence_logic, url_prefix="/api/geofence/callback")
+app.register_blueprint(sweep_bp, url_prefix="/api/geofence/sweep")
 
 def implement_geofence():
+    """Run one full device sweep now, in the calling thread."""
     print("🚀 Initializing geofencing setup...")
-
     try:
-        raw_dsn = os.getenv("DATABASE_URL")
-        if raw_dsn.startswith("postgresql+psycopg2://"):
-            raw_dsn = raw_dsn.replace("postgresql+psycopg2://", "postgresql://")
-
-        conn = psycopg2.connect(raw_dsn)
-        cursor = conn.cursor()
-        # 1️⃣ Fetch all devices
-        cursor.execute("SELECT uid, phone_number FROM devices;")
-        devices = cursor.fetchall()
-        print(f"📱 Found {len(devices)} devices to process...")
-
-        # 2️⃣ Process each device
-        for uid, phone_number in devices:
-            print(f"🔍 Processing device: {uid} ({phone_number})")
-
-            # (Optional) Hardcode phone number for testing
-            phone_number = "+36719991000"  # comment once your API credits are ready
-
-            try:
-                # 3️⃣ Retrieve location from API
-                print(f"📍 Retrieving location for {phone_number} ...")
-                location = get_device_location({ "device": {"phoneNumber": phone_number}, "maxAge": 60, })
-
-                if not location or "error" in location:
-                    print(f"❌ Failed to get location for {phone_number}: {location}")
-                    continue
-
-                # 4️⃣ Parse location fields safely
-                current_lat = float(location.get("latitude", 0))
-                current_lon = float(location.get("longitude", 0))
-                radius = int(location.get("radius", 1000))
-                last_time = location.get("lastLocationTime", "N/A")
-
-                status_success, status_result=get_device_connectivity_status(phone_number)
-                
-                print(f"📍 Device {phone_number} -> lat: {current_lat}, lon: {current_lon}, radius: {radius}, time: {last_time}")
-                update_query = """
-                    UPDATE devices
-                    SET latitude = %s,
-                        longitude = %s,
-                        c_status=%s
-                    WHERE phone_number = %s;
-                """
-                cursor.execute(update_query, (current_lat, current_lon,status_result["connectivityStatus"], phone_number))
-                conn.commit()
-                print(f"✅ Updated device {phone_number} in DB with latest location.")
-
-                # 5️⃣ Create geofence subscription
-                create_res = create_geofence_subscription(phone_number, current_lat, current_lon, radius)
-                print(f"🛰️ Geofence created for {phone_number}: {create_res}")
-
-                #shops descovery logic create functions discover nearby shops so we can use for update geofence also
-                base_url = "http://10.43.38.225:5000/shops//active_campaigns_nearby"
-                params = {
-                    "lat": current_lat,
-                    "lon": current_lon,
-                    "radius": radius
-                }
-
-                try:
-                    response = requests.get(base_url, params=params, timeout=10)
-                    response.raise_for_status()  # Raise error for bad responses (4xx, 5xx)
-                    data = response.json()
-                    for item in data["items"]:
-                        campaign=item["campaign"]
-                        poster_path=os.getenv("ENDPOINT")+"/"+campaign["poster_path"]
-                        campaign_title=campaign["campaign_title"]
-                        send_notify(phone_number,campaign_title,poster_path)
-            
-                except requests.exceptions.RequestException as e:
-                    print("❌ Error calling API:", e)
-                    return None
-                #once shops discovered, iterate shops, find campains for that shop, invoke pushnotification to that user device using the FCM code
-
-            except Exception as inner_e:
-                print(f"⚠️ Error processing {phone_number}: {inner_e}")
-
-        cursor.close()
-        conn.close()
+        sweep_all_devices()
         print("✅ Geofencing setup completed for all devices.")
-
     except Exception as outer_e:
         print(f"❌ Error connecting to database or initializing geofence: {outer_e}")
 
@@ -148,8 +92,12 @@ if __name__ == "__main__":
     port = int(os.getenv("FLASK_PORT", "5000"))
 
  
-    with app.app_context():
-        implement_geofence()
+    # Sweeps and queued geofence callbacks run in the background so the API is up
+    # immediately; with the debug reloader only the serving child process starts them.
+    if GEOFENCE_SCHEDULER_MODE == "thread" and (not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        geofence_scheduler.start()
+    if CALLBACK_WORKER_MODE == "thread" and (not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        callback_workers.start()
 
     app.run(host=host, port=port, debug=debug_mode)
 
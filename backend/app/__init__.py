@@ -27,6 +27,12 @@ def create_app():
         from .models import User, Shop, Campaign
         db.create_all()
         print('✅ Database tables ensured')
+        from .routes.shops import load_location_index
+        try:
+            print(f'🗺️ Shop spatial index loaded: {load_location_index()} shops')
+        except Exception as e:
+            db.session.rollback()
+            print('⚠️ Shop spatial index not loaded:', e)
 
     @app.route('/')
     def home():
@@ -0,0 +1,339 @@
+"""
+asyncio variant of the Nokia client (app/nokia_client.py) for batch work.
+
+AsyncNokiaClient has the operations batch callers need: device location,
+connectivity, create / retrieve / delete geofencing subscription and SIM
+swap check. They build the same payloads and return the same shapes as the
+sync client. All calls of one client share one aiohttp connection pool
+(keep-alive, TLS sessions reused), so a single event loop can keep hundreds
+of requests in flight where the sync client needs a thread per request.
+
+  async with AsyncNokiaClient() as client:
+      locations = await client.gather(
+          [client.device_location(phone, 60) for phone in phones]
+      )
+
+gather() runs the calls under a semaphore (at most `concurrency` in
+flight), gives every call its own deadline and cancels only that call when
+the deadline passes: its slot in the result list holds the
+asyncio.TimeoutError (or any other exception it raised) and the other
+calls carry on. Cancelling the gather() itself cancels every call still
+pending. A single call can be cancelled the usual way, by cancelling the
+task it runs in; aiohttp then drops the request and frees its connection.
+
+Sync code (the sweep thread) uses `nokia_loop`, a background event loop
+that owns one long-lived client, so the pool is shared by every batch in
+the process:
+
+  states = nokia_loop.run(fetch_device_states, phones, 60)
+
+Settings (env):
+  NOKIA_ASYNC_CONNECTIONS    connections in the shared pool (default 200)
+  NOKIA_ASYNC_CONCURRENCY    calls in flight per gather() (default 100)
+  NOKIA_ASYNC_CALL_TIMEOUT   deadline per call in seconds before it is cancelled (default 30)
+Connect and per-endpoint read timeouts are the sync client's
+(NOKIA_CONNECT_TIMEOUT, NOKIA_TIMEOUT_<GROUP>), and so are the circuit
+breakers and retry budget (services/resilience.py), so both clients see
+the same upstream health, and so are the location cache
+(services/location_cache.py) and the shared rate limit buckets
+(services/rate_limiter.py). Calls of this client are background priority
+unless the client is created with priority="interactive".
+"""
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+from typing import NamedTuple
+
+import aiohttp
+import certifi
+
+from app.nokia_client import (
+    NOKIA_BASE_URL,
+    NOKIA_RAPIDAPI_KEY,
+    NOKIA_RAPIDAPI_HOST,
+    NOKIA_CONNECT_TIMEOUT_S,
+    NOKIA_READ_TIMEOUTS,
+    LOCATION_RETRIEVE_PATH,
+    CONNECTIVITY_PATH,
+    GEOFENCE_SUBSCRIPTIONS_PATH,
+    SIM_SWAP_CHECK_PATH,
+    geofence_subscription_payload,
+    location_from_response,
+    location_payload,
+    nokia_resilience,
+    rapidapi_headers,
+    unexpected_response,
+)
+from services.location_cache import location_cache
+from services.rate_limiter import BACKGROUND, RateLimitedError, nokia_rate_limiter
+from services.resilience import CircuitOpenError
+
+NOKIA_ASYNC_CONNECTIONS = int(os.getenv("NOKIA_ASYNC_CONNECTIONS", "200"))
+NOKIA_ASYNC_CONCURRENCY = int(os.getenv("NOKIA_ASYNC_CONCURRENCY", "100"))
+NOKIA_ASYNC_CALL_TIMEOUT_S = float(os.getenv("NOKIA_ASYNC_CALL_TIMEOUT", "30"))
+
+# failures the operations turn into their {"error"} results
+_CALL_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, RateLimitedError)
+
+
+class _Reply(NamedTuple):
+    status: int
+    data: object  # parsed JSON body, None if there is none
+    text: str
+    headers: object
+
+
+class AsyncNokiaClient:
+    def __init__(self, base_url=NOKIA_BASE_URL, api_key=NOKIA_RAPIDAPI_KEY, api_host=NOKIA_RAPIDAPI_HOST,
+                 connections=NOKIA_ASYNC_CONNECTIONS, concurrency=NOKIA_ASYNC_CONCURRENCY,
+                 call_timeout=NOKIA_ASYNC_CALL_TIMEOUT_S, connect_timeout=NOKIA_CONNECT_TIMEOUT_S,
+                 read_timeouts=None, resilience=nokia_resilience, cache=location_cache,
+                 rate_limiter=nokia_rate_limiter, priority=BACKGROUND):
+        self.base_url = base_url.rstrip("/")
+        self.resilience = resilience
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.cache = cache
+        self.headers = rapidapi_headers(api_key, api_host)
+        self.connections = max(1, connections)
+        self.concurrency = max(1, concurrency)
+        self.call_timeout = call_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeouts = dict(NOKIA_READ_TIMEOUTS, **(read_timeouts or {}))
+        self._session = None
+
+    # -- session (one pool per client, bound to the loop that opened it) ------
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections,
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def timeout(self, group):
+        return aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeouts[group])
+
+    async def _request(self, group, method, path, payload=None, idempotent=True):
+        """
+        (status, parsed JSON body or None, raw text, headers) of one call,
+        rate-limited, retried and circuit-broken per endpoint group; raises
+        aiohttp errors, CircuitOpenError or RateLimitedError.
+        """
+        async def send():
+            async with self.session.request(
+                method, f"{self.base_url}{path}", json=payload, timeout=self.timeout(group)
+            ) as res:
+                text = await res.text()
+                try:
+                    data = json.loads(text) if text else None
+                except ValueError:
+                    data = None
+                return _Reply(res.status, data, text, res.headers)
+
+        async def pace():
+            await self.rate_limiter.aacquire(group, self.priority)
+
+        return await self.resilience.acall(group, send, idempotent=idempotent, pace=pace)
+
+    # -- operations (same results as app/nokia_client.NokiaClient) -------------
+
+    async def device_location(self, phone_number: str, max_age: int = None) -> dict:
+        return await self.cache.aget_or_fetch(
+            phone_number, max_age, lambda: self._retrieve_location(phone_number, max_age)
+        )
+
+    async def _retrieve_location(self, phone_number, max_age):
+        try:
+            status, data, text, _ = await self._request(
+                "location", "POST", LOCATION_RETRIEVE_PATH, location_payload(phone_number, max_age)
+            )
+            if status != 200 or data is None:
+                return unexpected_response(status, text)
+            return location_from_response(data)
+        except _CALL_ERRORS as e:
+            print("❌ Error retrieving device location:", e)
+            return {"error": str(e) or type(e).__name__}
+
+    async def connectivity_status(self, phone_number: str):
+        try:
+            status, data, text, _ = await self._request(
+                "connectivity", "POST", CONNECTIVITY_PATH, location_payload(phone_number)
+            )
+            success = status in (200, 201) and data is not None
+            return success, (data if success else unexpected_response(status, text))
+        except _CALL_ERRORS as e:
+            print("❌ Device Status API Exception:", e)
+            return False, {"error": str(e) or type(e).__name__}
+
+    async def create_geofence_subscription(self, phone_number: str, lat: float, lon: float, radius: int = 2000) -> dict:
+        payload = geofence_subscription_payload(phone_number, lat, lon, radius)
+        try:
+            status, data, text, _ = await self._request(
+                "geofencing", "POST", GEOFENCE_SUBSCRIPTIONS_PATH, payload, idempotent=False
+            )
+            print("📡 Create Geofence Response:", status, text)
+            return data if 200 <= status < 300 and data is not None else unexpected_response(status, text)
+        except _CALL_ERRORS as e:
+            print("❌ Error creating geofence subscription:", e)
+            return {"error": str(e) or type(e).__name__}
+
+    async def retrieve_geofence_subscription(self, subscription_id: str) -> dict:
+        try:
+            status, data, text, _ = await self._request(
+                "geofencing", "GET", f"{GEOFENCE_SUBSCRIPTIONS_PATH}/{subscription_id}"
+            )
+            return data if 200 <= status < 300 and data is not None else unexpected_response(status, text)
+        except _CALL_ERRORS as e:
+            print("❌ Error retrieving geofence subscription:", e)
+            return {"error": str(e) or type(e).__name__}
+
+    async def delete_geofence_subscription(self, subscription_id: str) -> dict:
+        try:
+            status, _, text, _ = await self._request(
+                "geofencing", "DELETE", f"{GEOFENCE_SUBSCRIPTIONS_PATH}/{subscription_id}"
+            )
+            print("🗑️ Delete Geofence Response:", status, text)
+            return {"status": status, "response": text}
+        except _CALL_ERRORS as e:
+            print("❌ Error deleting geofence subscription:", e)
+            return {"error": str(e) or type(e).__name__}
+
+    async def check_sim_swap(self, phone_number: str, max_age: int = 240) -> dict:
+        payload = {"phoneNumber": phone_number, "maxAge": max_age}
+        try:
+            status, data, text, _ = await self._request("sim_swap", "POST", SIM_SWAP_CHECK_PATH, payload)
+            return data if 200 <= status < 300 and data is not None else unexpected_response(status, text)
+        except _CALL_ERRORS as e:
+            print("❌ SIM Swap Check Error:", e)
+            return {"error": str(e) or type(e).__name__}
+
+    # -- bounded fan-out ---------------------------------------------------------
+
+    async def gather(self, calls, concurrency=None, call_timeout=None):
+        """
+        Await the coroutines in `calls` with at most `concurrency` running at
+        once. Results come back in input order; a call that raised or ran
+        past `call_timeout` seconds (it is cancelled then) has its exception
+        in its slot instead of a result.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency or self.concurrency))
+        deadline = self.call_timeout if call_timeout is None else call_timeout
+
+        async def bounded(coro):
+            try:
+                async with semaphore:
+                    return await asyncio.wait_for(coro, deadline)
+            finally:
+                coro.close()  # never started (gather cancelled while waiting for a slot)
+
+        return await asyncio.gather(*(bounded(c) for c in calls), return_exceptions=True)
+
+
+async def fetch_device_states(client, phone_numbers, max_age=None):
+    """
+    Location and connectivity of every device in one fan-out. Returns one
+    (location, (status_success, status_result), locate_ms, connectivity_ms)
+    per phone number, in order; failed or timed-out calls come back as the
+    sync client's error shapes.
+    """
+    elapsed = {}
+
+    async def timed(slot, fn, *args):
+        started = time.perf_counter()
+        try:
+            return await fn(*args)
+        finally:
+            elapsed[slot] = (time.perf_counter() - started) * 1000.0
+
+    n = len(phone_numbers)
+    results = await client.gather(
+        [timed(i, client.device_location, phone, max_age) for i, phone in enumerate(phone_numbers)]
+        + [timed(n + i, client.connectivity_status, phone) for i, phone in enumerate(phone_numbers)]
+    )
+
+    states = []
+    for i in range(n):
+        location, status = results[i], results[n + i]
+        if isinstance(location, BaseException):
+            location = {"error": str(location) or type(location).__name__}
+        if isinstance(status, BaseException):
+            status = (False, {"error": str(status) or type(status).__name__})
+        states.append((location, status, elapsed.get(i), elapsed.get(n + i)))
+    return states
+
+
+class NokiaEventLoop:
+    """
+    A background thread running one event loop with one AsyncNokiaClient,
+    so sync callers can submit batches without opening a pool per batch.
+    """
+
+    def __init__(self, client_factory=AsyncNokiaClient):
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self.client = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def main():
+                asyncio.set_event_loop(loop)
+                self.client = self._client_factory()
+                ready.set()
+                loop.run_forever()
+
+            self._loop = loop
+            self._thread = threading.Thread(target=main, name="nokia-async", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def run(self, fn, *args, timeout=None):
+        """
+        Run `fn(client, *args)` on the loop and wait for its result. If the
+        wait times out, the coroutine (and every request it has in flight)
+        is cancelled before the TimeoutError is raised.
+        """
+        self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(fn(self.client, *args), self._loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = self.client = None
+
+
+nokia_loop = NokiaEventLoop()
@@ -1,153 +1,386 @@
+"""
+Nokia Network-as-Code (RapidAPI) client.
+
+One NokiaClient (the module-level `nokia`) serves every caller: the
+/api/geofence routes, the geofence sweep, the callback workers and the
+subscription registry. It keeps a single requests.Session, so connections
+(and their TLS sessions) to the RapidAPI host are pooled and kept alive
+across calls and threads instead of being opened per request. The pool is
+sized for the sweep's worker threads.
+
+Every endpoint group has its own (connect, read) timeout and its own
+circuit breaker; failed calls are retried with backoff within a retry
+budget (services/resilience.py, upstream "nokia"). Subscription creates
+are not idempotent, so they are only retried when the request cannot have
+been processed. While a breaker is open the methods return their error
+result at once.
+
+Every attempt first takes a token from the endpoint group's shared bucket
+(services/rate_limiter.py), so all worker processes stay inside one
+RapidAPI quota. Calls made while serving an HTTP request go ahead of
+background work; a call that cannot get a token in time fails with
+RateLimitedError, which the methods return as their error result.
+
+device_location() answers from services/location_cache.py when a
+recent enough retrieval of the phone is cached (maxAge), and concurrent
+misses for one phone share a single retrieval.
+
+Settings (env):
+  NOKIA_BASE_URL, NOKIA_RAPIDAPI_KEY, NOKIA_RAPIDAPI_HOST
+  NOKIA_POOL_CONNECTIONS        host pools kept by the adapter (default 4)
+  NOKIA_POOL_MAXSIZE            keep-alive connections per host (default 32)
+  NOKIA_CONNECT_TIMEOUT         connect timeout in seconds (default 3.05)
+  NOKIA_TIMEOUT_<GROUP>         read timeout of one endpoint group, GROUP in
+                                LOCATION, CONNECTIVITY, DEVICE_STATUS,
+                                GEOFENCING, SIM_SWAP, VERIFICATION
+"""
 import os
-import json
-import requests
+import threading
+
 import certifi
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.location_cache import location_cache
+from services.rate_limiter import current_priority, nokia_rate_limiter
+from services.resilience import Resilience
 
 # Nokia Network-as-Code (RapidAPI) Config
 NOKIA_BASE_URL = os.getenv("NOKIA_BASE_URL", "https://network-as-code.p-eu.rapidapi.com")
 NOKIA_RAPIDAPI_KEY = os.getenv("NOKIA_RAPIDAPI_KEY")
 NOKIA_RAPIDAPI_HOST = os.getenv("NOKIA_RAPIDAPI_HOST", "network-as-code.nokia.rapidapi.com")
 
-HEADERS = {
-    "x-rapidapi-key": NOKIA_RAPIDAPI_KEY,
-    "x-rapidapi-host": NOKIA_RAPIDAPI_HOST,
-    "Content-Type": "application/json"
+NOKIA_POOL_CONNECTIONS = int(os.getenv("NOKIA_POOL_CONNECTIONS", "4"))
+NOKIA_POOL_MAXSIZE = int(os.getenv("NOKIA_POOL_MAXSIZE", "32"))
+NOKIA_CONNECT_TIMEOUT_S = float(os.getenv("NOKIA_CONNECT_TIMEOUT", "3.05"))
+
+# read timeout (seconds) per endpoint group
+NOKIA_READ_TIMEOUTS = {
+    group: float(os.getenv(f"NOKIA_TIMEOUT_{group.upper()}", default))
+    for group, default in (
+        ("location", "10"),
+        ("connectivity", "5"),
+        ("device_status", "10"),
+        ("geofencing", "15"),
+        ("sim_swap", "10"),
+        ("verification", "15"),
+    )
+}
+
+# Limits sent with every geofencing subscription (recorded by services/subscription_registry.py)
+SUBSCRIPTION_MAX_EVENTS = 10
+SUBSCRIPTION_EXPIRE_TIME = "2045-03-22T05:40:58.469Z"
+
+GEOFENCE_CALLBACK_SINK = "http://192.168.1.11:5000/api/geofence/callback"  # your callback endpoint
+GEOFENCE_AREA_LEFT_EVENT = "org.camaraproject.geofencing-subscriptions.v0.area-left"
+
+# Device status (roaming) subscription sent by /location/retrieve and /location/cstatus
+DEVICE_STATUS_EXPIRE_TIME = "2026-01-17T13:18:23.682Z"
+DEVICE_STATUS_WEBHOOK = {
+    "notificationUrl": "https://application-server.com",
+    "notificationAuthToken": "c8974e592c2fa383d4a3960714",
 }
 
-# Create Geofencing Subscription
-def create_geofence_subscription(phone_number: str, lat: float, lon: float, radius: int = 2000):
-    url = f"{NOKIA_BASE_URL}/geofencing-subscriptions/v0.3/subscriptions"
-    payload = {
+
+# Endpoint paths (shared with the asyncio client, app/nokia_async_client.py)
+LOCATION_RETRIEVE_PATH = "/location-retrieval/v0/retrieve"
+LOCATION_VERIFY_PATH = "/location-verification/v1/verify"
+CONNECTIVITY_PATH = "/device-status/v0/connectivity"
+DEVICE_STATUS_SUBSCRIPTIONS_PATH = "/device-status/v0/subscriptions"
+GEOFENCE_SUBSCRIPTIONS_PATH = "/geofencing-subscriptions/v0.3/subscriptions"
+SIM_SWAP_CHECK_PATH = "/passthrough/camara/v1/sim-swap/sim-swap/v0/check"
+SIM_SWAP_DATE_PATH = "/passthrough/camara/v1/sim-swap/sim-swap/v0/retrieve-date"
+
+
+# shared by the sync and the asyncio client: one set of breakers per process
+nokia_resilience = Resilience("nokia")
+
+
+def rapidapi_headers(api_key=NOKIA_RAPIDAPI_KEY, api_host=NOKIA_RAPIDAPI_HOST):
+    headers = {
+        "x-rapidapi-key": api_key,
+        "x-rapidapi-host": api_host,
+        "Content-Type": "application/json",
+    }
+    # an unset key is left out (requests drops None headers, aiohttp rejects them)
+    return {name: value for name, value in headers.items() if value is not None}
+
+
+def unexpected_response(status_code, text):
+    return {"error": f"Unexpected response: {status_code} - {text}"}
+
+
+def json_or_error(res):
+    """Body of a successful sync response, or the {"error"} result for any other status."""
+    if res.ok:
+        return res.json()
+    return unexpected_response(res.status_code, res.text)
+
+
+def location_payload(phone_number, max_age=None):
+    payload = {"device": {"phoneNumber": phone_number}}
+    if max_age is not None:
+        payload["maxAge"] = max_age
+    return payload
+
+
+def location_from_response(data):
+    """The location-retrieval body as {lastLocationTime, latitude, longitude, radius, areaType}."""
+    # the API returns the area directly (not inside "location")
+    area = data.get("area", {}) or {}
+    center = area.get("center", {}) or {}
+    return {
+        "lastLocationTime": data.get("lastLocationTime"),
+        "latitude": center.get("latitude"),
+        "longitude": center.get("longitude"),
+        "radius": area.get("radius"),
+        "areaType": area.get("areaType"),
+    }
+
+
+def geofence_subscription_payload(phone_number, lat, lon, radius):
+    return {
         "protocol": "HTTP",
-        "sink": "http://192.168.1.11:5000/api/geofence/callback",  # your callback endpoint
-        "types": ["org.camaraproject.geofencing-subscriptions.v0.area-left"],  # ✅ only trigger when leaving
+        "sink": GEOFENCE_CALLBACK_SINK,
+        "types": [GEOFENCE_AREA_LEFT_EVENT],  # ✅ only trigger when leaving
         "config": {
             "subscriptionDetail": {
                 "device": {"phoneNumber": phone_number},
                 "area": {
                     "areaType": "CIRCLE",
                     "center": {"latitude": lat, "longitude": lon},
-                    "radius": radius
-                }
+                    "radius": radius,
+                },
             },
             "initialEvent": True,  # optional, triggers once immediately after creation
-            "subscriptionMaxEvents": 10,
-            "subscriptionExpireTime": "2045-03-22T05:40:58.469Z"
-        }
+            "subscriptionMaxEvents": SUBSCRIPTION_MAX_EVENTS,
+            "subscriptionExpireTime": SUBSCRIPTION_EXPIRE_TIME,
+        },
     }
 
-    try:
-        res = requests.post(url, data=json.dumps(payload),
-                            headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📡 Create Geofence Response:", res.status_code, res.text)
-        return res.json()
-    except Exception as e:
-        print("❌ Error creating geofence subscription:", e)
-        return {"error": str(e)}
 
+class NokiaClient:
+    def __init__(self, base_url=NOKIA_BASE_URL, api_key=NOKIA_RAPIDAPI_KEY, api_host=NOKIA_RAPIDAPI_HOST,
+                 pool_connections=NOKIA_POOL_CONNECTIONS, pool_maxsize=NOKIA_POOL_MAXSIZE,
+                 connect_timeout=NOKIA_CONNECT_TIMEOUT_S, read_timeouts=None, resilience=nokia_resilience,
+                 cache=location_cache, rate_limiter=nokia_rate_limiter):
+        self.base_url = base_url.rstrip("/")
+        self.resilience = resilience
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.headers = rapidapi_headers(api_key, api_host)
+        self.pool_connections = max(1, pool_connections)
+        self.pool_maxsize = max(1, pool_maxsize)
+        self.connect_timeout = connect_timeout
+        self.read_timeouts = dict(NOKIA_READ_TIMEOUTS, **(read_timeouts or {}))
 
-# Retrieve Geofencing Subscription
-def retrieve_geofence_subscription(subscription_id: str):
-    url = f"{NOKIA_BASE_URL}/geofencing-subscriptions/v0.3/subscriptions/{subscription_id}"
-    try:
-        res = requests.get(url, headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📡 Retrieve Subscription Response:", res.status_code, res.text)
-        return res.json()
-    except Exception as e:
-        print("❌ Error retrieving geofence subscription:", e)
-        return {"error": str(e)}
-
-# Delete Geofencing Subscription
-def delete_geofence_subscription(subscription_id: str):
-    url = f"{NOKIA_BASE_URL}/geofencing-subscriptions/v0.3/subscriptions/{subscription_id}"
-    try:
-        res = requests.delete(url, headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("🗑️ Delete Geofence Response:", res.status_code, res.text)
-        return {"status": res.status_code, "response": res.text}
-    except Exception as e:
-        print("❌ Error deleting geofence subscription:", e)
-        return {"error": str(e)}
-
-# List All Geofencing Subscriptions
-def list_geofence_subscriptions():
-    url = f"{NOKIA_BASE_URL}/geofencing-subscriptions/v0.3/subscriptions"
-    try:
-        res = requests.get(url, headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📋 List Subscriptions Response:", res.status_code, res.text)
-        return res.json()
-    except Exception as e:
-        print("❌ Error listing subscriptions:", e)
-        return {"error": str(e)}
-
-# Verify Device Location
-def verify_location_nokia(phone_number: str, lat: float, lon: float, timestamp: str = None, radius: float = 50000) -> bool:
-    url = f"{NOKIA_BASE_URL}/location-verification/v1/verify"
-    payload = {
-        "device": {"phoneNumber": phone_number},
-        "area": {"areaType": "CIRCLE", "center": {"latitude": lat, "longitude": lon}, "radius": radius}
-    }
-    try:
-        res = requests.post(url, data=json.dumps(payload), headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📡 Location Verify Response:", res.status_code, res.text)
-        if res.status_code == 200:
-            data = res.json()
-            return data.get("verificationResult", "").upper() == "TRUE"
-        return False
-    except Exception as e:
-        print("❌ Nokia Verify Location Error:", e)
-        return False
-
-# SIM Swap Check
-def check_sim_swap(phone_number: str, max_age: int = 240):
-    url = f"{NOKIA_BASE_URL}/passthrough/camara/v1/sim-swap/sim-swap/v0/check"
-    payload = {"phoneNumber": phone_number, "maxAge": max_age}
-    try:
-        res = requests.post(url, data=json.dumps(payload), headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📡 SIM Swap Check Response:", res.status_code, res.text)
-        return res.json()
-    except Exception as e:
-        print("❌ SIM Swap Check Error:", e)
-        return {"error": str(e)}
-
-def retrieve_sim_swap_date(phone_number: str):
-    url = f"{NOKIA_BASE_URL}/passthrough/camara/v1/sim-swap/sim-swap/v0/retrieve-date"
-    payload = {"phoneNumber": phone_number}
-    try:
-        res = requests.post(url, data=json.dumps(payload), headers=HEADERS, verify=certifi.where(), timeout=15)
-        print("📡 SIM Swap Retrieve Response:", res.status_code, res.text)
-        return res.json()
-    except Exception as e:
-        print("❌ SIM Swap Retrieve Error:", e)
-        return {"error": str(e)}
-
-
-# # Retrieve Device Location
-# def get_device_location(phone_number: str):
-#     """
-#     Retrieve the current or last known location of a device from Nokia Network-as-Code.
-#     """
-#     url = f"{NOKIA_BASE_URL}/location-retrieval/v0/retrieve"
-#     payload = {
-#         "device": {"phoneNumber": phone_number}
-#     }
-#     try:
-#         res = requests.post(
-#             url,
-#             data=json.dumps(payload),
-#             headers=HEADERS,
-#             verify=certifi.where(),
-#             timeout=15
-#         )
-#         print("📡 Device Location Response:", res.status_code, res.text)
-#         if res.status_code == 200:
-#             data = res.json()
-#             # The structure depends on Nokia's API, but usually:
-#             return {
-#                 "latitude": data.get("location", {}).get("latitude"),
-#                 "longitude": data.get("location", {}).get("longitude"),
-#                 "timestamp": data.get("location", {}).get("timestamp")
-#             }
-#         return {"error": f"Unexpected response: {res.status_code} - {res.text}"}
-#     except Exception as e:
-#         print("❌ Error retrieving device location:", e)
-#         return {"error": str(e)}
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The pooled keep-alive session, created on first use."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.verify = certifi.where()  # resolved once, not per call
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def timeout(self, group):
+        return (self.connect_timeout, self.read_timeouts[group])
+
+    def _request(self, group, method, path, payload=None, headers=None, idempotent=True):
+        """
+        One call to the RapidAPI host, rate-limited, retried and
+        circuit-broken per endpoint group; raises requests exceptions,
+        CircuitOpenError or RateLimitedError.
+        """
+        priority = current_priority()  # taken here: retries keep the caller's priority
+        return self.resilience.call(
+            group,
+            lambda: self.session.request(
+                method,
+                f"{self.base_url}{path}",
+                json=payload,
+                headers=dict(self.headers, **(headers or {})),
+                timeout=self.timeout(group),
+            ),
+            idempotent=idempotent,
+            pace=lambda: self.rate_limiter.acquire(group, priority),
+        )
+
+    # -- location ------------------------------------------------------------
+
+    def device_location(self, phone_number: str, max_age: int = None) -> dict:
+        """
+        Current or last known location of a device, at most `max_age` seconds
+        old: {lastLocationTime, latitude, longitude, radius, areaType}, or
+        {"error"}.
+        """
+        return self.cache.get_or_fetch(phone_number, max_age, lambda: self._retrieve_location(phone_number, max_age))
+
+    def _retrieve_location(self, phone_number, max_age):
+        try:
+            res = self._request("location", "POST", LOCATION_RETRIEVE_PATH, location_payload(phone_number, max_age))
+            print("📡 Nokia Location Response:", res.status_code, res.text)
+            if res.status_code != 200:
+                return unexpected_response(res.status_code, res.text)
+            return location_from_response(res.json())
+        except Exception as e:
+            print("❌ Error retrieving device location:", e)
+            return {"error": str(e)}
+
+    def verify_location(self, phone_number: str, lat: float, lon: float, radius: float = 50000) -> bool:
+        """True if the network places the device inside the circle."""
+        payload = {
+            "device": {"phoneNumber": phone_number},
+            "area": {"areaType": "CIRCLE", "center": {"latitude": lat, "longitude": lon}, "radius": radius},
+        }
+        try:
+            res = self._request("location", "POST", LOCATION_VERIFY_PATH, payload)
+            print("📡 Location Verify Response:", res.status_code, res.text)
+            if res.status_code == 200:
+                return res.json().get("verificationResult", "").upper() == "TRUE"
+            return False
+        except Exception as e:
+            print("❌ Nokia Verify Location Error:", e)
+            return False
+
+    # -- device status -------------------------------------------------------
+
+    def connectivity_status(self, phone_number: str):
+        """(success, {"connectivityStatus": CONNECTED_SMS | CONNECTED_DATA | NOT_CONNECTED} or {"error"})"""
+        try:
+            res = self._request("connectivity", "POST", CONNECTIVITY_PATH, location_payload(phone_number))
+            print("📡 Connectivity Response:", res.status_code, res.text)
+            success = res.status_code in (200, 201)
+            return success, (res.json() if success else unexpected_response(res.status_code, res.text))
+        except Exception as e:
+            print("❌ Device Status API Exception:", e)
+            return False, {"error": str(e)}
+
+    def subscribe_device_status(self, phone_number: str):
+        """(success, subscription or {"error"}) for roaming-status notifications of a device."""
+        payload = {
+            "subscriptionDetail": {
+                "device": {"phoneNumber": phone_number},
+                "type": "org.camaraproject.device-status.v0.roaming-status",
+            },
+            "subscriptionExpireTime": DEVICE_STATUS_EXPIRE_TIME,
+            "webhook": DEVICE_STATUS_WEBHOOK,
+        }
+        try:
+            res = self._request("device_status", "POST", DEVICE_STATUS_SUBSCRIPTIONS_PATH, payload, idempotent=False)
+            print("📡 Device Status Subscription Response:", res.status_code, res.text)
+            success = res.status_code in (200, 201)
+            return success, (res.json() if success else unexpected_response(res.status_code, res.text))
+        except Exception as e:
+            print("❌ Subscription API Exception:", e)
+            return False, {"error": str(e)}
+
+    # -- geofencing ----------------------------------------------------------
+
+    def create_geofence_subscription(self, phone_number: str, lat: float, lon: float, radius: int = 2000) -> dict:
+        payload = geofence_subscription_payload(phone_number, lat, lon, radius)
+        try:
+            res = self._request("geofencing", "POST", GEOFENCE_SUBSCRIPTIONS_PATH, payload, idempotent=False)
+            print("📡 Create Geofence Response:", res.status_code, res.text)
+            return json_or_error(res)
+        except Exception as e:
+            print("❌ Error creating geofence subscription:", e)
+            return {"error": str(e)}
+
+    def retrieve_geofence_subscription(self, subscription_id: str) -> dict:
+        try:
+            res = self._request("geofencing", "GET", f"{GEOFENCE_SUBSCRIPTIONS_PATH}/{subscription_id}")
+            print("📡 Retrieve Subscription Response:", res.status_code, res.text)
+            return json_or_error(res)
+        except Exception as e:
+            print("❌ Error retrieving geofence subscription:", e)
+            return {"error": str(e)}
+
+    def delete_geofence_subscription(self, subscription_id: str) -> dict:
+        try:
+            res = self._request("geofencing", "DELETE", f"{GEOFENCE_SUBSCRIPTIONS_PATH}/{subscription_id}")
+            print("🗑️ Delete Geofence Response:", res.status_code, res.text)
+            return {"status": res.status_code, "response": res.text}
+        except Exception as e:
+            print("❌ Error deleting geofence subscription:", e)
+            return {"error": str(e)}
+
+    def list_geofence_subscriptions(self):
+        try:
+            res = self._request("geofencing", "GET", GEOFENCE_SUBSCRIPTIONS_PATH)
+            print("📋 List Subscriptions Response:", res.status_code, res.text)
+            return json_or_error(res)
+        except Exception as e:
+            print("❌ Error listing subscriptions:", e)
+            return {"error": str(e)}
+
+    # -- SIM swap --------------------------------------------------------------
+
+    def check_sim_swap(self, phone_number: str, max_age: int = 240) -> dict:
+        payload = {"phoneNumber": phone_number, "maxAge": max_age}
+        try:
+            res = self._request("sim_swap", "POST", SIM_SWAP_CHECK_PATH, payload)
+            print("📡 SIM Swap Check Response:", res.status_code, res.text)
+            return json_or_error(res)
+        except Exception as e:
+            print("❌ SIM Swap Check Error:", e)
+            return {"error": str(e)}
+
+    def retrieve_sim_swap_date(self, phone_number: str) -> dict:
+        payload = {"phoneNumber": phone_number}
+        try:
+            res = self._request("sim_swap", "POST", SIM_SWAP_DATE_PATH, payload)
+            print("📡 SIM Swap Retrieve Response:", res.status_code, res.text)
+            return json_or_error(res)
+        except Exception as e:
+            print("❌ SIM Swap Retrieve Error:", e)
+            return {"error": str(e)}
+
+    # -- number verification (routes/verify_number.py drives the OAuth flow) ---
+
+    def number_verification_credentials(self):
+        """(client_id, client_secret) of the application; raises on failure."""
+        res = self._request("verification", "GET", "/oauth2/v1/auth/clientcredentials")
+        if res.status_code != 200:
+            raise Exception("Error getting client credentials")
+        credentials = res.json()
+        return credentials["client_id"], credentials["client_secret"]
+
+    def number_verification_endpoints(self):
+        """(authorization_endpoint, token_endpoint) from the OIDC metadata; raises on failure."""
+        res = self._request("verification", "GET", "/.well-known/openid-configuration")
+        if res.status_code != 200:
+            raise Exception("Error getting endpoints")
+        endpoints = res.json()
+        return endpoints["authorization_endpoint"], endpoints["token_endpoint"]
+
+    def verify_number(self, phone_number: str, access_token: str) -> bool:
+        """True if the network confirms the device uses `phone_number`; raises on failure."""
+        res = self._request(
+            "verification",
+            "POST",
+            "/passthrough/camara/v1/number-verification/number-verification/v0/verify",
+            {"phoneNumber": phone_number},
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        print("Verification Response:", res.status_code, res.text)
+        if res.status_code != 200:
+            raise Exception("Error verifying phone number")
+        return bool(res.json().get("devicePhoneNumberVerified"))
+
+
+nokia = NokiaClient()
@@ -1,75 +1,11 @@
 from routes.verify_number import verify_number
 from flask import Blueprint, request, jsonify
-from ..nokia_client import (
-    verify_location_nokia,
-    create_geofence_subscription,
-    retrieve_geofence_subscription,
-    delete_geofence_subscription,
-    list_geofence_subscriptions,
-    check_sim_swap,
-    retrieve_sim_swap_date
-)
-import os
-import requests
+from ..nokia_client import nokia
+from services.location_cache import location_cache
 import json
 geofence_bp = Blueprint("geofence", __name__)
 
-# Verify Device Location (Existing)
 
-NOKIA_BASE_URL = os.getenv("NOKIA_BASE_URL")
-NOKIA_RAPIDAPI_KEY = os.getenv("NOKIA_RAPIDAPI_KEY")
-NOKIA_RAPIDAPI_HOST = os.getenv("NOKIA_RAPIDAPI_HOST")
-
-HEADERS = {
-    "Content-Type": "application/json",
-    "X-RapidAPI-Key": NOKIA_RAPIDAPI_KEY,
-    "X-RapidAPI-Host": NOKIA_RAPIDAPI_HOST
-}
-
-# ✅ Updated function to send correct payload
-def get_device_location(device_payload: dict):
-    """
-    Retrieve the current or last known location of a device from Nokia Network-as-Code.
-    """
-    url = f"{NOKIA_BASE_URL}/location-retrieval/v0/retrieve"
-
-    try:
-        print("📤 Sending payload to Nokia API:", json.dumps(device_payload, indent=2))
-
-        res = requests.post(
-            url,
-            data=json.dumps(device_payload),
-            headers=HEADERS,
-            timeout=15
-        )
-
-        print("📡 Nokia API Response:", res.status_code, res.text)
-
-        # ✅ Handle successful response
-        if res.status_code == 200:
-            data = res.json()
-
-            # Since the API returns directly (not inside "location")
-            area = data.get("area", {}) or {}
-            center = area.get("center", {}) or {}
-
-            return {
-                "lastLocationTime": data.get("lastLocationTime"),
-                "latitude": center.get("latitude"),
-                "longitude": center.get("longitude"),
-                "radius": area.get("radius"),
-                "areaType": area.get("areaType"),
-            }
-
-        # ❌ Any other status code = error
-        return {
-            "error": f"Unexpected response: {res.status_code} - {res.text}"
-        }
-
-    except Exception as e:
-        print("❌ Error retrieving device location:", e)
-        return {"error": str(e)}
-    
 @geofence_bp.route("/device/status/subscribe", methods=["POST"])
 def subscribe_device_status():
     """
@@ -91,33 +27,11 @@ def subscribe_device_status():
             "error": "Missing phoneNumber"
         }), 400
 
-    # Fixed subscription payload
-    payload = {
-        "subscriptionDetail": {
-            "device": {"phoneNumber": phone_number},
-            "type": "org.camaraproject.device-status.v0.roaming-status"
-        },
-        "subscriptionExpireTime": "2026-01-17T13:18:23.682Z",
-        "webhook": {
-            "notificationUrl": "https://application-server.com",
-            "notificationAuthToken": "c8974e592c2fa383d4a3960714"
-        }
-    }
-
-    url = f"{NOKIA_BASE_URL}/device-status/v0/subscriptions"
-
-    try:
-        res = requests.post(url, data=json.dumps(payload), headers=HEADERS, timeout=15)
-        print("📡 Device Status Subscription Response:", res.status_code, res.text)
-
-        if res.status_code in [200, 201]:
-            return jsonify({"success": True, "subscription": res.json()}), 200
-        else:
-            return jsonify({"success": False, "error": f"Unexpected response: {res.status_code} - {res.text}"}), 500
-
-    except Exception as e:
-        print("❌ Error creating device status subscription:", e)
-        return jsonify({"success": False, "error": str(e)}), 500
+    # fixed subscription payload (roaming status), built by the client
+    success, result = nokia.subscribe_device_status(phone_number)
+    if success:
+        return jsonify({"success": True, "subscription": result}), 200
+    return jsonify({"success": False, "error": result["error"]}), 500
 
 @geofence_bp.route("/device/status/connectivity", methods=["POST"])
 def get_device_connectivity_status():
@@ -139,21 +53,10 @@ def get_device_connectivity_status():
     if not phone_number:
         return jsonify({"success": False, "error": "Missing device.phoneNumber"}), 400
 
-    url = f"{NOKIA_BASE_URL}/device-status/v0/connectivity"
-    payload = {"device": {"phoneNumber": phone_number}}
-
-    try:
-        res = requests.post(url, data=json.dumps(payload), headers=HEADERS, timeout=15)
-        print("📡 Connectivity API Response:", res.status_code, res.text)
-
-        if res.status_code == 200:
-            return jsonify({"success": True, "connectivityStatus": res.json().get("connectivityStatus")}), 200
-        else:
-            return jsonify({"success": False, "error": f"Unexpected response: {res.status_code} - {res.text}"}), 500
-
-    except Exception as e:
-        print("❌ Error getting device connectivity status:", e)
-        return jsonify({"success": False, "error": str(e)}), 500
+    success, result = nokia.connectivity_status(phone_number)
+    if success:
+        return jsonify({"success": True, "connectivityStatus": result.get("connectivityStatus")}), 200
+    return jsonify({"success": False, "error": result["error"]}), 500
 
 
 # # Retrieve Device Location
@@ -178,7 +81,7 @@ def get_device_connectivity_status():
 #     phone_number = data["device"]["phoneNumber"]
 
 #     # 1️⃣ Get device location
-#     location_result = get_device_location(data)
+#     location_result = nokia.device_location(phone_number, data.get("maxAge"))
 #     if "error" in location_result:
 #         print("❌ Location retrieval failed:", location_result["error"])
 #         return jsonify({
@@ -248,87 +151,13 @@ def get_device_connectivity_status():
 #     }), 200
 
 
-# ---------------------------------------------------------------------
-# 🔹 Function: Subscribe Device to Status Updates
-# ---------------------------------------------------------------------
-def subscribe_device_status(phone_number):
-    subscription_payload = {
-        "subscriptionDetail": {
-            "device": {"phoneNumber": phone_number},
-            "type": "org.camaraproject.device-status.v0.roaming-status"
-        },
-        "subscriptionExpireTime": "2026-01-17T13:18:23.682Z",
-        "webhook": {
-            "notificationUrl": "https://application-server.com",
-            "notificationAuthToken": "c8974e592c2fa383d4a3960714"
-        }
-    }
-
-    print("📤 Subscription API Payload:", json.dumps(subscription_payload, indent=2))
-    subscription_url = f"{NOKIA_BASE_URL}/device-status/v0/subscriptions"
-
-    try:
-        response = requests.post(
-            subscription_url,
-            data=json.dumps(subscription_payload),
-            headers=HEADERS,
-            timeout=15
-        )
-        print("📡 Device Status Subscription Response Code:", response.status_code)
-        print("📡 Device Status Subscription Response Body:", response.text)
-
-        success = response.status_code in [200, 201]
-        result = response.json() if success else {
-            "error": f"Unexpected response: {response.status_code} - {response.text}"
-        }
-        return success, result
-
-    except Exception as e:
-        print("❌ Subscription API Exception:", e)
-        return False, {"error": str(e)}
-
-
-# ---------------------------------------------------------------------
-# 🔹 Function: Get Device Connectivity Status
-# ---------------------------------------------------------------------
-def get_device_connectivity_status(phone_number):
-    status_payload = {
-        "device": {"phoneNumber": phone_number}
-    }
-
-    print("📤 Connectivity Status API Payload:", json.dumps(status_payload, indent=2))
-    status_url = f"{NOKIA_BASE_URL}/device-status/v0/connectivity"
-
-    try:
-        response = requests.post(
-            status_url,
-            data=json.dumps(status_payload),
-            headers=HEADERS,
-            timeout=15
-        )
-        print("📡 Device Status Response Code:", response.status_code)
-        print("📡 Device Status Response Body:", response.text)
-
-        success = response.status_code in [200, 201]
-        result = response.json() if success else {
-            "error": f"Unexpected response: {response.status_code} - {response.text}"
-        }
-        return success, result
-
-    except Exception as e:
-        print("❌ Device Status API Exception:", e)
-        return False, {"error": str(e)}
-
-
-
-
 @geofence_bp.route("/location/cstatus",methods=["POST"])
 def get_connectivity_status():
     data = request.get_json()
     phone_number=data["phoneNumber"]
-    subscription_success, subscription_result = subscribe_device_status(phone_number)
+    subscription_success, subscription_result = nokia.subscribe_device_status(phone_number)
     # 3️⃣ Get device connectivity status
-    status_success, status_result = get_device_connectivity_status(phone_number)
+    status_success, status_result = nokia.connectivity_status(phone_number)
 
     return jsonify({
         "data": status_result,
@@ -366,7 +195,7 @@ def retrieve_location_and_status():
     phone_number = data["device"]["phoneNumber"]
 
     # 1️⃣ Get device location
-    location_result = get_device_location(data)
+    location_result = nokia.device_location(phone_number, data.get("maxAge"))
     if "error" in location_result:
         print("❌ Location retrieval failed:", location_result["error"])
         return jsonify({
@@ -375,10 +204,10 @@ def retrieve_location_and_status():
         }), 500
 
     # 2️⃣ Subscribe to device status
-    subscription_success, subscription_result = subscribe_device_status(phone_number)
+    subscription_success, subscription_result = nokia.subscribe_device_status(phone_number)
 
     # 3️⃣ Get device connectivity status
-    status_success, status_result = get_device_connectivity_status(phone_number)
+    status_success, status_result = nokia.connectivity_status(phone_number)
 
     # ✅ Return combined response
     return jsonify({
@@ -390,11 +219,18 @@ def retrieve_location_and_status():
         },
         "device_status": {
             "success": status_success,
-            "status": status_result["connectivityStatus"]
+            "status": status_result.get("connectivityStatus") if status_success else None,
+            "error": None if status_success else status_result.get("error")
         },
         "message": "✅ Device location retrieved, subscription processed, and device status fetched."
     }), 200
 
+@geofence_bp.route("/location/cache", methods=["GET"])
+def location_cache_stats():
+    """Hit/miss counters of the per-phone location cache in this process."""
+    return jsonify(location_cache.stats()), 200
+
+
 @geofence_bp.route("/trigger", methods=["POST"])
 def trigger_geofence():
     """
@@ -407,12 +243,11 @@ def trigger_geofence():
     phone_number = data.get("phone_number", "+99999991000")
     lat = data.get("lat")
     lon = data.get("lon")
-    timestamp = data.get("timestamp", "2025-10-07T12:00:00Z")
 
     if not lat or not lon:
         return jsonify({"error": "Missing coordinates"}), 400
 
-    verified = verify_location_nokia(phone_number, lat, lon, timestamp)
+    verified = nokia.verify_location(phone_number, lat, lon)
 
     return jsonify({
         "verified": verified,
@@ -436,7 +271,7 @@ def create_subscription():
     if not lat or not lon:
         return jsonify({"error": "Missing coordinates"}), 400
 
-    result = create_geofence_subscription(phone_number, lat, lon, radius)
+    result = nokia.create_geofence_subscription(phone_number, lat, lon, radius)
     return jsonify(result), 200
 
 
@@ -447,7 +282,7 @@ def get_subscription(subscription_id):
     Retrieve a single geofencing subscription by its ID.
     """
     print(f"🔍 Retrieving subscription: {subscription_id}")
-    result = retrieve_geofence_subscription(subscription_id)
+    result = nokia.retrieve_geofence_subscription(subscription_id)
     return jsonify(result), 200
 
 # Delete Geofencing Subscription
@@ -457,7 +292,7 @@ def remove_subscription(subscription_id):
     Delete a geofencing subscription by its ID.
     """
     print(f"🗑 Deleting subscription: {subscription_id}")
-    result = delete_geofence_subscription(subscription_id)
+    result = nokia.delete_geofence_subscription(subscription_id)
     return jsonify(result), 200
 
 
@@ -469,7 +304,7 @@ def list_subscriptions():
     List all active geofencing subscriptions.
     """
     print("📋 Listing all active subscriptions")
-    result = list_geofence_subscriptions()
+    result = nokia.list_geofence_subscriptions()
     return jsonify(result), 200
 
 
@@ -485,7 +320,7 @@ def simswap_check():
     max_age = data.get("max_age", 240)
 
     print(f"📡 Checking SIM swap for: {phone_number}")
-    result = check_sim_swap(phone_number, max_age)
+    result = nokia.check_sim_swap(phone_number, max_age)
     return jsonify(result), 200
 
 # Retrieve SIM Swap Date
@@ -499,7 +334,7 @@ def simswap_retrieve():
     phone_number = data.get("phone_number", "+99999991000")
 
     print(f"📡 Retrieving SIM swap date for: {phone_number}")
-    result = retrieve_sim_swap_date(phone_number)
+    result = nokia.retrieve_sim_swap_date(phone_number)
     return jsonify(result), 200
 
 
@@ -522,9 +357,9 @@ def redeem_offer():
     print(f"🎯 Redeem attempt: {phone_number} at {lat},{lon}")
 
     # Step 1: Check location
-    inside = verify_location_nokia(phone_number, lat, lon)
+    inside = nokia.verify_location(phone_number, lat, lon)
     # Step 2: Check SIM status
-    sim_info = check_sim_swap(phone_number)
+    sim_info = nokia.check_sim_swap(phone_number)
     changed = sim_info.get("changed", True)
 
     if inside and not changed:
@@ -1,3 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 
 db = SQLAlchemy()
+
+
+def postgis_installed(ddl, target, bind, **kw):
+    """execute_if() check: only run PostGIS DDL where the extension is installed."""
+    if bind is None:
+        return False
+    return bind.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'postgis'")).first() is not None
@@ -0,0 +1,93 @@
+"""
+Add the geography and campaign reach columns to active_offers and backfill
+existing rows.
+
+Only needed for databases whose active_offers table was created before the
+reach columns existed, or before PostGIS was installed (db.create_all() only
+adds the geography columns when the extension is present):
+
+    python -m migrations.add_offer_reach
+
+Safe to re-run; every step is idempotent.
+"""
+import os
+import psycopg2
+from dotenv import load_dotenv
+from models.active_offer_model import (
+    ACTIVE_OFFER_GEOG_COLUMN,
+    ACTIVE_OFFER_GEOG_INDEX,
+    ACTIVE_OFFER_REACH_COLUMN,
+    ACTIVE_OFFER_REACH_INDEX,
+    ACTIVE_OFFER_SYNC_FUNCTION,
+    ACTIVE_OFFER_GEOG_SYNC_TRIGGER,
+)
+
+load_dotenv(".env")
+
+STEPS = [
+    ("enable postgis", "CREATE EXTENSION IF NOT EXISTS postgis;"),
+    ("add geog column", ACTIVE_OFFER_GEOG_COLUMN),
+    ("add reach column", ACTIVE_OFFER_REACH_COLUMN),
+    ("add reach box columns", """
+        ALTER TABLE active_offers
+          ADD COLUMN IF NOT EXISTS reach_min_lat double precision,
+          ADD COLUMN IF NOT EXISTS reach_max_lat double precision,
+          ADD COLUMN IF NOT EXISTS reach_min_lon double precision,
+          ADD COLUMN IF NOT EXISTS reach_max_lon double precision;
+    """),
+    ("create sync function", ACTIVE_OFFER_SYNC_FUNCTION),
+    ("create sync trigger", ACTIVE_OFFER_GEOG_SYNC_TRIGGER),
+    # touching radius_km fires the trigger, which fills geog and reach
+    ("backfill reach", """
+        UPDATE active_offers
+        SET radius_km = radius_km,
+            reach_min_lat = GREATEST(lat - radius_km * 1000.0 / 111320.0, -90.0),
+            reach_max_lat = LEAST(lat + radius_km * 1000.0 / 111320.0, 90.0),
+            -- boxes crossing the antimeridian or reaching a pole span every longitude
+            reach_min_lon = CASE WHEN abs(lon) + LEAST(radius_km * 1000.0 / (111320.0 * GREATEST(cos(radians(lat)), 1e-6)), 180.0) > 180.0
+                                   OR abs(lat) + radius_km * 1000.0 / 111320.0 >= 90.0
+                                 THEN -180.0
+                                 ELSE lon - LEAST(radius_km * 1000.0 / (111320.0 * GREATEST(cos(radians(lat)), 1e-6)), 180.0) END,
+            reach_max_lon = CASE WHEN abs(lon) + LEAST(radius_km * 1000.0 / (111320.0 * GREATEST(cos(radians(lat)), 1e-6)), 180.0) > 180.0
+                                   OR abs(lat) + radius_km * 1000.0 / 111320.0 >= 90.0
+                                 THEN 180.0
+                                 ELSE lon + LEAST(radius_km * 1000.0 / (111320.0 * GREATEST(cos(radians(lat)), 1e-6)), 180.0) END
+        WHERE radius_km IS NOT NULL AND (reach IS NULL OR reach_min_lat IS NULL);
+    """),
+    # rows without a radius only need their geog point
+    ("backfill geog", "UPDATE active_offers SET lat = lat WHERE geog IS NULL;"),
+    ("create geog gist index", ACTIVE_OFFER_GEOG_INDEX),
+    ("create reach gist index", ACTIVE_OFFER_REACH_INDEX),
+    ("create box index", """
+        CREATE INDEX IF NOT EXISTS ix_active_offers_reach_box
+        ON active_offers (reach_min_lat, reach_max_lat, reach_min_lon, reach_max_lon);
+    """),
+    ("analyze active_offers", "ANALYZE active_offers;"),
+]
+
+
+def run():
+    raw_dsn = os.getenv("DATABASE_URL")
+    if raw_dsn.startswith("postgresql+psycopg2://"):
+        raw_dsn = raw_dsn.replace("postgresql+psycopg2://", "postgresql://")
+
+    conn = psycopg2.connect(raw_dsn)
+    try:
+        with conn.cursor() as cursor:
+            for label, sql in STEPS:
+                print(f"🛠️ {label} ...")
+                cursor.execute(sql)
+                if label in ("backfill reach", "backfill geog"):
+                    print(f"   - {cursor.rowcount} rows backfilled")
+        conn.commit()
+        print("✅ active_offers.reach migration complete")
+    except Exception as e:
+        conn.rollback()
+        print("❌ active_offers.reach migration failed:", e)
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,63 @@
+"""
+Add the persisted shops.geog column + GiST index and backfill existing rows.
+
+Run once against a database whose shops table was created before the column
+existed, or before PostGIS was installed (create_all() only adds it when the
+extension is present):
+
+    python -m migrations.add_shop_geog
+
+Safe to re-run; every step is idempotent.
+"""
+import os
+import psycopg2
+from dotenv import load_dotenv
+from models.shop_model import (
+    SHOP_GEOG_COLUMN,
+    SHOP_GEOG_INDEX,
+    SHOP_GEOG_SYNC_FUNCTION,
+    SHOP_GEOG_SYNC_TRIGGER,
+)
+
+load_dotenv(".env")
+
+STEPS = [
+    ("enable postgis", "CREATE EXTENSION IF NOT EXISTS postgis;"),
+    ("add geog column", SHOP_GEOG_COLUMN),
+    ("create sync function", SHOP_GEOG_SYNC_FUNCTION),
+    ("create sync trigger", SHOP_GEOG_SYNC_TRIGGER),
+    ("backfill geog", """
+        UPDATE shops
+        SET geog = ST_SetSRID(ST_MakePoint(lon::double precision, lat::double precision), 4326)::geography
+        WHERE lat IS NOT NULL AND lon IS NOT NULL AND geog IS NULL;
+    """),
+    ("create gist index", SHOP_GEOG_INDEX),
+    ("analyze shops", "ANALYZE shops;"),
+]
+
+
+def run():
+    raw_dsn = os.getenv("DATABASE_URL")
+    if raw_dsn.startswith("postgresql+psycopg2://"):
+        raw_dsn = raw_dsn.replace("postgresql+psycopg2://", "postgresql://")
+
+    conn = psycopg2.connect(raw_dsn)
+    try:
+        with conn.cursor() as cursor:
+            for label, sql in STEPS:
+                print(f"🛠️ {label} ...")
+                cursor.execute(sql)
+                if label == "backfill geog":
+                    print(f"   - {cursor.rowcount} rows backfilled")
+        conn.commit()
+        print("✅ shops.geog migration complete")
+    except Exception as e:
+        conn.rollback()
+        print("❌ shops.geog migration failed:", e)
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    run()
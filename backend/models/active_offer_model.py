@@ -0,0 +1,108 @@
+from datetime import datetime
+from sqlalchemy import DDL, event
+from database import db, postgis_installed
+
+# geog (the shop point) and reach are geography columns with GiST indexes.
+# They are not declared on the model: create_all() only adds them when
+# PostGIS is installed, so the table can still be created without it.
+ACTIVE_OFFER_GEOG_COLUMN = "ALTER TABLE active_offers ADD COLUMN IF NOT EXISTS geog geography(Point, 4326);"
+ACTIVE_OFFER_GEOG_INDEX = "CREATE INDEX IF NOT EXISTS ix_active_offers_geog ON active_offers USING GIST (geog);"
+ACTIVE_OFFER_REACH_COLUMN = "ALTER TABLE active_offers ADD COLUMN IF NOT EXISTS reach geography(Polygon, 4326);"
+ACTIVE_OFFER_REACH_INDEX = "CREATE INDEX IF NOT EXISTS ix_active_offers_reach ON active_offers USING GIST (reach);"
+
+# Keeps geog (shop point) and reach (the campaign's radius_km circle as a
+# polygon) in sync with lat/lon/radius_km. The buffer is widened by 1% so the
+# polygon's chords never cut inside the true circle; reach is only the
+# indexed prefilter, the exact test is ST_DWithin on geog.
+ACTIVE_OFFER_SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION active_offers_sync_geog() RETURNS trigger AS $$
+BEGIN
+  IF NEW.lat IS NULL OR NEW.lon IS NULL THEN
+    NEW.geog := NULL;
+  ELSE
+    NEW.geog := ST_SetSRID(ST_MakePoint(NEW.lon::double precision, NEW.lat::double precision), 4326)::geography;
+  END IF;
+  IF NEW.geog IS NULL OR NEW.radius_km IS NULL THEN
+    NEW.reach := NULL;
+  ELSE
+    NEW.reach := ST_Buffer(NEW.geog, NEW.radius_km * 1000.0 * 1.01);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+ACTIVE_OFFER_GEOG_SYNC_TRIGGER = """
+DROP TRIGGER IF EXISTS active_offers_sync_geog_trg ON active_offers;
+CREATE TRIGGER active_offers_sync_geog_trg
+  BEFORE INSERT OR UPDATE OF lat, lon, radius_km ON active_offers
+  FOR EACH ROW EXECUTE FUNCTION active_offers_sync_geog();
+"""
+
+class ActiveOfferModel(db.Model):
+    """
+    Materialized (shop, campaign) pairs for campaigns that are running or
+    scheduled, with the shop location copied in. Maintained by
+    services/active_offers.py on campaign/shop writes and purged of expired
+    campaigns, so nearby-offer reads are one spatial lookup on this table.
+    """
+    __tablename__ = "active_offers"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    campaign_id = db.Column(db.Integer, nullable=False, index=True)
+    shop_id = db.Column(db.Integer, nullable=False, index=True)
+    owner_uid = db.Column(db.String(128), nullable=True, index=True)
+
+    lat = db.Column(db.Numeric(9,6), nullable=False)
+    lon = db.Column(db.Numeric(9,6), nullable=False)
+
+    # lat/lon bounding box of the campaign reach, for databases without
+    # PostGIS (which get the buffered reach polygon instead)
+    reach_min_lat = db.Column(db.Float, nullable=True)
+    reach_max_lat = db.Column(db.Float, nullable=True)
+    reach_min_lon = db.Column(db.Float, nullable=True)
+    reach_max_lon = db.Column(db.Float, nullable=True)
+
+    start = db.Column(db.DateTime, nullable=False)
+    end = db.Column(db.DateTime, nullable=False)
+    radius_km = db.Column(db.Float, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("campaign_id", "shop_id", name="uq_active_offers_campaign_shop"),
+        db.Index("ix_active_offers_window", "start", "end"),
+        db.Index("ix_active_offers_lat_lon", "lat", "lon"),
+        db.Index("ix_active_offers_reach_box", "reach_min_lat", "reach_max_lat", "reach_min_lon", "reach_max_lon"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "campaign_id": self.campaign_id,
+            "shop_id": self.shop_id,
+            "owner_uid": self.owner_uid,
+            "lat": float(self.lat) if self.lat is not None else None,
+            "lon": float(self.lon) if self.lon is not None else None,
+            "start": self.start.isoformat() if self.start else None,
+            "end": self.end.isoformat() if self.end else None,
+            "radius_km": self.radius_km,
+        }
+
+
+# Fresh PostGIS databases get the geography columns, indexes and sync trigger
+# straight from create_all(); existing ones are handled by
+# migrations/add_offer_reach.py.
+for _ddl in (
+    ACTIVE_OFFER_GEOG_COLUMN,
+    ACTIVE_OFFER_GEOG_INDEX,
+    ACTIVE_OFFER_REACH_COLUMN,
+    ACTIVE_OFFER_REACH_INDEX,
+    ACTIVE_OFFER_SYNC_FUNCTION,
+    ACTIVE_OFFER_GEOG_SYNC_TRIGGER,
+):
+    event.listen(
+        ActiveOfferModel.__table__,
+        "after_create",
+        DDL(_ddl).execute_if(dialect="postgresql", callable_=postgis_installed),
+    )
@@ -0,0 +1,52 @@
+from datetime import datetime
+from database import db
+
+class CallbackEventModel(db.Model):
+    """
+    Durable queue of Nokia geofencing callbacks (CloudEvents). The webhook
+    only inserts here and answers 202; services/callback_queue.py drains it.
+    event_id is unique, so a redelivered callback is stored (and run) once.
+
+    status: pending -> processing -> done | failed (pending again on retry)
+            pending -> coalesced (superseded by a later event of the same
+                                  device, see coalesced_into)
+    """
+    __tablename__ = "geofence_callback_events"
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True, autoincrement=True)
+    event_id = db.Column(db.String(128), unique=True, nullable=False)
+    event_type = db.Column(db.String(255), nullable=True)
+    phone_number = db.Column(db.String(32), nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+
+    status = db.Column(db.String(16), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    coalesced = db.Column(db.Integer, nullable=False, default=0)  # earlier events merged into this one
+    coalesced_into = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), nullable=True)
+
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_geofence_callback_events_claim", "status", "available_at"),
+        db.Index("ix_geofence_callback_events_phone", "phone_number", "status"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "event_id": self.event_id,
+            "event_type": self.event_type,
+            "phone_number": self.phone_number,
+            "status": self.status,
+            "attempts": self.attempts,
+            "available_at": self.available_at.isoformat() if self.available_at else None,
+            "last_error": self.last_error,
+            "coalesced": self.coalesced,
+            "coalesced_into": self.coalesced_into,
+            "received_at": self.received_at.isoformat() if self.received_at else None,
+            "processed_at": self.processed_at.isoformat() if self.processed_at else None,
+        }
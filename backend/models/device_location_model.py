@@ -0,0 +1,60 @@
+from datetime import datetime
+from sqlalchemy import DDL, event
+from database import db
+
+# Newest fix per device, derived from the history.
+DEVICE_LATEST_LOCATIONS_VIEW = """
+CREATE OR REPLACE VIEW device_latest_locations AS
+SELECT DISTINCT ON (phone_number)
+       phone_number, lat, lon, accuracy_m, c_status, source, recorded_at
+FROM device_locations
+ORDER BY phone_number, recorded_at DESC;
+"""
+
+# Catches rows whose month partition has not been created yet
+# (services/location_history.py creates the monthly partitions).
+DEVICE_LOCATIONS_DEFAULT_PARTITION = """
+CREATE TABLE IF NOT EXISTS device_locations_default PARTITION OF device_locations DEFAULT;
+"""
+
+class DeviceLocationModel(db.Model):
+    """
+    Append-only history of device location fixes, range-partitioned by month
+    on recorded_at (PostgreSQL). Written in batches by
+    services/location_history.py; devices.latitude/longitude and the
+    device_latest_locations view are derived from it.
+    """
+    __tablename__ = "device_locations"
+
+    # the partition key has to be part of the primary key
+    id = db.Column(db.BigInteger, db.Identity(), primary_key=True)
+    recorded_at = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
+    phone_number = db.Column(db.String(32), nullable=False)
+
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+    accuracy_m = db.Column(db.Float, nullable=True)
+    c_status = db.Column(db.String(32), nullable=True)
+    source = db.Column(db.String(16), nullable=True)  # sweep | callback | ingest
+
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_device_locations_phone_time", "phone_number", "recorded_at"),
+        {"postgresql_partition_by": "RANGE (recorded_at)"},
+    )
+
+    def to_dict(self):
+        return {
+            "phone_number": self.phone_number,
+            "lat": self.lat,
+            "lon": self.lon,
+            "accuracy_m": self.accuracy_m,
+            "c_status": self.c_status,
+            "source": self.source,
+            "recorded_at": self.recorded_at.isoformat() if self.recorded_at else None,
+        }
+
+
+event.listen(DeviceLocationModel.__table__, "after_create", DDL(DEVICE_LOCATIONS_DEFAULT_PARTITION).execute_if(dialect="postgresql"))
+event.listen(DeviceLocationModel.__table__, "after_create", DDL(DEVICE_LATEST_LOCATIONS_VIEW).execute_if(dialect="postgresql"))
@@ -0,0 +1,50 @@
+from datetime import datetime
+from database import db
+
+class GeofenceSubscriptionModel(db.Model):
+    """
+    The live Nokia geofencing subscription of each device (at most one).
+    Maintained by services/subscription_registry.py so a device's circle is
+    reused while it stays put and replaced (old one deleted) when it moves.
+    """
+    __tablename__ = "geofence_subscriptions"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    phone_number = db.Column(db.String(32), unique=True, index=True, nullable=False)
+    subscription_id = db.Column(db.String(128), nullable=True, index=True)
+
+    center_lat = db.Column(db.Float, nullable=True)
+    center_lon = db.Column(db.Float, nullable=True)
+    radius_m = db.Column(db.Integer, nullable=True)
+
+    # last location fix and smoothed speed, for services/radius_policy.py
+    last_lat = db.Column(db.Float, nullable=True)
+    last_lon = db.Column(db.Float, nullable=True)
+    last_fix_at = db.Column(db.DateTime, nullable=True)
+    speed_mps = db.Column(db.Float, nullable=True)
+
+    expires_at = db.Column(db.DateTime, nullable=True)
+    max_events = db.Column(db.Integer, nullable=True)
+    events_remaining = db.Column(db.Integer, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "phone_number": self.phone_number,
+            "subscription_id": self.subscription_id,
+            "center_lat": self.center_lat,
+            "center_lon": self.center_lon,
+            "radius_m": self.radius_m,
+            "last_lat": self.last_lat,
+            "last_lon": self.last_lon,
+            "last_fix_at": self.last_fix_at.isoformat() if self.last_fix_at else None,
+            "speed_mps": self.speed_mps,
+            "expires_at": self.expires_at.isoformat() if self.expires_at else None,
+            "max_events": self.max_events,
+            "events_remaining": self.events_remaining,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
@@ -0,0 +1,26 @@
+from datetime import datetime
+from database import db
+
+class NotificationLedgerModel(db.Model):
+    """
+    Last push notification sent per (device, campaign). Backs the cooldown
+    and the per-device daily cap in services/notification_ledger.py.
+    """
+    __tablename__ = "notification_ledger"
+
+    phone_number = db.Column(db.String(32), primary_key=True)
+    campaign_id = db.Column(db.Integer, primary_key=True)
+    last_sent_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_count = db.Column(db.Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        db.Index("ix_notification_ledger_phone_sent", "phone_number", "last_sent_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "phone_number": self.phone_number,
+            "campaign_id": self.campaign_id,
+            "last_sent_at": self.last_sent_at.isoformat() if self.last_sent_at else None,
+            "sent_count": self.sent_count,
+        }
@@ -0,0 +1,20 @@
+from datetime import datetime
+from database import db
+
+class RateLimitBucketModel(db.Model):
+    """
+    Shared token bucket of one upstream endpoint family (e.g. "nokia:location").
+    Every worker process draws from the same row, see services/rate_limiter.py.
+    """
+    __tablename__ = "rate_limit_buckets"
+
+    name = db.Column(db.String(64), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "tokens": self.tokens,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
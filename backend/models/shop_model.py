@@ -1,5 +1,36 @@
 from datetime import datetime
-from database import db
+from sqlalchemy import DDL, event
+from database import db, postgis_installed
+
+# shops.geog is a geography point with a GiST index. It is not declared on
+# the model: create_all() only adds it when PostGIS is installed, so the
+# table can still be created on plain Postgres (and SQLite dev DBs).
+SHOP_GEOG_COLUMN = "ALTER TABLE shops ADD COLUMN IF NOT EXISTS geog geography(Point, 4326);"
+SHOP_GEOG_INDEX = "CREATE INDEX IF NOT EXISTS ix_shops_geog ON shops USING GIST (geog);"
+
+# Keeps shops.geog in sync with lat/lon on every INSERT/UPDATE so the nearby
+# queries can hit the GiST index instead of rebuilding a point per row.
+SHOP_GEOG_SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION shops_sync_geog() RETURNS trigger AS $$
+BEGIN
+  IF NEW.lat IS NULL OR NEW.lon IS NULL THEN
+    NEW.geog := NULL;
+  ELSE
+    NEW.geog := ST_SetSRID(
+      ST_MakePoint(NEW.lon::double precision, NEW.lat::double precision), 4326
+    )::geography;
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+SHOP_GEOG_SYNC_TRIGGER = """
+DROP TRIGGER IF EXISTS shops_sync_geog_trg ON shops;
+CREATE TRIGGER shops_sync_geog_trg
+  BEFORE INSERT OR UPDATE OF lat, lon ON shops
+  FOR EACH ROW EXECUTE FUNCTION shops_sync_geog();
+"""
 
 class ShopModel(db.Model):
     __tablename__ = "shops"
@@ -48,3 +79,14 @@ class ShopModel(db.Model):
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
+
+
+# Fresh PostGIS databases get the geog column, index and sync trigger straight
+# from create_all(); existing ones (or PostGIS installed later) are handled by
+# migrations/add_shop_geog.py.
+for _ddl in (SHOP_GEOG_COLUMN, SHOP_GEOG_INDEX, SHOP_GEOG_SYNC_FUNCTION, SHOP_GEOG_SYNC_TRIGGER):
+    event.listen(
+        ShopModel.__table__,
+        "after_create",
+        DDL(_ddl).execute_if(dialect="postgresql", callable_=postgis_installed),
+    )
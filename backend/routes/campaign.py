@@ -1,7 +1,10 @@
 import os
 from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required
 from database import db
 from models.campaign_model import CampaignModel
+from services.nearby_cache import invalidate_owner_shops
+from services.active_offers import sync_campaign, refresh_active_offers, rebuild_active_offers
 from datetime import datetime
 
 campaign_bp = Blueprint("campaign", __name__)
@@ -62,8 +65,17 @@ def create_campaign():
         )
 
         db.session.add(campaign_obj)
+        db.session.flush()
+        # same transaction as the campaign row: a failed sync rolls both back
+        sync_campaign(campaign_obj.id)
         db.session.commit()
         print("✅ Campaign saved in DB")
+        try:
+            invalidate_owner_shops(owner_uid)
+        except Exception as e:
+            # the campaign is committed; cached pages just age out with the TTL
+            db.session.rollback()
+            print("⚠️ Nearby cache not invalidated:", e)
 
         return jsonify({
             "message": "Campaign created successfully",
@@ -74,3 +86,23 @@ def create_campaign():
         db.session.rollback()
         print("❌ Error creating campaign:", e)
         return jsonify({"error": str(e)}), 500
+
+
+@campaign_bp.route("/active_offers/refresh", methods=["POST"])
+@jwt_required()
+def refresh_offers():
+    """
+    Maintain the active_offers table.
+    Query params:
+      full (optional) -- "1" rebuilds from shops x campaigns instead of only purging expired rows
+    """
+    try:
+        if request.args.get("full", "0").lower() in ("1", "true", "yes"):
+            count = rebuild_active_offers()
+            return jsonify({"message": "Active offers rebuilt", "count": count}), 200
+        removed = refresh_active_offers()
+        return jsonify({"message": "Expired offers purged", "removed": removed}), 200
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Failed to refresh active offers: %s", e)
+        return jsonify({"error": "Failed to refresh active offers"}), 500
@@ -2,7 +2,13 @@ from flask import Blueprint, request, jsonify, current_app
 from database import db
 from models.device_model import DeviceModel  # make sure you save the earlier model as device_model.py
 from datetime import datetime
+from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
+from services.ndjson import wants_ndjson, stream_execute, ndjson_response
+from services.local_geofence import local_fences, local_evaluation_enabled
+from services.callback_queue import enqueue_event
+from services.location_history import location_history, utc_naive
+from models.device_location_model import DeviceLocationModel
 
 device_bp = Blueprint("device", __name__)
 
@@ -64,11 +70,120 @@ def get_device(uid):
 
 @device_bp.route("/all", methods=["GET"])
 def get_all_devices():
-    """List all devices."""
+    """
+    List all devices.
+    With `Accept: application/x-ndjson` the devices are streamed one per line
+    from a server-side cursor instead of being loaded into one response.
+    """
+    if wants_ndjson():
+        def generate():
+            result = stream_execute(select(DeviceModel).order_by(DeviceModel.created_at.desc()))
+            for device in result.scalars():
+                yield device.to_dict()
+
+        return ndjson_response(generate())
+
     devices = DeviceModel.query.order_by(DeviceModel.created_at.desc()).all()
     return jsonify({"count": len(devices), "devices": [d.to_dict() for d in devices]}), 200
 
 
+def _parse_position(p):
+    phone_number = p.get("phone_number") or p.get("phoneNumber")
+    lat = p.get("latitude", p.get("lat"))
+    lon = p.get("longitude", p.get("lon"))
+    if not phone_number or lat is None or lon is None:
+        raise ValueError("phone_number, latitude and longitude are required")
+    lat, lon = float(lat), float(lon)
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError("latitude/longitude out of range")
+    at = p.get("time")
+    return {
+        "phone_number": phone_number,
+        "lat": lat,
+        "lon": lon,
+        "accuracy": float(p.get("accuracy", p.get("radius", 0)) or 0),
+        "at": utc_naive(datetime.fromisoformat(at.replace("Z", "+00:00"))) if at else None,
+    }
+
+
+@device_bp.route("/positions", methods=["POST"])
+def ingest_positions():
+    """
+    Position updates from devices, one object or {"positions": [...]}:
+    {
+        "phone_number": "+36...",
+        "latitude": 12.345678,
+        "longitude": 98.765432,
+        "accuracy": 25,              (meters, optional)
+        "time": "2025-01-01T10:00:00Z"  (optional)
+    }
+    Positions go to the location history (batched; the devices rows get the
+    newest one on the next flush). With
+    GEOFENCE_EVALUATION=local each position is also checked against the
+    device's fence and transitions are queued as geofence events.
+    """
+    data = request.get_json(silent=True) or {}
+    raw = data.get("positions") if isinstance(data.get("positions"), list) else [data]
+    try:
+        positions = [_parse_position(p) for p in raw]
+    except (TypeError, ValueError, AttributeError) as e:
+        return jsonify({"error": f"Invalid position: {e}"}), 400
+
+    try:
+        location_history.record_many(
+            (p["phone_number"], p["lat"], p["lon"], p["accuracy"] or None, p["at"], None, "ingest")
+            for p in positions
+        )
+
+        events = []
+        if local_evaluation_enabled():
+            for p in positions:
+                event = local_fences.evaluate(p["phone_number"], p["lat"], p["lon"], p["accuracy"], p["at"])
+                if event is not None:
+                    enqueue_event(event)
+                    events.append({"phone_number": p["phone_number"], "type": event["type"], "id": event["id"]})
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.exception("Database error while ingesting positions: %s", e)
+        return jsonify({"error": "Database error"}), 500
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Failed to ingest positions: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "accepted": len(positions),
+        "events": events,
+        "fences": local_fences.status(),
+        "history": location_history.status(),
+    }), 202
+
+
+@device_bp.route("/<string:uid>/locations", methods=["GET"])
+def get_device_locations(uid):
+    """
+    Location history of one device, newest first.
+    Query params:
+      - limit (optional, default 100, max 1000)
+      - since (optional, ISO timestamp)
+    """
+    device = DeviceModel.query.filter_by(uid=uid).first()
+    if not device:
+        return jsonify({"error": "Device not found"}), 404
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+        since = request.args.get("since")
+        since = utc_naive(datetime.fromisoformat(since.replace("Z", "+00:00"))) if since else None
+    except ValueError:
+        return jsonify({"error": "Invalid limit or since"}), 400
+
+    query = DeviceLocationModel.query.filter(DeviceLocationModel.phone_number == device.phone_number)
+    if since is not None:
+        query = query.filter(DeviceLocationModel.recorded_at >= since)
+    rows = query.order_by(DeviceLocationModel.recorded_at.desc()).limit(limit).all()
+    return jsonify({"count": len(rows), "locations": [r.to_dict() for r in rows]}), 200
+
+
 @device_bp.route("/test", methods=["GET"])
 def test_device():
     """Simple health check route."""
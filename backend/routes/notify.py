@@ -81,10 +81,15 @@ import google.auth.transport.requests
 import firebase_admin
 from firebase_admin import credentials, firestore
 import os
+from services.resilience import Resilience
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Gets current file’s directory
 SERVICE_ACCOUNT_FILE = "pinpoint-e02f5-firebase-adminsdk-fbsvc-76372b9547.json" # Path to Firebase service account key
 PROJECT_ID = "pinpoint-e02f5"                   # Your Firebase project ID
 FCM_ENDPOINT = f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send"
+FCM_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+
+# retries 429/503 (honouring Retry-After) and fails fast while FCM is down
+fcm_resilience = Resilience("fcm")
 
 
 if not firebase_admin._apps:
@@ -132,8 +137,14 @@ def send_fcm_message(token, title, body, data=None, image_url=None):
         }
     }
 
-    response = requests.post(FCM_ENDPOINT, headers=headers, data=json.dumps(message))
+    # a send is not idempotent: only retried when FCM cannot have delivered it
+    response = fcm_resilience.call(
+        "send",
+        lambda: requests.post(FCM_ENDPOINT, headers=headers, data=json.dumps(message), timeout=FCM_TIMEOUT),
+        idempotent=False,
+    )
     print("📡 FCM Response:", response.status_code, response.text)
+    response.raise_for_status()
     return response.json()
 
 
@@ -1,18 +1,32 @@
 # blueprints/shop.py
-from flask import Blueprint, request, jsonify, current_app,url_for
+from flask import Blueprint, request, jsonify, current_app
 from database import db
 from models.shop_model import ShopModel
 from models.product_model import ProductModel
 from models.campaign_model import CampaignModel
-from datetime import datetime
 import os
 import requests
 import uuid,time
-from sqlalchemy import text
-from sqlalchemy.exc import ProgrammingError
-import random
-import math
+import base64
+import json
+from sqlalchemy.exc import ProgrammingError, OperationalError
+from sqlalchemy.orm import Session
 from werkzeug.utils import secure_filename
+from flask_jwt_extended import jwt_required
+from services.spatial_index import shop_index, index_shop, load_shop_index, haversine_m
+from services.distance_engine import EngineUnavailable, haversine_engine, hydrate_shops, postgis_enabled, postgis_failed
+from services.nearby_cache import nearby_cache
+from services.active_offers import sync_shop
+from services.ndjson import wants_ndjson, stream_limit, ndjson_response, STREAM_CHUNK_ROWS
+from services import campaign_discovery as discovery
+from services.spatial_queries import (
+    active_campaigns_statement,
+    campaign_item,
+    nearby_params,
+    nearby_shops_statement,
+    query_stats,
+    shop_item,
+)
 
 
 shop_bp = Blueprint("shop", __name__)
@@ -21,6 +35,19 @@ shop_bp = Blueprint("shop", __name__)
 MAP_PROVIDER = os.getenv("MAP_PROVIDER", "GOOGLE")  # "GOOGLE" | "MAPBOX" | "NOKIA"
 MAPS_API_KEY = os.getenv("MAPS_API_KEY", "")
 
+# Serve /shops/nearby from the in-process grid index when it is loaded
+SPATIAL_INDEX_ENABLED = os.getenv("SPATIAL_INDEX_ENABLED", "1").lower() in ("1", "true", "yes")
+
+# Radius cap for the nearby endpoints (meters)
+MAX_NEARBY_RADIUS_M = float(os.getenv("MAX_NEARBY_RADIUS_M", "10000"))
+
+# Upper bound on points accepted by /active_campaigns_nearby/batch
+MAX_BATCH_POINTS = int(os.getenv("MAX_BATCH_POINTS", "1000"))
+
+# Page size bounds for the nearby / campaign list endpoints (and per batch point)
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = int(os.getenv("MAX_PAGE_LIMIT", "500"))
+
 ALLOWED_IMAGE_EXT = {"png", "jpg", "jpeg", "gif", "webp"}
 
 def _allowed_file(filename):
@@ -153,7 +180,12 @@ def create_shop():
         )
 
         db.session.add(shop)
+        db.session.flush()
+        # same transaction as the shop row: a failed sync rolls both back
+        sync_shop(shop.id)
         db.session.commit()
+        index_shop(shop)
+        nearby_cache.invalidate_point(shop.lat, shop.lon)
 
         return jsonify({"message": "Shop created", "shop": shop.to_dict()}), 201
 
@@ -173,16 +205,280 @@ def get_shop(shop_id):
 
 
 
+def _page_limit(raw, default=DEFAULT_PAGE_LIMIT):
+    """Page size from a query/body value, clamped to 1..MAX_PAGE_LIMIT."""
+    try:
+        limit = int(raw) if raw is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, MAX_PAGE_LIMIT))
+
+
+# Engines whose distances a cursor is measured in. The grid index and the
+# haversine engine share one metric, PostGIS orders by the KNN operator.
+CURSOR_ENGINES = ("postgis", "haversine")
+
+CURSOR_EXPIRED = "cursor expired, request the first page again"
+
+
+def _encode_cursor(distance, row_id, engine):
+    """Opaque keyset cursor for the last row of a page: (distance, id) and the engine that measured it."""
+    raw = json.dumps({"d": float(distance), "id": int(row_id), "e": engine}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    """
+    Return ((distance, id), engine) from a cursor string, or (None, None) if
+    absent. Raises ValueError if malformed.
+    """
+    if not cursor:
+        return None, None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        after, engine = (float(data["d"]), int(data["id"])), data["e"]
+    except Exception:
+        raise ValueError("invalid cursor")
+    if engine not in CURSOR_ENGINES:
+        raise ValueError("invalid cursor")
+    return after, engine
+
+
+def _sort_distance(r):
+    """(distance the rows were ordered by, engine): the KNN value on PostGIS, distance_m otherwise."""
+    knn_m = getattr(r, "knn_m", None)
+    return (knn_m, "postgis") if knn_m is not None else (r.distance_m, "haversine")
+
+
+def _paginate(rows, limit, key):
+    """
+    Rows were fetched with LIMIT limit + 1 in (distance, id) order. Trim to
+    `limit` and build the cursor for the next page (None when exhausted);
+    `key(row)` is (distance, id, engine).
+    """
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, _encode_cursor(*key(page[-1]))
+
+
+@shop_bp.route("/index/rebuild", methods=["POST"])
+@jwt_required()
+def rebuild_shop_index():
+    """Rebuild this process's in-memory shop spatial index from the shops table (drops tombstones too)."""
+    try:
+        started = time.time()
+        count = load_shop_index()
+        elapsed_ms = round((time.time() - started) * 1000, 1)
+        current_app.logger.info("Shop index rebuilt: %d shops in %.1f ms", count, elapsed_ms)
+        return jsonify({"message": "Shop index rebuilt", "count": count, "elapsedMs": elapsed_ms}), 200
+    except Exception as e:
+        current_app.logger.exception("Failed to rebuild shop index: %s", e)
+        return jsonify({"error": "Failed to rebuild shop index"}), 500
+
+
+def _cached_nearby(kind, query, point_of, lat, lon, radius_m, limit, after, engine=None):
+    """
+    Answer a nearby query through `nearby_cache`. The cache holds candidate
+    sets queried around the caller's geohash cell; distances, the radius
+    trim, the order and the cursor are recomputed from this caller's point.
+    `point_of(item)` is the (lat, lon) of an item.
+    Returns (results, next_cursor).
+    """
+    if not nearby_cache.enabled or after is not None:
+        results, _, next_cursor = query(lat, lon, radius_m, limit, after, engine)
+        return results, next_cursor
+
+    key, q_lat, q_lon, q_radius, q_limit, slack_m = nearby_cache.normalize(kind, lat, lon, radius_m, limit)
+    entry = nearby_cache.get(key)
+    if entry is None:
+        results, keys, next_cursor = query(q_lat, q_lon, q_radius, q_limit, None)
+        # a truncated candidate set is complete only up to its farthest row
+        horizon = keys[-1][0] if next_cursor is not None else None
+        entry = (results, [k[1] for k in keys], horizon)
+        nearby_cache.put(key, entry, q_lat, q_lon, q_radius)
+
+    page = _page_from_candidates(entry, point_of, lat, lon, radius_m, limit, slack_m)
+    if page is None:
+        # the page reaches past what the candidate set is known to contain
+        results, _, next_cursor = query(lat, lon, radius_m, limit, None)
+        return results, next_cursor
+    return page
+
+
+def _page_from_candidates(entry, point_of, lat, lon, radius_m, limit, slack_m):
+    """
+    The caller's first page from a cached candidate set, or None when the set
+    cannot be trusted to hold it. Distances are haversine from (lat, lon), so
+    the cursor continues on the haversine metric.
+    """
+    results, ids, horizon = entry
+    # every row within `complete_m` of the caller is in the set (1 m covers KNN vs haversine rounding)
+    complete_m = radius_m if horizon is None else min(radius_m, horizon - slack_m - 1.0)
+
+    ranked = []
+    for item, row_id in zip(results, ids):
+        p_lat, p_lon = point_of(item)
+        if p_lat is None or p_lon is None:
+            continue
+        d = haversine_m(lat, lon, p_lat, p_lon)
+        if d <= radius_m:
+            ranked.append((d, row_id, item))
+    ranked.sort(key=lambda t: (t[0], t[1]))
+
+    if complete_m < radius_m:
+        ranked = [t for t in ranked if t[0] <= complete_m]
+        if len(ranked) <= limit:
+            return None
+
+    page = ranked[:limit]
+    next_cursor = _encode_cursor(page[-1][0], page[-1][1], "haversine") if len(ranked) > limit else None
+    return [dict(item, distanceMeters=d) for d, _, item in page], next_cursor
+
+
+def _shop_point(item):
+    return item["lat"], item["lon"]
+
+
+def _shop_sort_key(r, index_distances):
+    if r.id in index_distances:
+        return index_distances[r.id], r.id, "haversine"
+    d, engine = _sort_distance(r)
+    return d, r.id, engine
+
+
+def _query_nearby_shops(lat, lon, radius_m, limit, after, engine=None):
+    """
+    Run the nearby-shops lookup (grid index -> PostGIS -> haversine engine).
+    `engine` pins the engine a cursor came from (EngineUnavailable if it is gone).
+    Returns (results, sort_keys, next_cursor); raises on database errors.
+    """
+    rows = None
+    index_distances = {}
+    if engine == "postgis" and not postgis_enabled():
+        raise EngineUnavailable("postgis")
+    if engine != "postgis" and SPATIAL_INDEX_ENABLED and shop_index.loaded:
+        # Answer from the in-process grid, then hydrate the top-K rows in one IN (...) fetch
+        try:
+            hits = shop_index.nearby(lat, lon, radius_m, limit + 1, after=after)
+            index_distances = dict(hits)
+            rows = hydrate_shops([sid for sid, _ in hits])
+        except Exception as e:
+            current_app.logger.warning("Shop index lookup failed, falling back to SQL: %s", e)
+            db.session.rollback()
+            rows = None
+            index_distances = {}
+
+    if rows is None and engine != "haversine" and postgis_enabled():
+        # Prefer PostGIS: ST_DWithin on the stored shops.geog column is GiST-index backed
+        try:
+            rows = nearby_shops_statement(after).fetch(nearby_params(lat, lon, radius_m, limit + 1, after))
+        except (ProgrammingError, OperationalError) as pe:
+            # PostGIS functions missing (SQLite / stock Postgres) -> haversine engine below
+            current_app.logger.warning("PostGIS query failed, falling back to haversine engine: %s", pe)
+            db.session.rollback()
+            postgis_failed(pe)
+            if engine == "postgis":
+                raise EngineUnavailable("postgis") from pe
+
+    if rows is None:
+        rows = haversine_engine.nearby_shops(lat, lon, radius_m, limit + 1, after=after)
+
+    rows, next_cursor = _paginate(rows, limit, key=lambda r: _shop_sort_key(r, index_distances))
+
+    # Build response — match frontend Shop model
+    results = [shop_item(r, index_distances.get(r.id, getattr(r, "distance_m", None))) for r in rows]
+
+    keys = [_shop_sort_key(r, index_distances) for r in rows]
+    return results, keys, next_cursor
+
+
+
+def _stream_rows(result, session, item):
+    """Items off a server-side cursor opened on its own `session`, closed when the stream ends."""
+    try:
+        for r in result:
+            yield item(r)
+    finally:
+        session.close()
+
+
+def _stream_nearby_shops(lat, lon, radius_m, limit, after, engine=None):
+    """
+    NDJSON variant of _query_nearby_shops. Picks the engine and opens the
+    query in the view, so a pinned engine that is gone is an EngineUnavailable
+    before any line is sent; returns an iterator of items for the streamed
+    response (see services/ndjson.py). PostGIS rows come straight off a
+    server-side cursor on a session of their own (the request's session is
+    removed when the view returns); the grid index / haversine paths rank ids
+    up front and hydrate them STREAM_CHUNK_ROWS at a time while streaming.
+    """
+    if engine == "postgis" and not postgis_enabled():
+        raise EngineUnavailable("postgis")
+    ranked = None
+    if engine != "postgis" and SPATIAL_INDEX_ENABLED and shop_index.loaded:
+        try:
+            ranked = shop_index.nearby(lat, lon, radius_m, limit, after=after)
+        except Exception as e:
+            current_app.logger.warning("Shop index lookup failed, falling back to SQL: %s", e)
+            ranked = None
+
+    if ranked is None and engine != "haversine" and postgis_enabled():
+        session = Session(db.engine)
+        try:
+            result = nearby_shops_statement(after).stream(
+                nearby_params(lat, lon, radius_m, limit, after), STREAM_CHUNK_ROWS, session=session
+            )
+        except (ProgrammingError, OperationalError) as pe:
+            session.close()
+            current_app.logger.warning("PostGIS query failed, falling back to haversine engine: %s", pe)
+            postgis_failed(pe)
+            if engine == "postgis":
+                # the cursor's distances are PostGIS ones; nothing to continue from
+                raise EngineUnavailable("postgis") from pe
+        else:
+            return _stream_rows(result, session, lambda r: shop_item(r, getattr(r, "distance_m", None)))
+
+    if ranked is None:
+        ranked = haversine_engine.rank_shops(lat, lon, radius_m, limit, after=after)
+    return _hydrate_ranked(ranked)
+
+
+def _hydrate_ranked(ranked):
+    for i in range(0, len(ranked), STREAM_CHUNK_ROWS):
+        chunk = ranked[i:i + STREAM_CHUNK_ROWS]
+        distances = dict(chunk)
+        for r in hydrate_shops([sid for sid, _ in chunk]):
+            yield shop_item(r, distances[r.id])
+
+
+@shop_bp.route("/nearby/cache", methods=["GET"])
+def nearby_cache_stats():
+    """Hit/miss/invalidation counters for this process's nearby response cache."""
+    return jsonify(nearby_cache.stats()), 200
+
+
+@shop_bp.route("/spatial/stats", methods=["GET"])
+def spatial_query_stats():
+    """Per-statement call counts and timings for the shared spatial queries in this process."""
+    return jsonify(query_stats()), 200
+
+
 @shop_bp.route("/nearby", methods=["GET"])
 def nearby_shops():
     """
     Query params:
       lat (required), lon (required),
       radius_m (optional, default 10000),  -- default 10km
-      limit (optional, default 50)
+      limit (optional, default 50, max MAX_PAGE_LIMIT) -- page size
+      cursor (optional)                    -- nextCursor from the previous page
 
     Returns shops ordered by distance (nearest first) up to radius, plus
     hasOffer flag if owner_uid has an active campaign and ownerUid in result.
+    Paging is keyset-based on (distance, id), so each page starts where the
+    previous one stopped instead of re-sorting with OFFSET.
+    With `Accept: application/x-ndjson` the shops are streamed one per line.
     """
     try:
         lat = float(request.args.get("lat", None))
@@ -197,163 +493,103 @@ def nearby_shops():
         radius_m = 10000.0
 
     # cap radius to 10 km (safeguard)
-    if radius_m > 10000:
-        radius_m = 10000.0
+    if radius_m > MAX_NEARBY_RADIUS_M:
+        radius_m = MAX_NEARBY_RADIUS_M
+
+    limit = _page_limit(request.args.get("limit"))
 
     try:
-        limit = int(request.args.get("limit", 50))
-    except Exception:
-        limit = 50
-
-    # Prefer PostGIS: use ST_DWithin + ST_Distance for accurate ordering
-    postgis_sql = """
-    SELECT
-      s.id,
-      s.name,
-      s.category,
-      s.description,
-      s.address_line,
-      s.city,
-      s.lat,
-      s.lon,
-      s.avg_spend,
-      s.image_url,
-      s.owner_uid,
-      -- distance in meters using geography
-      ST_Distance(
-        ST_SetSRID(ST_MakePoint(COALESCE(s.lon,0), COALESCE(s.lat,0)), 4326)::geography,
-        ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography
-      ) AS distance_m,
-      -- whether there exists an active campaign owned by this shop owner
-      EXISTS (
-        SELECT 1 FROM campaigns c
-        WHERE c.owner_uid IS NOT NULL
-          AND c.owner_uid = s.owner_uid
-          AND c.start <= now() AT TIME ZONE 'utc'
-          AND c.end >= now() AT TIME ZONE 'utc'
-      ) AS has_offer
-    FROM shops s
-    WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-      AND ST_DWithin(
-        ST_SetSRID(ST_MakePoint(COALESCE(s.lon,0), COALESCE(s.lat,0)), 4326)::geography,
-        ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography,
-        :radius_m
-      )
-    ORDER BY distance_m ASC
-    LIMIT :limit
-    """
+        after, engine = _decode_cursor(request.args.get("cursor"))
+    except ValueError:
+        return jsonify({"error": "invalid cursor"}), 400
+    if engine == "postgis" and not postgis_enabled():
+        return jsonify({"error": CURSOR_EXPIRED}), 400
+
+    if wants_ndjson():
+        # streamed, uncached, one shop per line; limit defaults to the stream cap
+        try:
+            items = _stream_nearby_shops(lat, lon, radius_m, stream_limit(request.args.get("limit")), after, engine)
+        except EngineUnavailable:
+            return jsonify({"error": CURSOR_EXPIRED}), 400
+        except Exception as e:
+            current_app.logger.exception("Error running nearby query: %s", e)
+            return jsonify({"error": "Internal server error"}), 500
+        return ndjson_response(items)
 
     try:
-        q = db.session.execute(
-            text(postgis_sql),
-            {"lat": lat, "lon": lon, "radius_m": radius_m, "limit": limit},
+        results, next_cursor = _cached_nearby(
+            "shops", _query_nearby_shops, _shop_point, lat, lon, radius_m, limit, after, engine
         )
-        rows = q.fetchall()
-    except ProgrammingError as pe:
-        # PostGIS functions missing (or syntax error). Fall back to Haversine SQL.
-        current_app.logger.warning("PostGIS query failed, falling back to Haversine: %s", pe)
-
-        # Haversine (meters) — earth radius 6371000
-        haversine_sql = """
-        SELECT
-          s.id,
-          s.name,
-          s.category,
-          s.description,
-          s.address_line,
-          s.city,
-          s.lat,
-          s.lon,
-          s.avg_spend,
-          s.image_url,
-          s.owner_uid,
-          (6371000 * 2 * asin(sqrt(
-            power(sin(radians((COALESCE(s.lat,0) - :lat)/2)),2) +
-            cos(radians(:lat)) * cos(radians(COALESCE(s.lat,0))) *
-            power(sin(radians((COALESCE(s.lon,0) - :lon)/2)),2)
-          ))) AS distance_m,
-          EXISTS (
-            SELECT 1 FROM campaigns c
-            WHERE c.owner_uid IS NOT NULL
-              AND c.owner_uid = s.owner_uid
-              AND c.start <= now() AT TIME ZONE 'utc'
-              AND c.end >= now() AT TIME ZONE 'utc'
-          ) AS has_offer
-        FROM shops s
-        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-        HAVING distance_m <= :radius_m
-        ORDER BY distance_m ASC
-        LIMIT :limit
-        """
-        q = db.session.execute(
-            text(haversine_sql),
-            {"lat": lat, "lon": lon, "radius_m": radius_m, "limit": limit},
-        )
-        rows = q.fetchall()
+    except EngineUnavailable:
+        return jsonify({"error": CURSOR_EXPIRED}), 400
     except Exception as e:
         current_app.logger.exception("Error running nearby query: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 
-    # Build response — match frontend Shop model
-    results = []
-    for r in rows:
-        # rows may be sqlalchemy Row/RowProxy — access by column name
-        sid = getattr(r, "id", None)
-        name = getattr(r, "name", None)
-        category = getattr(r, "category", None)
-        lat_val = getattr(r, "lat", None)
-        lon_val = getattr(r, "lon", None)
-        avg_spend = getattr(r, "avg_spend", None)
-        image_url = getattr(r, "image_url", None)
-        owner_uid = getattr(r, "owner_uid", None)
-        description = getattr(r, "description", None) or ""
-        distance_m = getattr(r, "distance_m", None)
-        has_offer = getattr(r, "has_offer", False)
-
-        # normalize numeric types
-        try:
-            distance_m_f = float(distance_m) if distance_m is not None else None
-        except Exception:
-            distance_m_f = None
+    current_app.logger.debug("nearby_shops results: %s", results)
+    return jsonify({"count": len(results), "shops": results, "nextCursor": next_cursor}), 200
+
+
+# Add this route to the blueprint you prefer, e.g. shop_bp or campaign_bp
+def _campaign_point(item):
+    return item["shop"]["lat"], item["shop"]["lon"]
+
+
+def _campaign_sort_key(r):
+    d, engine = _sort_distance(r)
+    return d, r.campaign_id, engine
+
+
+def _query_active_campaigns(lat, lon, radius_m, limit, after, engine=None):
+    """
+    Run the active-campaigns lookup (PostGIS -> haversine engine); `engine`
+    pins the engine a cursor came from.
+    Returns (items, sort_keys, next_cursor); raises on database errors.
+    """
+    rows = discovery.active_campaigns_nearby(lat, lon, radius_m, limit + 1, after=after, engine=engine)
+    rows, next_cursor = _paginate(rows, limit, key=_campaign_sort_key)
+
+    results = [campaign_item(r) for r in rows]
+    return results, [_campaign_sort_key(r) for r in rows], next_cursor
+
 
+
+def _stream_active_campaigns(lat, lon, radius_m, limit, after, engine=None):
+    """NDJSON variant of _query_active_campaigns; opens the query in the view like _stream_nearby_shops."""
+    if engine == "postgis" and not postgis_enabled():
+        raise EngineUnavailable("postgis")
+    if engine != "haversine" and postgis_enabled():
+        session = Session(db.engine)
         try:
-            avg_spend_f = float(avg_spend) if avg_spend is not None else None
-        except Exception:
-            avg_spend_f = None
-
-        # Randomize rating (between 3.5 and 5.0, one decimal) — optional
-        rating = round(random.uniform(3.5, 5.0), 1)
-
-        results.append({
-            "id": sid,
-            "name": name,
-            "category": category,
-            "lat": float(lat_val) if lat_val is not None else None,
-            "lon": float(lon_val) if lon_val is not None else None,
-            "avgSpend": avg_spend_f,
-            "hasOffer": bool(has_offer),
-            "distanceMeters": distance_m_f,
-            "snippet": description,      # frontend expects snippet -> use description
-            "imageUrl": image_url,
-            "rating": rating,
-            "ownerUid": owner_uid  # <-- added owner UID here
-        })
+            result = active_campaigns_statement(after).stream(
+                nearby_params(lat, lon, radius_m, limit, after), STREAM_CHUNK_ROWS, session=session
+            )
+        except (ProgrammingError, OperationalError) as pe:
+            session.close()
+            current_app.logger.warning("PostGIS query failed, falling back to haversine engine: %s", pe)
+            postgis_failed(pe)
+            if engine == "postgis":
+                raise EngineUnavailable("postgis") from pe
+        else:
+            return _stream_rows(result, session, campaign_item)
 
-    current_app.logger.debug("nearby_shops results: %s", results)
-    return jsonify({"count": len(results), "shops": results}), 200
+    rows = haversine_engine.active_campaigns_nearby(lat, lon, radius_m, limit, after=after)
+    return (campaign_item(r) for r in rows)
 
 
-# Add this route to the blueprint you prefer, e.g. shop_bp or campaign_bp
 @shop_bp.route("/active_campaigns_nearby", methods=["GET"])
 def active_campaigns_nearby():
     """
     Query params:
       lat (required), lon (required),
       radius_m (optional, default 10000),  -- maximum 10km by default
-      limit (optional, default 50)
+      limit (optional, default 50, max MAX_PAGE_LIMIT) -- page size
+      cursor (optional)                    -- nextCursor from the previous page
 
     Returns a list of active campaigns joined with shop details ordered by nearest first.
     Each item contains both campaign and shop fields so frontend can render offers.
+    Paged with a (distance, campaign id) keyset cursor.
+    With `Accept: application/x-ndjson` the items are streamed one per line.
     """
     # parse lat/lon
     try:
@@ -369,177 +605,125 @@ def active_campaigns_nearby():
         radius_m = 10000.0
 
     # cap to 10km for safety (remove if you want)
-    if radius_m > 10000:
-        radius_m = 10000.0
+    if radius_m > MAX_NEARBY_RADIUS_M:
+        radius_m = MAX_NEARBY_RADIUS_M
+
+    limit = _page_limit(request.args.get("limit"))
 
     try:
-        limit = int(request.args.get("limit", 50))
-    except Exception:
-        limit = 50
-
-    # PostGIS query: join shops -> campaigns where campaign active
-    postgis_sql = """
-    SELECT
-      s.id        AS shop_id,
-      s.owner_uid AS shop_owner_uid,
-      s.name      AS shop_name,
-      s.category  AS shop_category,
-      s.description AS shop_description,
-      s.address_line,
-      s.city,
-      s.lat,
-      s.lon,
-      s.avg_spend,
-      s.image_url,
-      c.id        AS campaign_id,
-      c.owner_uid AS campaign_owner_uid,
-      c.title     AS campaign_title,
-      c.offer     AS campaign_offer,
-      c.poster_path,
-      c.radius_km,
-      c.start     AS campaign_start,
-      c.end       AS campaign_end,
-      -- compute distance in meters using geography
-      ST_Distance(
-        ST_SetSRID(ST_MakePoint(COALESCE(s.lon,0), COALESCE(s.lat,0)), 4326)::geography,
-        ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography
-      ) AS distance_m
-    FROM shops s
-    JOIN campaigns c
-      ON c.owner_uid IS NOT NULL
-      AND c.owner_uid = s.owner_uid
-    WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-      AND c.start <= now() AT TIME ZONE 'utc'
-      AND c.end >= now() AT TIME ZONE 'utc'
-      AND ST_DWithin(
-        ST_SetSRID(ST_MakePoint(COALESCE(s.lon,0), COALESCE(s.lat,0)), 4326)::geography,
-        ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography,
-        :radius_m
-      )
-    ORDER BY distance_m ASC
-    LIMIT :limit
-    """
+        after, engine = _decode_cursor(request.args.get("cursor"))
+    except ValueError:
+        return jsonify({"error": "invalid cursor"}), 400
+    if engine == "postgis" and not postgis_enabled():
+        return jsonify({"error": CURSOR_EXPIRED}), 400
+
+    if wants_ndjson():
+        # streamed, uncached, one item per line; limit defaults to the stream cap
+        try:
+            items = _stream_active_campaigns(lat, lon, radius_m, stream_limit(request.args.get("limit")), after, engine)
+        except EngineUnavailable:
+            return jsonify({"error": CURSOR_EXPIRED}), 400
+        except Exception as e:
+            current_app.logger.exception("Error running active campaigns nearby query: %s", e)
+            return jsonify({"error": "Internal server error"}), 500
+        return ndjson_response(items)
 
     try:
-        q = db.session.execute(
-            text(postgis_sql),
-            {"lat": lat, "lon": lon, "radius_m": radius_m, "limit": limit},
+        results, next_cursor = _cached_nearby(
+            "campaigns", _query_active_campaigns, _campaign_point, lat, lon, radius_m, limit, after, engine
         )
-        rows = q.fetchall()
-    except ProgrammingError as pe:
-        # PostGIS missing or syntax error -> fallback to Haversine raw SQL
-        current_app.logger.warning("PostGIS query failed, falling back to Haversine: %s", pe)
-
-        # Haversine (meters) — earth radius 6371000
-        haversine_sql = """
-        SELECT
-          s.id        AS shop_id,
-          s.owner_uid AS shop_owner_uid,
-          s.name      AS shop_name,
-          s.category  AS shop_category,
-          s.description AS shop_description,
-          s.address_line,
-          s.city,
-          s.lat,
-          s.lon,
-          s.avg_spend,
-          s.image_url,
-          c.id        AS campaign_id,
-          c.owner_uid AS campaign_owner_uid,
-          c.title     AS campaign_title,
-          c.offer     AS campaign_offer,
-          c.poster_path,
-          c.radius_km,
-          c.start     AS campaign_start,
-          c.end       AS campaign_end,
-          (6371000 * 2 * asin(sqrt(
-            power(sin(radians((COALESCE(s.lat,0) - :lat)/2)),2) +
-            cos(radians(:lat)) * cos(radians(COALESCE(s.lat,0))) *
-            power(sin(radians((COALESCE(s.lon,0) - :lon)/2)),2)
-          ))) AS distance_m
-        FROM shops s
-        JOIN campaigns c
-          ON c.owner_uid IS NOT NULL
-          AND c.owner_uid = s.owner_uid
-        WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
-          AND c.start <= now() AT TIME ZONE 'utc'
-          AND c.end >= now() AT TIME ZONE 'utc'
-        HAVING distance_m <= :radius_m
-        ORDER BY distance_m ASC
-        LIMIT :limit
-        """
-        q = db.session.execute(
-            text(haversine_sql),
-            {"lat": lat, "lon": lon, "radius_m": radius_m, "limit": limit},
-        )
-        rows = q.fetchall()
+    except EngineUnavailable:
+        return jsonify({"error": CURSOR_EXPIRED}), 400
     except Exception as e:
         current_app.logger.exception("Error running active campaigns nearby query: %s", e)
         return jsonify({"error": "Internal server error"}), 500
 
-    # Build response
-    results = []
-    for r in rows:
-        # Access by column names
-        shop_id = getattr(r, "shop_id", None)
-        shop_name = getattr(r, "shop_name", None)
-        shop_category = getattr(r, "shop_category", None)
-        shop_description = getattr(r, "shop_description", None) or ""
-        shop_lat = getattr(r, "lat", None)
-        shop_lon = getattr(r, "lon", None)
-        avg_spend = getattr(r, "avg_spend", None)
-        image_url = getattr(r, "image_url", None)
-
-        campaign_id = getattr(r, "campaign_id", None)
-        campaign_title = getattr(r, "campaign_title", None)
-        campaign_offer = getattr(r, "campaign_offer", None)
-        poster_path = getattr(r, "poster_path", None)
-        campaign_start = getattr(r, "campaign_start", None)
-        campaign_end = getattr(r, "campaign_end", None)
-
-        distance_m = getattr(r, "distance_m", None)
+    return jsonify({"count": len(results), "items": results, "nextCursor": next_cursor}), 200
+
+
+def _query_campaigns_reaching(lat, lon, limit):
+    """
+    Reverse match: active campaigns whose own reach circle (radius_km around
+    the shop) contains (lat, lon), nearest shop first (PostGIS -> haversine engine).
+    """
+    return [campaign_item(r) for r in discovery.campaigns_reaching(lat, lon, limit)]
+
+
+@shop_bp.route("/campaigns_reaching", methods=["GET"])
+def campaigns_reaching():
+    """
+    Query params:
+      lat (required), lon (required),
+      limit (optional, default 50, max MAX_PAGE_LIMIT)
+
+    Returns the active campaigns whose reach (each campaign's radius_km
+    around its shop) contains the point -- the lookup a device movement needs.
+    Items have the same shape as /active_campaigns_nearby.
+    """
+    try:
+        lat = float(request.args.get("lat", None))
+        lon = float(request.args.get("lon", None))
+    except Exception:
+        return jsonify({"error": "lat and lon query parameters required and must be numeric"}), 400
+
+    limit = _page_limit(request.args.get("limit"))
+
+    try:
+        results = _query_campaigns_reaching(lat, lon, limit)
+    except Exception as e:
+        current_app.logger.exception("Error running campaigns reaching query: %s", e)
+        return jsonify({"error": "Internal server error"}), 500
+
+    return jsonify({"count": len(results), "items": results}), 200
+
+
+@shop_bp.route("/active_campaigns_nearby/batch", methods=["POST"])
+def active_campaigns_nearby_batch():
+    """
+    JSON body:
+      {
+        "points": [ {"lat": .., "lon": .., "radius_m": ..}, ... ],   -- radius_m optional, default/max 10km
+        "limit": 50                                                  -- per point, max MAX_PAGE_LIMIT
+      }
+
+    Returns one entry per input point, in input order, each with the same
+    "items" shape as /active_campaigns_nearby. All points are answered by a
+    single statement (LATERAL join over the unnested points arrays).
+    """
+    payload = request.get_json(silent=True) or {}
+    raw_points = payload.get("points")
+    if not isinstance(raw_points, list) or not raw_points:
+        return jsonify({"error": "points must be a non-empty list"}), 400
+    if len(raw_points) > MAX_BATCH_POINTS:
+        return jsonify({"error": f"at most {MAX_BATCH_POINTS} points per request"}), 400
+
+    points = []
+    for p in raw_points:
         try:
-            distance_m_f = float(distance_m) if distance_m is not None else None
+            lat = float(p["lat"])
+            lon = float(p["lon"])
         except Exception:
-            distance_m_f = None
-
+            return jsonify({"error": "each point needs numeric lat and lon"}), 400
         try:
-            avg_spend_f = float(avg_spend) if avg_spend is not None else None
+            radius_m = float(p.get("radius_m", 10000))
         except Exception:
-            avg_spend_f = None
-
-        # optional randomized rating for frontend
-        rating = round(random.uniform(3.5, 5.0), 1)
-
-        results.append({
-            "shop": {
-                "id": shop_id,
-                "owner_uid": getattr(r, "shop_owner_uid", None),
-                "name": shop_name,
-                "category": shop_category,
-                "description": shop_description,
-                "address_line": getattr(r, "address_line", None),
-                "city": getattr(r, "city", None),
-                "lat": float(shop_lat) if shop_lat is not None else None,
-                "lon": float(shop_lon) if shop_lon is not None else None,
-                "avgSpend": avg_spend_f,
-                "imageUrl": image_url,
-                "rating": rating,
-            },
-            "campaign": {
-                "id": campaign_id,
-                "owner_uid": getattr(r, "campaign_owner_uid", None),
-                "title": campaign_title,
-                "offer": campaign_offer,
-                "poster_path": poster_path,
-                "start": campaign_start.isoformat() if campaign_start else None,
-                "end": campaign_end.isoformat() if campaign_end else None,
-                "radius_km": getattr(r, "radius_km", None),
-            },
-            "distanceMeters": distance_m_f,
-        })
+            radius_m = 10000.0
+        points.append((lat, lon, min(radius_m, MAX_NEARBY_RADIUS_M)))
 
-    return jsonify({"count": len(results), "items": results}), 200
+    limit = _page_limit(payload.get("limit"))
+
+    try:
+        per_point = discovery.active_campaigns_nearby_batch(points, limit)
+    except Exception as e:
+        current_app.logger.exception("Error running batch active campaigns query: %s", e)
+        return jsonify({"error": "Internal server error"}), 500
+
+    results = []
+    for (lat, lon, radius_m), point_rows in zip(points, per_point):
+        items = [campaign_item(r) for r in point_rows]
+        results.append({"lat": lat, "lon": lon, "radius_m": radius_m, "count": len(items), "items": items})
+
+    return jsonify({"count": len(results), "results": results}), 200
 
 
 @shop_bp.route("/shopdetails_and_campaigns", methods=["GET"])
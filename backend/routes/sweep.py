@@ -0,0 +1,34 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required
+from services.geofence_scheduler import geofence_scheduler
+from services.rate_limiter import nokia_rate_limiter
+from services.resilience import resilience_status
+
+sweep_bp = Blueprint("sweep", __name__)
+
+
+@sweep_bp.route("/status", methods=["GET"])
+def sweep_status():
+    """Last/next geofence sweep, its duration and summary, for this process."""
+    return jsonify(geofence_scheduler.status()), 200
+
+
+@sweep_bp.route("/run", methods=["POST"])
+@jwt_required()
+def run_sweep_now():
+    """Start a sweep in the background unless one is already running (metered Nokia calls, FCM pushes)."""
+    if not geofence_scheduler.trigger():
+        return jsonify({"message": "Sweep already running", "status": geofence_scheduler.status()}), 409
+    return jsonify({"message": "Sweep started"}), 202
+
+
+@sweep_bp.route("/upstreams", methods=["GET"])
+def upstream_status():
+    """Circuit breakers and retry counters of the Nokia and FCM upstreams, for this process."""
+    return jsonify(resilience_status()), 200
+
+
+@sweep_bp.route("/rate-limits", methods=["GET"])
+def rate_limit_status():
+    """Nokia token buckets, with grants, waits and shed calls of this process."""
+    return jsonify(nokia_rate_limiter.status()), 200
@@ -1,20 +1,16 @@
-import requests
 import urllib.parse
 import os
 
+# app.nokia_client is imported inside the functions below: app.routes.geofence
+# imports this module while the app package is still loading.
 
 
 # ------------------------------
 # 🔧 CONFIGURATION
 # ------------------------------
-NAC_CLIENT_CREDENTIALS_URL = "https://network-as-code.p-eu.rapidapi.com/oauth2/v1/auth/clientcredentials"
-WELL_KNOWN_METADATA_URL = "https://network-as-code.p-eu.rapidapi.com/.well-known/openid-configuration"
-NUMBER_VERIFICATION_URL = "https://network-as-code.p-eu.rapidapi.com/passthrough/camara/v1/number-verification/number-verification/v0/verify"
-RAPIDAPIHOST = "network-as-code.nokia.rapidapi.com"
 REDIRECT_URI = "https://teammosambi.requestcatcher.com/"  # Replace with your RequestCatcher URL
 
 PHONE_NUMBER = "99999991001" 
-RAPIDAPI_KEY = "026086a8f0msh74fcf7cb83ef534p1bd1e2jsnd9a723138bc6"  # Replace with your real key
 
 # Globals
 CLIENT_ID = None
@@ -28,44 +24,30 @@ ACCESS_TOKEN = None
 # 🪙 Step 1: Get Client Credentials
 # ------------------------------
 def get_client_credentials():
-    headers = {
-        "content-type": "application/json",
-        "X-RapidAPI-Key": RAPIDAPI_KEY,
-        "X-RapidAPI-Host": RAPIDAPIHOST,
-    }
-
-    response = requests.get(NAC_CLIENT_CREDENTIALS_URL, headers=headers)
-    if response.status_code != 200:
-        raise Exception("Error getting client credentials")
+    from app.nokia_client import nokia
 
-    credentials = response.json()
+    credentials = nokia.number_verification_credentials()
     print("Client Credentials:", credentials)
-    return credentials["client_id"], credentials["client_secret"]
+    return credentials
 
 
 # ------------------------------
 # 🔗 Step 2: Get Authorization + Token Endpoints
 # ------------------------------
 def get_endpoints():
-    headers = {
-        "content-type": "application/json",
-        "X-RapidAPI-Key": RAPIDAPI_KEY,
-        "X-RapidAPI-Host": RAPIDAPIHOST,
-    }
+    from app.nokia_client import nokia
 
-    response = requests.get(WELL_KNOWN_METADATA_URL, headers=headers)
-    if response.status_code != 200:
-        raise Exception("Error getting endpoints")
-
-    endpoints = response.json()
+    endpoints = nokia.number_verification_endpoints()
     print("OIDC Metadata:", endpoints)
-    return endpoints["authorization_endpoint"], endpoints["token_endpoint"]
+    return endpoints
 
 
 # ------------------------------
 # 🔐 Step 3: Get Authorization Code
 # ------------------------------
 def get_authorization_code():
+    from app.nokia_client import nokia
+
     auth_code_url = (
         f"{AUTH_ENDPOINT}?scope=number-verification:verify"
         f"&response_type=code"
@@ -77,7 +59,7 @@ def get_authorization_code():
 
     print("Auth Code URL:", auth_code_url)
 
-    response = requests.get(auth_code_url, allow_redirects=True)
+    response = nokia.session.get(auth_code_url, allow_redirects=True, timeout=nokia.timeout("verification"))
     final_url = response.url
 
     parsed_url = urllib.parse.urlparse(final_url)
@@ -95,6 +77,8 @@ def get_authorization_code():
 # 🪙 Step 4: Get Access Token
 # ------------------------------
 def get_access_token():
+    from app.nokia_client import nokia
+
     data = {
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
@@ -103,7 +87,7 @@ def get_access_token():
     }
 
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(TOKEN_ENDPOINT, data=data, headers=headers)
+    response = nokia.session.post(TOKEN_ENDPOINT, data=data, headers=headers, timeout=nokia.timeout("verification"))
 
     if response.status_code != 200:
         raise Exception("Error getting Access Token")
@@ -117,23 +101,9 @@ def get_access_token():
 
 
 def verify_phone_number():
-    headers = {
-        "content-type": "application/json",
-        "X-RapidAPI-Key": RAPIDAPI_KEY,
-        "X-RapidAPI-Host": RAPIDAPIHOST,
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-    }
-
-    data = {"phoneNumber": f"+{PHONE_NUMBER}"}
-    response = requests.post(NUMBER_VERIFICATION_URL, json=data, headers=headers)
-
-    print("Verification Response:", response.status_code, response.text)
-
-    if response.status_code != 200:
-        raise Exception("Error verifying phone number")
+    from app.nokia_client import nokia
 
-    result = response.json()
-    if result.get("devicePhoneNumberVerified"):
+    if nokia.verify_number(f"+{PHONE_NUMBER}", ACCESS_TOKEN):
         print("✅ Number verification successful!")
         return True
     else:
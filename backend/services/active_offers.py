@@ -0,0 +1,104 @@
+# services/active_offers.py
+"""
+Maintenance for the active_offers table (models/active_offer_model.py).
+
+active_offers holds one row per (shop, campaign) where the campaign has not
+ended yet, with the shop location and the campaign window copied in. The
+nearby-offer reads then only touch this table (GiST on geog, btree on the
+window) instead of joining shops x campaigns and re-checking owner_uid
+per row. Each row also carries the campaign's reach (radius_km around the
+shop) so "which campaigns cover this point?" is an index lookup too.
+
+Writers call sync_campaign / sync_shop after flushing their shop/campaign
+row, in the same transaction, and commit both together: a failed sync rolls
+the write back too, so a retried create does not leave duplicates. Expired
+rows are purged by refresh_active_offers(). All functions need an app
+context; the refresh and rebuild commit their own transaction.
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import db
+from models.active_offer_model import ActiveOfferModel  # noqa: F401  (registers the table for create_all)
+from services.distance_engine import bounding_box
+
+_CANDIDATES_SQL = """
+SELECT c.id AS campaign_id, s.id AS shop_id, s.owner_uid, s.lat, s.lon,
+       c.start, c."end" AS end_at, c.radius_km
+FROM shops s
+JOIN campaigns c
+  ON c.owner_uid IS NOT NULL
+  AND c.owner_uid = s.owner_uid
+WHERE s.lat IS NOT NULL AND s.lon IS NOT NULL
+  AND c."end" >= :now
+"""
+
+_INSERT_SQL = text("""
+INSERT INTO active_offers (
+  campaign_id, shop_id, owner_uid, lat, lon, start, "end", radius_km,
+  reach_min_lat, reach_max_lat, reach_min_lon, reach_max_lon, created_at
+) VALUES (
+  :campaign_id, :shop_id, :owner_uid, :lat, :lon, :start, :end_at, :radius_km,
+  :reach_min_lat, :reach_max_lat, :reach_min_lon, :reach_max_lon, :now
+)
+""")
+
+
+def _materialize(where="", params=None):
+    """
+    Insert the (shop, campaign) pairs matching `where`. The reach bounding box
+    is computed here so databases without PostGIS can prefilter on it; the
+    PostGIS trigger derives geog and reach from the same columns.
+    """
+    now = datetime.utcnow()
+    rows = db.session.execute(text(_CANDIDATES_SQL + where), dict(params or {}, now=now)).fetchall()
+    payload = []
+    for r in rows:
+        row = dict(r._mapping, now=now)
+        if r.radius_km is not None:
+            box = bounding_box(float(r.lat), float(r.lon), float(r.radius_km) * 1000.0)
+        else:
+            box = (None, None, None, None)
+        row.update(zip(("reach_min_lat", "reach_max_lat", "reach_min_lon", "reach_max_lon"), box))
+        payload.append(row)
+    if payload:
+        db.session.execute(_INSERT_SQL, payload)
+    return len(payload)
+
+
+def sync_campaign(campaign_id):
+    """(Re)materialize the offers of one campaign. The caller commits."""
+    db.session.execute(text("DELETE FROM active_offers WHERE campaign_id = :cid"), {"cid": campaign_id})
+    return _materialize("  AND c.id = :cid", {"cid": campaign_id})
+
+
+def sync_shop(shop_id):
+    """(Re)materialize the offers attached to one shop (its owner's campaigns). The caller commits."""
+    db.session.execute(text("DELETE FROM active_offers WHERE shop_id = :sid"), {"sid": shop_id})
+    return _materialize("  AND s.id = :sid", {"sid": shop_id})
+
+
+def refresh_active_offers():
+    """Drop offers whose campaign has ended. Returns the number of rows removed."""
+    res = db.session.execute(
+        text('DELETE FROM active_offers WHERE "end" < :now'), {"now": datetime.utcnow()}
+    )
+    db.session.commit()
+    return res.rowcount
+
+
+def rebuild_active_offers():
+    """Rebuild the whole table from shops x campaigns. Returns the row count."""
+    db.session.execute(text("DELETE FROM active_offers"))
+    count = _materialize()
+    db.session.commit()
+    return count
+
+
+def ensure_active_offers():
+    """Startup hook: backfill an empty table, otherwise just purge expired rows."""
+    has_rows = db.session.execute(text("SELECT 1 FROM active_offers LIMIT 1")).first() is not None
+    if not has_rows:
+        return "rebuilt", rebuild_active_offers()
+    return "purged", refresh_active_offers()
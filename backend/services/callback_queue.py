@@ -0,0 +1,325 @@
+# services/callback_queue.py
+"""
+Durable queue for the Nokia geofencing webhook (/api/geofence/callback).
+
+The webhook only calls enqueue_event(): one INSERT into
+geofence_callback_events (models/callback_event_model.py) and a 202, so its
+latency no longer depends on the Nokia location/connectivity/subscription
+calls. A redelivered callback carries the same CloudEvent id and hits the
+unique event_id, so it is acknowledged but not queued twice.
+
+CallbackWorkerPool drains the table with at-least-once semantics:
+
+  * a worker claims the oldest due event (FOR UPDATE SKIP LOCKED, so
+    workers in several processes never take the same row) and marks it
+    processing with a lease,
+  * success marks it done; a failure puts it back to pending with
+    exponential backoff, and after CALLBACK_MAX_ATTEMPTS it is parked as
+    failed,
+  * an event whose worker died is claimed again once its lease
+    (CALLBACK_LEASE_SECONDS) has run out.
+
+Bursts are coalesced per device: a new event only becomes due
+CALLBACK_COALESCE_SECONDS after it arrived, and when a worker claims an
+event it also takes every other pending event of the same phone number.
+Only the latest of them is handled; the earlier ones are marked coalesced
+(coalesced_into = the event that ran) and counted on it, so a device
+wobbling along a fence edge costs one location/resubscribe cycle per
+window instead of one per area-left/area-entered.
+
+Settings (env):
+  CALLBACK_WORKERS         worker threads (default 4)
+  CALLBACK_WORKER_MODE     thread (default): drain inside the API process
+                           off: run the standalone worker instead:
+                               python -m services.callback_queue
+  CALLBACK_POLL_SECONDS    idle poll interval (default 2)
+  CALLBACK_MAX_ATTEMPTS    attempts before an event is parked (default 5)
+  CALLBACK_LEASE_SECONDS   processing lease (default 300)
+  CALLBACK_RETRY_SECONDS   first retry delay, doubled per attempt (default 5)
+  CALLBACK_COALESCE_SECONDS  per-device merge window (default 5, 0 = no delay)
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from database import db
+from models.callback_event_model import CallbackEventModel
+from services.pg import pg_connection
+
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", "4"))
+CALLBACK_WORKER_MODE = os.getenv("CALLBACK_WORKER_MODE", "thread").lower()
+CALLBACK_POLL_S = float(os.getenv("CALLBACK_POLL_SECONDS", "2"))
+CALLBACK_MAX_ATTEMPTS = int(os.getenv("CALLBACK_MAX_ATTEMPTS", "5"))
+CALLBACK_LEASE_S = float(os.getenv("CALLBACK_LEASE_SECONDS", "300"))
+CALLBACK_RETRY_S = float(os.getenv("CALLBACK_RETRY_SECONDS", "5"))
+CALLBACK_RETRY_MAX_S = 600.0
+CALLBACK_COALESCE_S = max(0.0, float(os.getenv("CALLBACK_COALESCE_SECONDS", "5")))
+
+_DUE_SQL = """
+SELECT id, phone_number FROM geofence_callback_events
+WHERE (status = 'pending' AND available_at <= %(now)s)
+   OR (status = 'processing' AND locked_at < %(lease_cutoff)s)
+ORDER BY available_at, id
+LIMIT 1
+FOR UPDATE SKIP LOCKED;
+"""
+
+# the due event plus every other pending event of the same device
+_BURST_SQL = """
+SELECT id FROM geofence_callback_events
+WHERE phone_number = %(phone)s AND status = 'pending' AND id <> %(id)s
+ORDER BY id
+FOR UPDATE SKIP LOCKED;
+"""
+
+
+def event_key(event):
+    """The CloudEvent id, or a digest of the payload when the sender left it out."""
+    if event.get("id"):
+        return str(event["id"])
+    return hashlib.sha256(json.dumps(event, sort_keys=True).encode()).hexdigest()
+
+
+def enqueue_event(event):
+    """
+    Store one callback (needs an app context). Returns (queued, event_id);
+    queued is False when the event was already received.
+    """
+    # imported here: the event helpers pull in the Nokia clients
+    from services.geofence_events import event_phone_number
+
+    key = event_key(event)
+    db.session.add(CallbackEventModel(
+        event_id=key,
+        event_type=event.get("eventType") or event.get("type"),
+        phone_number=event_phone_number(event),
+        payload=json.dumps(event),
+        status="pending",
+        attempts=0,
+        available_at=datetime.utcnow() + timedelta(seconds=CALLBACK_COALESCE_S),
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False, key
+    if not CALLBACK_COALESCE_S:
+        callback_workers.wake()
+    return True, key
+
+
+def queue_counts():
+    """{status: rows} for the queue table (needs an app context)."""
+    rows = (
+        db.session.query(CallbackEventModel.status, func.count(CallbackEventModel.id))
+        .group_by(CallbackEventModel.status)
+        .all()
+    )
+    return {status: count for status, count in rows}
+
+
+class CallbackWorkerPool:
+    def __init__(self, handler, workers=CALLBACK_WORKERS, poll_s=CALLBACK_POLL_S):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.poll_s = max(0.1, poll_s)
+
+        self._stop = threading.Event()
+        self._wake = threading.Condition()
+        self._threads = []
+        self._state_lock = threading.Lock()
+
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.last_error = None
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self):
+        if any(t.is_alive() for t in self._threads):
+            return False
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._loop, name=f"callback-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+        print(f"📥 Callback queue workers started: {self.workers}")
+        return True
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self.wake(all_workers=True)
+        for t in self._threads:
+            t.join(timeout)
+
+    def run_forever(self):
+        """Foreground workers for the standalone process."""
+        self.start()
+        try:
+            while not self._stop.wait(60):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def wake(self, all_workers=False):
+        """Nudge an idle worker (same process) instead of waiting for the next poll."""
+        with self._wake:
+            if all_workers:
+                self._wake.notify_all()
+            else:
+                self._wake.notify()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                worked = self.drain_one()
+            except Exception as e:
+                # database unreachable etc.; back off one poll interval
+                print(f"❌ Callback queue error: {e}")
+                worked = False
+            if not worked:
+                with self._wake:
+                    self._wake.wait(self.poll_s)
+
+    # -- processing --------------------------------------------------------
+
+    def _claim(self):
+        """
+        Claim the next due event and coalesce its device's burst. Returns
+        (id, event_id, payload, attempts, [superseded payloads]) or None.
+        """
+        now = datetime.utcnow()
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(_DUE_SQL, {"now": now, "lease_cutoff": now - timedelta(seconds=CALLBACK_LEASE_S)})
+                due = cursor.fetchone()
+                if due is None:
+                    conn.commit()
+                    return None
+                due_id, phone_number = due
+
+                burst = [due_id]
+                if phone_number:
+                    cursor.execute(_BURST_SQL, {"phone": phone_number, "id": due_id})
+                    burst = sorted(burst + [r[0] for r in cursor.fetchall()])
+                latest_id, superseded_ids = burst[-1], burst[:-1]
+
+                superseded = []
+                if superseded_ids:
+                    cursor.execute(
+                        """
+                        UPDATE geofence_callback_events
+                        SET status = 'coalesced', coalesced_into = %s, processed_at = %s, locked_at = NULL
+                        WHERE id = ANY(%s)
+                        RETURNING payload;
+                        """,
+                        (latest_id, now, superseded_ids),
+                    )
+                    superseded = [r[0] for r in cursor.fetchall()]
+                cursor.execute(
+                    """
+                    UPDATE geofence_callback_events
+                    SET status = 'processing', locked_at = %s, attempts = attempts + 1,
+                        coalesced = coalesced + %s
+                    WHERE id = %s
+                    RETURNING id, event_id, payload, attempts;
+                    """,
+                    (now, len(superseded_ids), latest_id),
+                )
+                row = cursor.fetchone()
+            conn.commit()
+        return row + (superseded,)
+
+    def _finish(self, row_id, error=None, attempts=0):
+        now = datetime.utcnow()
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                if error is None:
+                    cursor.execute(
+                        """
+                        UPDATE geofence_callback_events
+                        SET status = 'done', processed_at = %s, locked_at = NULL, last_error = NULL
+                        WHERE id = %s;
+                        """,
+                        (now, row_id),
+                    )
+                else:
+                    parked = attempts >= CALLBACK_MAX_ATTEMPTS
+                    delay = min(CALLBACK_RETRY_S * (2 ** (attempts - 1)), CALLBACK_RETRY_MAX_S)
+                    cursor.execute(
+                        """
+                        UPDATE geofence_callback_events
+                        SET status = %s, available_at = %s, locked_at = NULL, last_error = %s
+                        WHERE id = %s;
+                        """,
+                        ("failed" if parked else "pending", now + timedelta(seconds=delay), error[:2000], row_id),
+                    )
+            conn.commit()
+
+    def drain_one(self):
+        """Claim and process one due event. Returns False when the queue had nothing due."""
+        row = self._claim()
+        if row is None:
+            return False
+        row_id, event_id, payload, attempts, superseded = row
+        if superseded:
+            with self._state_lock:
+                self.coalesced += len(superseded)
+        try:
+            self.handler(json.loads(payload), [json.loads(p) for p in superseded])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"⚠️ Callback {event_id} failed (attempt {attempts}): {error}")
+            self._finish(row_id, error, attempts)
+            with self._state_lock:
+                self.last_error = error
+                if attempts >= CALLBACK_MAX_ATTEMPTS:
+                    self.failed += 1
+                else:
+                    self.retried += 1
+            return True
+        self._finish(row_id)
+        with self._state_lock:
+            self.processed += 1
+        return True
+
+    def status(self):
+        with self._state_lock:
+            return {
+                "mode": CALLBACK_WORKER_MODE,
+                "workers": self.workers,
+                "running": sum(1 for t in self._threads if t.is_alive()),
+                "processed": self.processed,
+                "retried": self.retried,
+                "failed": self.failed,
+                "coalesced": self.coalesced,
+                "coalesceSeconds": CALLBACK_COALESCE_S,
+                "lastError": self.last_error,
+            }
+
+
+def _handle(event, superseded):
+    # imported lazily: the handler pulls in the Nokia clients
+    from services.geofence_events import handle_geofence_event
+
+    return handle_geofence_event(event, superseded)
+
+
+callback_workers = CallbackWorkerPool(_handle)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv(".env")
+    print("🚀 Standalone callback queue worker")
+    callback_workers.run_forever()
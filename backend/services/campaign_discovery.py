@@ -0,0 +1,211 @@
+# services/campaign_discovery.py
+"""
+Campaign discovery as plain function calls, shared by the /shops routes,
+the geofence sweep and the callback worker (which used to reach it through
+an HTTP call to this same server).
+
+Every lookup tries PostGIS first and falls back to the haversine engine,
+exactly like the routes always did, and returns CampaignMatch rows;
+spatial_queries.campaign_item() turns one into the API item shape.
+
+  active_campaigns_nearby(lat, lon, radius_m, limit, after=None, engine=None)
+  active_campaigns_nearby_batch([(lat, lon, radius_m)], limit)
+  campaigns_reaching(lat, lon, limit)
+  campaigns_reaching_batch([(lat, lon)], limit)
+
+The functions use db.session, so they need an app context. Code running
+outside a request (sweep, queue workers, standalone processes) wraps calls
+in discovery_context(), which pushes the API app registered with
+init_discovery(), or a minimal app bound to DATABASE_URL when there is none.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+from typing import NamedTuple, Optional
+
+from flask import Flask, current_app, has_app_context
+from sqlalchemy.exc import ProgrammingError, OperationalError
+
+from database import db
+from services.distance_engine import EngineUnavailable, haversine_engine, postgis_enabled, postgis_failed
+from services.spatial_queries import (
+    ACTIVE_CAMPAIGNS_BATCH,
+    CAMPAIGNS_REACHING,
+    CAMPAIGNS_REACHING_BATCH,
+    active_campaigns_statement,
+    nearby_params,
+)
+
+
+class CampaignMatch(NamedTuple):
+    """One active campaign of one shop, with the distance to the query point."""
+    campaign_id: int
+    campaign_title: Optional[str]
+    campaign_offer: Optional[str]
+    campaign_owner_uid: Optional[str]
+    poster_path: Optional[str]
+    radius_km: Optional[float]
+    campaign_start: Optional[datetime]
+    campaign_end: Optional[datetime]
+    shop_id: int
+    shop_owner_uid: Optional[str]
+    shop_name: Optional[str]
+    shop_category: Optional[str]
+    shop_description: Optional[str]
+    address_line: Optional[str]
+    city: Optional[str]
+    lat: Optional[float]
+    lon: Optional[float]
+    avg_spend: Optional[float]
+    image_url: Optional[str]
+    distance_m: Optional[float]
+    knn_m: Optional[float] = None  # PostGIS KNN ordering value, used for the page cursors
+
+    @classmethod
+    def from_row(cls, r):
+        return cls(**{field: getattr(r, field, None) for field in cls._fields})
+
+
+def _fell_back(pe):
+    current_app.logger.warning("PostGIS query failed, falling back to haversine engine: %s", pe)
+    db.session.rollback()
+    postgis_failed(pe)
+
+
+def active_campaigns_nearby(lat, lon, radius_m, limit, after=None, engine=None):
+    """
+    Active campaigns of shops within radius_m, nearest first; `after` is a
+    (distance, id) cursor. `engine` ("postgis" | "haversine") pins the engine
+    that issued the cursor, whose distances `after` is measured in; raises
+    EngineUnavailable when that engine cannot be used.
+    """
+    rows = None
+    if engine == "postgis" and not postgis_enabled():
+        raise EngineUnavailable("postgis")
+    if engine != "haversine" and postgis_enabled():
+        # spatial lookup on active_offers, then the shop/campaign details by id
+        try:
+            rows = active_campaigns_statement(after).fetch(nearby_params(lat, lon, radius_m, limit, after))
+        except (ProgrammingError, OperationalError) as pe:
+            _fell_back(pe)
+            if engine == "postgis":
+                raise EngineUnavailable("postgis") from pe
+    if rows is None:
+        rows = haversine_engine.active_campaigns_nearby(lat, lon, radius_m, limit, after=after)
+    return [CampaignMatch.from_row(r) for r in rows]
+
+
+def active_campaigns_nearby_batch(points, limit):
+    """
+    `points` is a list of (lat, lon, radius_m). Returns one list of matches
+    per point, in input order, from a single statement.
+    """
+    if not points:
+        return []
+    per_point = None
+    if postgis_enabled():
+        try:
+            rows = ACTIVE_CAMPAIGNS_BATCH.fetch({
+                "lats": [pt[0] for pt in points],
+                "lons": [pt[1] for pt in points],
+                "radii": [pt[2] for pt in points],
+                "limit": limit,
+            })
+            per_point = [[] for _ in points]
+            for idx, group in groupby(rows, key=lambda r: r.point_idx):
+                per_point[idx - 1] = list(group)
+        except (ProgrammingError, OperationalError) as pe:
+            _fell_back(pe)
+    if per_point is None:
+        per_point = haversine_engine.active_campaigns_nearby_batch(points, limit)
+    return [[CampaignMatch.from_row(r) for r in point_rows] for point_rows in per_point]
+
+
+def campaigns_reaching(lat, lon, limit):
+    """Active campaigns whose own reach (radius_km around the shop) contains (lat, lon)."""
+    rows = None
+    if postgis_enabled():
+        try:
+            rows = CAMPAIGNS_REACHING.fetch({"lat": lat, "lon": lon, "limit": limit})
+        except (ProgrammingError, OperationalError) as pe:
+            _fell_back(pe)
+    if rows is None:
+        rows = haversine_engine.campaigns_reaching(lat, lon, limit)
+    return [CampaignMatch.from_row(r) for r in rows]
+
+
+def campaigns_reaching_batch(points, limit):
+    """
+    `points` is a list of (lat, lon). Returns campaigns_reaching() for each
+    point, in input order, from a single statement on PostGIS.
+    """
+    if not points:
+        return []
+    per_point = None
+    if postgis_enabled():
+        try:
+            rows = CAMPAIGNS_REACHING_BATCH.fetch({
+                "lats": [pt[0] for pt in points],
+                "lons": [pt[1] for pt in points],
+                "limit": limit,
+            })
+            per_point = [[] for _ in points]
+            for idx, group in groupby(rows, key=lambda r: r.point_idx):
+                per_point[idx - 1] = list(group)
+        except (ProgrammingError, OperationalError) as pe:
+            _fell_back(pe)
+    if per_point is None:
+        per_point = haversine_engine.campaigns_reaching_batch(points, limit)
+    return [[CampaignMatch.from_row(r) for r in point_rows] for point_rows in per_point]
+
+
+def campaign_notification(match):
+    """
+    (title, poster image url) of the push notification for one match. The
+    url is None when the campaign has no poster or ENDPOINT is not set; the
+    notification then goes out without an image.
+    """
+    endpoint = os.getenv("ENDPOINT")
+    if not match.poster_path or not endpoint:
+        return match.campaign_title, None
+    return match.campaign_title, endpoint.rstrip("/") + "/" + match.poster_path.lstrip("/")
+
+
+# -- app context for callers outside a request ---------------------------------
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def init_discovery(app):
+    """Register the API app; background work in the same process uses its database binding."""
+    global _app
+    _app = app
+
+
+def _discovery_app():
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                # standalone worker: a bare app bound to the same database
+                from services.pg import database_dsn
+
+                app = Flask("campaign_discovery")
+                app.config["SQLALCHEMY_DATABASE_URI"] = database_dsn()
+                app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+                db.init_app(app)
+                _app = app
+    return _app
+
+
+@contextmanager
+def discovery_context():
+    """Make the discovery functions usable from any thread; no-op inside a request."""
+    if has_app_context():
+        yield
+        return
+    with _discovery_app().app_context():
+        yield
@@ -0,0 +1,253 @@
+# services/distance_engine.py
+"""
+Distance engines for the nearby endpoints.
+
+PostGIS is the primary engine and lives in the route SQL. When it is not
+available (SQLite dev DB, stock Postgres) the routes hand off to
+`haversine_engine`, which:
+
+  1. pulls candidate rows with a plain lat/lon bounding-box filter
+     (served by the existing lat/lon btree indexes),
+  2. computes exact haversine distances with NumPy over column arrays,
+  3. keeps the nearest `limit` inside the radius, ordered by (distance, id).
+
+Rows come back as objects with the same attribute names as the PostGIS
+queries (plus `distance_m`), so the routes build identical responses.
+
+DISTANCE_ENGINE env:
+  auto      (default) try PostGIS. A capability error (PostGIS function,
+            type or column missing; any error on SQLite) switches to
+            haversine for the rest of the process. Any other failure
+            (connection reset, statement timeout, failover) switches
+            for POSTGIS_RETRY_SECONDS (default 60), then PostGIS is tried
+            again.
+  postgis   always try PostGIS first, fall back per request
+  haversine never touch PostGIS
+"""
+import math
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+from services.spatial_queries import HYDRATE_SHOPS, SHOPS_IN_BOX, OFFERS_IN_BOX, OFFERS_REACH_BOX
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEG_LAT = 111320.0
+
+DISTANCE_ENGINE = os.getenv("DISTANCE_ENGINE", "auto").lower()
+POSTGIS_RETRY_S = float(os.getenv("POSTGIS_RETRY_SECONDS", "60"))
+
+# undefined_function, undefined_object (type "geography"), undefined_column (geog)
+_CAPABILITY_PGCODES = {"42883", "42704", "42703"}
+
+_postgis_ok = DISTANCE_ENGINE != "haversine"
+_postgis_retry_at = 0.0
+
+
+class EngineUnavailable(Exception):
+    """A page cursor was issued by an engine this process cannot use (any more)."""
+
+
+def postgis_enabled():
+    return _postgis_ok and time.monotonic() >= _postgis_retry_at
+
+
+def _is_capability_error(error):
+    """True if `error` says PostGIS is not there, rather than that the database had a bad moment."""
+    orig = getattr(error, "orig", error)
+    if type(orig).__module__.startswith("sqlite3"):
+        return True
+    return getattr(orig, "pgcode", None) in _CAPABILITY_PGCODES
+
+
+def postgis_failed(error=None):
+    """Called by routes when a PostGIS statement errors out."""
+    global _postgis_ok, _postgis_retry_at
+    if DISTANCE_ENGINE != "auto":
+        return
+    if error is None or _is_capability_error(error):
+        _postgis_ok = False
+    else:
+        _postgis_retry_at = time.monotonic() + POSTGIS_RETRY_S
+
+
+def bounding_box(lat, lon, radius_m):
+    """
+    (min_lat, max_lat, min_lon, max_lon) enclosing the search circle. A box
+    that would cross the antimeridian or reach a pole spans every longitude,
+    so a single BETWEEN on lon stays correct there.
+    """
+    dlat = radius_m / METERS_PER_DEG_LAT
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    dlon = min(radius_m / (METERS_PER_DEG_LAT * cos_lat), 180.0)
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180.0 or max_lon > 180.0 or min_lat <= -90.0 or max_lat >= 90.0:
+        min_lon, max_lon = -180.0, 180.0
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def haversine_np(lat, lon, lats, lons):
+    """Vectorized great-circle distance (meters) from (lat, lon) to each point."""
+    p1 = math.radians(lat)
+    p2 = np.radians(lats)
+    dp = p2 - p1
+    dl = np.radians(lons - lon)
+    a = np.sin(dp / 2.0) ** 2 + math.cos(p1) * np.cos(p2) * np.sin(dl / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _as_datetime(value):
+    # SQLite hands DATETIME back as text from raw SQL
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return value
+
+
+def hydrate_shops(ids):
+    """
+    Fetch the nearby-shop columns for `ids` in one round trip, returned in
+    the same order as `ids`.
+    """
+    if not ids:
+        return []
+    rows = HYDRATE_SHOPS.fetch({"ids": list(ids), "now": datetime.utcnow()})
+    order = {sid: i for i, sid in enumerate(ids)}
+    return sorted(rows, key=lambda r: order.get(r.id, len(order)))
+
+
+class HaversineEngine:
+    """Bounding-box prefilter + NumPy haversine, for databases without PostGIS."""
+
+    name = "haversine"
+
+    def _rank(self, ids, lats, lons, lat, lon, radius_m, limit, after=None):
+        """
+        Return [(position, distance_m)] of the nearest `limit` points inside radius.
+        `after` is an optional (distance, id) keyset cursor; only rows after it are kept.
+        """
+        if len(ids) == 0:
+            return []
+        ids = np.asarray(ids, dtype=np.int64)
+        dist = haversine_np(lat, lon, np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        mask = dist <= radius_m
+        if after is not None:
+            after_d, after_id = after
+            mask &= (dist > after_d) | ((dist == after_d) & (ids > after_id))
+        inside = np.flatnonzero(mask)
+        if inside.size == 0:
+            return []
+        if limit is not None and inside.size > limit:
+            # cheap partial selection before the exact (distance, id) sort
+            keep = np.argpartition(dist[inside], limit - 1)[:limit]
+            cutoff = dist[inside][keep].max()
+            inside = inside[dist[inside] <= cutoff]
+        order = inside[np.lexsort((ids[inside], dist[inside]))]
+        if limit is not None:
+            order = order[:limit]
+        return [(int(i), float(dist[i])) for i in order]
+
+    def rank_shops(self, lat, lon, radius_m, limit, after=None):
+        """[(shop id, distance_m)] of the nearest shops inside radius, without hydrating them."""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_m)
+        candidates = SHOPS_IN_BOX.fetch(
+            {"min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon}
+        )
+
+        ids = [r.id for r in candidates]
+        ranked = self._rank(
+            ids,
+            [float(r.lat) for r in candidates],
+            [float(r.lon) for r in candidates],
+            lat, lon, radius_m, limit, after,
+        )
+        return [(ids[i], d) for i, d in ranked]
+
+    def nearby_shops(self, lat, lon, radius_m, limit, after=None):
+        ranked = self.rank_shops(lat, lon, radius_m, limit, after)
+        distances = dict(ranked)
+        rows = hydrate_shops([sid for sid, _ in ranked])
+        return [SimpleNamespace(**dict(r._mapping), distance_m=distances[r.id]) for r in rows]
+
+    def _active_campaign_candidates(self, min_lat, max_lat, min_lon, max_lon):
+        return OFFERS_IN_BOX.fetch({
+            "min_lat": min_lat, "max_lat": max_lat,
+            "min_lon": min_lon, "max_lon": max_lon,
+            "now": datetime.utcnow(),
+        })
+
+    def _campaign_rows(self, candidates, ranked):
+        results = []
+        for i, d in ranked:
+            row = dict(candidates[i]._mapping)
+            row["campaign_start"] = _as_datetime(row["campaign_start"])
+            row["campaign_end"] = _as_datetime(row["campaign_end"])
+            results.append(SimpleNamespace(**row, distance_m=d))
+        return results
+
+    def active_campaigns_nearby(self, lat, lon, radius_m, limit, after=None):
+        candidates = self._active_campaign_candidates(*bounding_box(lat, lon, radius_m))
+        ranked = self._rank(
+            [r.campaign_id for r in candidates],
+            [float(r.lat) for r in candidates],
+            [float(r.lon) for r in candidates],
+            lat, lon, radius_m, limit, after,
+        )
+        return self._campaign_rows(candidates, ranked)
+
+    def active_campaigns_nearby_batch(self, points, limit):
+        """
+        `points` is a list of (lat, lon, radius_m). One candidate query over the
+        union bounding box, then a NumPy pass per point. Returns one row list per point.
+        """
+        if not points:
+            return []
+        boxes = [bounding_box(lat, lon, radius_m) for lat, lon, radius_m in points]
+        candidates = self._active_campaign_candidates(
+            min(b[0] for b in boxes), max(b[1] for b in boxes),
+            min(b[2] for b in boxes), max(b[3] for b in boxes),
+        )
+        ids = [r.campaign_id for r in candidates]
+        lats = [float(r.lat) for r in candidates]
+        lons = [float(r.lon) for r in candidates]
+        return [
+            self._campaign_rows(candidates, self._rank(ids, lats, lons, lat, lon, radius_m, limit))
+            for lat, lon, radius_m in points
+        ]
+
+
+    def campaigns_reaching(self, lat, lon, limit):
+        """
+        Active campaigns whose own reach (radius_km around the shop) contains
+        (lat, lon), nearest shop first. The reach bounding-box columns narrow
+        the candidates; the exact test is haversine distance <= radius_km.
+        """
+        candidates = OFFERS_REACH_BOX.fetch({"lat": lat, "lon": lon, "now": datetime.utcnow()})
+        if not candidates:
+            return []
+        ids = np.asarray([r.campaign_id for r in candidates], dtype=np.int64)
+        dist = haversine_np(
+            lat, lon,
+            np.asarray([float(r.lat) for r in candidates], dtype=np.float64),
+            np.asarray([float(r.lon) for r in candidates], dtype=np.float64),
+        )
+        reach = np.asarray([float(r.radius_km) * 1000.0 for r in candidates], dtype=np.float64)
+        inside = np.flatnonzero(dist <= reach)
+        order = inside[np.lexsort((ids[inside], dist[inside]))][:limit]
+        return self._campaign_rows(candidates, [(int(i), float(dist[i])) for i in order])
+
+    def campaigns_reaching_batch(self, points, limit):
+        """
+        `points` is a list of (lat, lon). One reach-box lookup per point (each
+        is an index probe on the reach box columns). Returns one row list per point.
+        """
+        return [self.campaigns_reaching(lat, lon, limit) for lat, lon in points]
+
+
+haversine_engine = HaversineEngine()
@@ -0,0 +1,93 @@
+# services/geofence_events.py
+"""
+Processing of one Nokia geofencing callback (a CloudEvent), moved out of the
+webhook so it can run on the callback queue workers
+(services/callback_queue.py) instead of inside the HTTP request.
+
+handle_geofence_event() raises on failure; the queue then retries the
+event with backoff. It must stay safe to run twice for the same event:
+delivery is at-least-once. `superseded` are the same device's earlier
+events that the queue coalesced into this one; they are only counted
+against their subscriptions, the location/resubscribe cycle runs once.
+"""
+import json
+
+from app.nokia_client import nokia
+from routes.notify import send_notify
+from services.campaign_discovery import campaigns_reaching, discovery_context
+from services.notification_ledger import notify_campaign
+from services.geofence_sweep import DISCOVERY_LIMIT
+from services.location_history import location_history
+from services.subscription_registry import ensure_subscription, record_event
+
+
+def event_subscription_id(event):
+    return event.get("subscriptionId") or (event.get("data") or {}).get("subscriptionId")
+
+
+def event_phone_number(event):
+    device_info = event.get("device") or (event.get("data") or {}).get("device") or {}
+    return device_info.get("phoneNumber")
+
+
+def handle_geofence_event(event, superseded=()):
+    # 1️⃣ Pretty print the full payload for debugging
+    print("📬 Callback Received:")
+    print(json.dumps(event, indent=2))
+
+    # 2️⃣ Extract useful details
+    event_type = event.get("eventType") or event.get("type") or "unknown"
+    device_number = event_phone_number(event) or "unknown"
+    event_time = event.get("eventTime") or event.get("time") or "unknown"
+    for earlier in superseded:
+        record_event(event_subscription_id(earlier), earlier.get("eventType") or earlier.get("type"))
+    record_event(event_subscription_id(event), event_type)
+
+    # local evaluation (services/local_geofence.py) sends the position along with the event
+    event_location = (event.get("data") or {}).get("location")
+    if not event_location:
+        device_number = "+36719991000"  # commment it once got the credits to work for any number
+
+    print(f"📡 Device {device_number} triggered event: {event_type}"
+          + (f" ({len(superseded)} earlier events coalesced)" if superseded else ""))
+    print(f"   - Time: {event_time}")
+
+    # 3️⃣ Current location
+    location = event_location or nokia.device_location(device_number, 60)
+    if not location or "error" in location:
+        raise RuntimeError(f"location for {device_number}: {location}")
+
+    current_lat = float(location.get("latitude", 0))
+    current_lon = float(location.get("longitude", 0))
+    radius = int(location.get("radius", 2000))
+    last_time = location.get("lastLocationTime", "N/A")
+    print(f"📍 Device {device_number} -> lat: {current_lat}, lon: {current_lon}, radius: {radius}, time: {last_time}")
+
+    # 4️⃣ Store it with the connectivity status (batched with other fixes)
+    status_success, status_result = nokia.connectivity_status(device_number)
+    c_status = status_result.get("connectivityStatus") if status_success else None
+    location_history.record(
+        device_number, current_lat, current_lon, radius, location.get("lastLocationTime"), c_status, "callback"
+    )
+    print(f"✅ Queued latest location of {device_number} for the location history.")
+
+    # 5️⃣ Move the device's geofence to where it is now
+    create_res = ensure_subscription(device_number, current_lat, current_lon, radius, location.get("lastLocationTime"))
+    print(
+        f"🛰️ Geofence {create_res['action']} for {device_number}: {create_res.get('subscription_id')} "
+        f"(radius {create_res.get('radius')} m, speed {create_res.get('speed_mps')} m/s)"
+    )
+
+    # 6️⃣ Campaigns whose reach (radius_km around the shop) covers the device -> push per campaign
+    with discovery_context():
+        matches = campaigns_reaching(current_lat, current_lon, DISCOVERY_LIMIT)
+    notified = 0
+    for match in matches:
+        try:
+            notified += notify_campaign(device_number, match, send_notify)
+        except Exception as notify_e:
+            # not raised: a retry of the event would re-send the ones that went out
+            print(f"⚠️ Error notifying {device_number} about campaign {match.campaign_id}: {notify_e}")
+    print(f"🔔 {notified}/{len(matches)} campaign notifications sent to {device_number} (the rest already sent or capped)")
+
+    return {"device": device_number, "subscription": create_res, "campaigns": len(matches), "notified": notified}
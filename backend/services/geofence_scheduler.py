@@ -0,0 +1,168 @@
+# services/geofence_scheduler.py
+"""
+Periodic background runner for the geofence device sweep.
+
+app.py starts `geofence_scheduler` on a daemon thread next to the API, so
+server startup no longer waits for a full sweep of the devices table.
+Runs are spaced GEOFENCE_SWEEP_INTERVAL seconds apart (measured from the
+end of the previous run) plus a random 0..GEOFENCE_SWEEP_JITTER seconds,
+so several instances do not hit the Nokia APIs in lockstep. A run never
+overlaps another one: a trigger while a sweep is in progress is counted as
+skipped.
+
+Status (last/next run, duration, last summary) is served by
+GET /api/geofence/sweep/status; POST /api/geofence/sweep/run triggers a run.
+
+GEOFENCE_SCHEDULER selects where sweeps run:
+  thread  (default) background thread inside the API process
+  off     the API never sweeps; run the standalone worker instead:
+
+      python -m services.geofence_scheduler
+"""
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+GEOFENCE_SCHEDULER_MODE = os.getenv("GEOFENCE_SCHEDULER", "thread").lower()
+SWEEP_INTERVAL_S = float(os.getenv("GEOFENCE_SWEEP_INTERVAL", "300"))
+SWEEP_JITTER_S = float(os.getenv("GEOFENCE_SWEEP_JITTER", "30"))
+SWEEP_INITIAL_DELAY_S = float(os.getenv("GEOFENCE_SWEEP_INITIAL_DELAY", "10"))
+
+
+def _iso(ts):
+    return datetime.utcfromtimestamp(ts).isoformat() + "Z" if ts else None
+
+
+class GeofenceScheduler:
+    def __init__(self, job, interval_s=SWEEP_INTERVAL_S, jitter_s=SWEEP_JITTER_S, initial_delay_s=SWEEP_INITIAL_DELAY_S):
+        self.job = job
+        self.interval_s = max(1.0, interval_s)
+        self.jitter_s = max(0.0, jitter_s)
+        self.initial_delay_s = max(0.0, initial_delay_s)
+
+        self._run_lock = threading.Lock()    # overlap guard: held for the duration of a sweep
+        self._state_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_duration_ms = None
+        self.last_error = None
+        self.last_summary = None
+        self.next_run = None
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self):
+        """Start the background loop (no-op if it is already running)."""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self.next_run = time.time() + self.initial_delay_s
+        self._thread = threading.Thread(target=self._loop, name="geofence-scheduler", daemon=True)
+        self._thread.start()
+        print(f"🕒 Geofence scheduler started: every {self.interval_s:.0f}s (+0..{self.jitter_s:.0f}s jitter)")
+        return True
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run_forever(self):
+        """Foreground loop for the standalone worker process."""
+        self.next_run = time.time() + self.initial_delay_s
+        self._loop()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            delay = self.next_run - time.time()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            self.run_once()
+            self.next_run = time.time() + self.interval_s + random.uniform(0.0, self.jitter_s)
+
+    # -- runs --------------------------------------------------------------
+
+    def run_once(self):
+        """Run one sweep in the calling thread. Returns False if one is already running."""
+        if not self._run_lock.acquire(blocking=False):
+            with self._state_lock:
+                self.skipped += 1
+            print("⏭️ Geofence sweep already running, skipping this trigger")
+            return False
+        started = time.time()
+        with self._state_lock:
+            self.last_started = started
+        try:
+            summary = self.job()
+            error = None
+        except Exception as e:
+            summary, error = None, str(e)
+            print(f"❌ Geofence sweep failed: {e}")
+        finally:
+            finished = time.time()
+            with self._state_lock:
+                self.runs += 1
+                self.last_finished = finished
+                self.last_duration_ms = round((finished - started) * 1000.0, 1)
+                self.last_error = error
+                if error:
+                    self.failures += 1
+                elif isinstance(summary, dict):
+                    # keep the counters and stage timings, not the per-device results
+                    self.last_summary = {k: v for k, v in summary.items() if k != "results"}
+            self._run_lock.release()
+        return True
+
+    def trigger(self):
+        """Run a sweep now on a separate thread. Returns False if one is already running."""
+        if self._run_lock.locked():
+            with self._state_lock:
+                self.skipped += 1
+            return False
+        threading.Thread(target=self.run_once, name="geofence-sweep-manual", daemon=True).start()
+        return True
+
+    def status(self):
+        with self._state_lock:
+            return {
+                "mode": GEOFENCE_SCHEDULER_MODE,
+                "scheduled": self._thread is not None and self._thread.is_alive(),
+                "running": self._run_lock.locked(),
+                "intervalSeconds": self.interval_s,
+                "jitterSeconds": self.jitter_s,
+                "runs": self.runs,
+                "failures": self.failures,
+                "skipped": self.skipped,
+                "lastStarted": _iso(self.last_started),
+                "lastFinished": _iso(self.last_finished),
+                "lastDurationMs": self.last_duration_ms,
+                "lastError": self.last_error,
+                "lastSummary": self.last_summary,
+                "nextRun": _iso(self.next_run) if self._thread is not None and self._thread.is_alive() else None,
+            }
+
+
+def _sweep_job():
+    # imported lazily: the sweep pulls in the Nokia/FCM clients
+    from services.geofence_sweep import sweep_all_devices
+
+    return sweep_all_devices()
+
+
+geofence_scheduler = GeofenceScheduler(_sweep_job)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv(".env")
+    print("🚀 Standalone geofence worker")
+    geofence_scheduler.run_forever()
@@ -0,0 +1,280 @@
+# services/geofence_sweep.py
+"""
+Concurrent device sweep for app.py:implement_geofence.
+
+Every device goes through the same pipeline:
+
+  locate -> connectivity -> subscribe     (per device, on the worker pool)
+  store                                   (one location history batch for the sweep)
+  discover                                (one in-process batch lookup per chunk of the
+                                           campaigns whose reach covers each device)
+  notify                                  (per campaign hit not yet sent to the device,
+                                           on the worker pool; see services/notification_ledger.py)
+
+The per-device stages run on a bounded ThreadPoolExecutor. Each stage also
+has its own semaphore, so the pool can be wide while e.g. subscription
+creates stay at a handful in flight. Every stage call is timed; run() returns
+a summary with per-device results, per-stage timings and the total sweep
+time.
+
+With SWEEP_NOKIA_IO=async the locate and connectivity calls of the whole
+sweep are made up front in one asyncio fan-out (app/nokia_async_client.py,
+NOKIA_ASYNC_CONCURRENCY in flight) instead of one blocking call per worker
+thread; the workers then only run the subscribe stage.
+
+Settings (env):
+  SWEEP_WORKERS                  worker threads (default 32)
+  SWEEP_NOKIA_IO                 threads (default) | async
+  SWEEP_LOCATE_CONCURRENCY       location calls in flight (default 16)
+  SWEEP_CONNECTIVITY_CONCURRENCY connectivity calls in flight (default 16)
+  SWEEP_SUBSCRIBE_CONCURRENCY    subscription creates in flight (default 8)
+  SWEEP_NOTIFY_CONCURRENCY       FCM sends in flight (default 16)
+  SWEEP_DISCOVERY_CHUNK          points per batch campaign lookup (default 500)
+  SWEEP_DISCOVERY_LIMIT          campaigns per device (default 50)
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.nokia_client import nokia
+from routes.notify import send_notify
+from services.campaign_discovery import campaigns_reaching_batch, discovery_context
+from services.notification_ledger import notify_campaign
+from services.location_history import location_history
+from services.pg import pg_connection
+from services.subscription_registry import ensure_subscription
+
+SWEEP_WORKERS = int(os.getenv("SWEEP_WORKERS", "32"))
+SWEEP_NOKIA_IO = os.getenv("SWEEP_NOKIA_IO", "threads").lower()
+STAGE_LIMITS = {
+    "locate": int(os.getenv("SWEEP_LOCATE_CONCURRENCY", "16")),
+    "connectivity": int(os.getenv("SWEEP_CONNECTIVITY_CONCURRENCY", "16")),
+    "subscribe": int(os.getenv("SWEEP_SUBSCRIBE_CONCURRENCY", "8")),
+    "notify": int(os.getenv("SWEEP_NOTIFY_CONCURRENCY", "16")),
+}
+DISCOVERY_CHUNK = int(os.getenv("SWEEP_DISCOVERY_CHUNK", "500"))
+DISCOVERY_LIMIT = int(os.getenv("SWEEP_DISCOVERY_LIMIT", "50"))
+
+
+class StageTimings:
+    """Thread-safe call/error/latency counters per stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage, elapsed_ms, ok):
+        with self._lock:
+            s = self._stages.setdefault(stage, {"calls": 0, "errors": 0, "totalMs": 0.0, "maxMs": 0.0})
+            s["calls"] += 1
+            s["errors"] += 0 if ok else 1
+            s["totalMs"] += elapsed_ms
+            s["maxMs"] = max(s["maxMs"], elapsed_ms)
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: dict(s, avgMs=round(s["totalMs"] / s["calls"], 1) if s["calls"] else 0.0)
+                for stage, s in self._stages.items()
+            }
+
+
+class SweepEngine:
+    def __init__(self, workers=SWEEP_WORKERS, stage_limits=None, nokia_io=SWEEP_NOKIA_IO):
+        self.workers = max(1, workers)
+        self.nokia_io = nokia_io
+        limits = dict(STAGE_LIMITS, **(stage_limits or {}))
+        self._gates = {stage: threading.BoundedSemaphore(max(1, n)) for stage, n in limits.items()}
+        self.timings = StageTimings()
+
+    def _stage(self, stage, fn, *args, **kwargs):
+        """
+        Run one stage call under its concurrency limit and record its timing
+        (the call itself, not the wait for a free slot).
+        """
+        gate = self._gates.get(stage)
+        if gate is not None:
+            gate.acquire()
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = not (isinstance(result, dict) and "error" in result)
+            return result
+        finally:
+            self.timings.add(stage, (time.perf_counter() - started) * 1000.0, ok)
+            if gate is not None:
+                gate.release()
+
+    # -- per-device pipeline (worker threads) --------------------------------
+
+    def _process_device(self, uid, phone_number, state=None):
+        """`state` is the (location, connectivity) already fetched by _fetch_states(), if any."""
+        result = {"uid": uid, "phone_number": phone_number, "ok": False}
+        started = time.perf_counter()
+        try:
+            if state is None:
+                location = self._stage("locate", nokia.device_location, phone_number, 60)
+            else:
+                location = state[0]
+            if not location or "error" in location:
+                result["error"] = f"location: {location}"
+                return result
+
+            lat = float(location.get("latitude", 0))
+            lon = float(location.get("longitude", 0))
+            radius = int(location.get("radius", 1000))
+            result.update(lat=lat, lon=lon, radius=radius, last_time=location.get("lastLocationTime", "N/A"))
+
+            if state is None:
+                status_success, status_result = self._stage("connectivity", nokia.connectivity_status, phone_number)
+            else:
+                status_success, status_result = state[1]
+            result["c_status"] = status_result.get("connectivityStatus") if status_success else None
+
+            # reuses the device's live subscription when it has barely moved
+            subscription = self._stage(
+                "subscribe", ensure_subscription, phone_number, lat, lon, radius, location.get("lastLocationTime")
+            )
+            result["subscription_id"] = subscription.get("subscription_id")
+            result["subscription"] = subscription["action"]
+            result["fence_radius"] = subscription.get("radius")
+            result["speed_mps"] = subscription.get("speed_mps")
+            result["ok"] = True
+            return result
+        except Exception as e:
+            result["error"] = str(e)
+            return result
+        finally:
+            result["elapsedMs"] = round((time.perf_counter() - started) * 1000.0, 1)
+
+    # -- sweep-wide stages (caller thread) -------------------------------------
+
+    def _fetch_states(self, devices):
+        """SWEEP_NOKIA_IO=async: locate + connectivity of every device in one asyncio fan-out."""
+        from app.nokia_async_client import fetch_device_states, nokia_loop
+
+        states = nokia_loop.run(fetch_device_states, [phone for _, phone in devices], 60)
+        for location, (status_success, _), locate_ms, connectivity_ms in states:
+            if locate_ms is not None:
+                self.timings.add("locate", locate_ms, "error" not in location)
+            if connectivity_ms is not None:
+                self.timings.add("connectivity", connectivity_ms, status_success)
+        return [(location, status) for location, status, _, _ in states]
+
+    def _store(self, located):
+        """Queue the fixes and flush them. Returns the flush error, or None."""
+        location_history.record_many(
+            (r["phone_number"], r["lat"], r["lon"], r["radius"], r["last_time"], r["c_status"], "sweep")
+            for r in located
+        )
+        try:
+            self._stage("store", location_history.flush)
+        except Exception as e:
+            # counted as a failed store call; the rows stay buffered for the next flush,
+            # so discovery and notifications still run for the batch
+            print("❌ Error storing sweep locations (kept for the next flush):", e)
+            return str(e)
+        return None
+
+    def _discover(self, located):
+        """Return [(device result, [CampaignMatch])], one batch lookup per chunk of devices."""
+        hits = []
+        for start in range(0, len(located), DISCOVERY_CHUNK):
+            chunk = located[start:start + DISCOVERY_CHUNK]
+            # same matching as the callback path: the campaign's radius_km reach
+            points = [(r["lat"], r["lon"]) for r in chunk]
+
+            def lookup():
+                with discovery_context():
+                    return campaigns_reaching_batch(points, DISCOVERY_LIMIT)
+
+            try:
+                per_point = self._stage("discover", lookup)
+            except Exception as e:
+                print("❌ Error discovering campaigns:", e)
+                for r in chunk:
+                    r["error"] = f"discover: {e}"
+                continue
+            for r, matches in zip(chunk, per_point):
+                r["campaigns"] = len(matches)
+                hits.append((r, matches))
+        return hits
+
+    def _notify(self, phone_number, match):
+        """True if sent, False if the notification ledger suppressed it (already sent / daily cap)."""
+        return notify_campaign(phone_number, match, send_notify, stage=self._stage)
+
+    # -- entry point -------------------------------------------------------------
+
+    def run(self, devices):
+        """Sweep `devices` ([(uid, phone_number)])."""
+        started = time.perf_counter()
+        states = self._fetch_states(devices) if self.nokia_io == "async" else [None] * len(devices)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sweep") as pool:
+            results = list(pool.map(lambda d, state: self._process_device(*d, state), devices, states))
+            located = [r for r in results if r["ok"]]
+            for r in results:
+                if not r["ok"]:
+                    print(f"⚠️ Error processing {r['phone_number']}: {r.get('error')}")
+
+            store_error = self._store(located)
+            hits = self._discover(located)
+
+            futures = [
+                (r, pool.submit(self._notify, r["phone_number"], match))
+                for r, matches in hits
+                for match in matches
+            ]
+            for r, future in futures:
+                try:
+                    key = "notified" if future.result() else "suppressed"
+                    r[key] = r.get(key, 0) + 1
+                except Exception as notify_e:
+                    print(f"⚠️ Error notifying {r['phone_number']}: {notify_e}")
+
+        return {
+            "devices": len(results),
+            "located": len(located),
+            "failed": len(results) - len(located),
+            "notified": sum(r.get("notified", 0) for r in results),
+            "suppressed": sum(r.get("suppressed", 0) for r in results),
+            "storeError": store_error,
+            "durationMs": round((time.perf_counter() - started) * 1000.0, 1),
+            "workers": self.workers,
+            "stages": self.timings.summary(),
+            "results": results,
+        }
+
+
+def run_sweep(devices, **kwargs):
+    """Run one sweep with a fresh engine (fresh timings) and return its summary."""
+    return SweepEngine(**kwargs).run(devices)
+
+
+def sweep_all_devices():
+    """
+    Load every device from DATABASE_URL and sweep them. Returns the sweep
+    summary. Needs no Flask app, so it also runs from the standalone worker.
+    """
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            # 1️⃣ Fetch all devices
+            cursor.execute("SELECT uid, phone_number FROM devices;")
+            devices = cursor.fetchall()
+    print(f"📱 Found {len(devices)} devices to process...")
+
+    # (Optional) Hardcode phone number for testing
+    devices = [(uid, "+36719991000") for uid, _ in devices]  # comment once your API credits are ready
+
+    # 2️⃣ Locate, subscribe and notify every device on a bounded worker pool
+    summary = run_sweep(devices)
+
+    print(
+        f"⏱️ Sweep finished in {summary['durationMs']} ms: {summary['located']}/{summary['devices']} devices located, "
+        f"{summary['notified']} notifications sent, {summary['suppressed']} suppressed as repeats"
+    )
+    for stage, t in summary["stages"].items():
+        print(f"   - {stage}: {t['calls']} calls, avg {t['avgMs']} ms, max {round(t['maxMs'], 1)} ms, {t['errors']} errors")
+    return summary
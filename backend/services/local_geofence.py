@@ -0,0 +1,184 @@
+# services/local_geofence.py
+"""
+Local geofence evaluation: area-left / area-entered computed on our side
+from incoming positions, instead of one Nokia geofencing subscription per
+device.
+
+With GEOFENCE_EVALUATION=local, services/subscription_registry.py stores a
+local fence (subscription id "local-...") on the device's
+geofence_subscriptions row instead of creating a Nokia subscription, and
+registers it in `local_fences`. Positions posted to POST /device/positions
+are checked against the device's fence with one dict lookup and one
+haversine distance. A transition becomes a CloudEvent shaped like Nokia's
+callbacks and goes onto the callback queue (services/callback_queue.py), so
+coalescing, the resubscribe cycle and notifications are the same as for
+Nokia events. The event carries the position, so the handler does not need
+a location call.
+
+A position only counts as outside when the whole accuracy circle is outside
+the fence (and inside when it is wholly inside), so GPS jitter on the edge
+does not flap.
+
+Fences live in memory per process; a missing or older-than LOCAL_FENCE_TTL
+entry is re-read from geofence_subscriptions, so fences moved by another
+process (standalone sweep or callback worker) are picked up.
+
+Settings (env):
+  GEOFENCE_EVALUATION     nokia (default) | local
+  LOCAL_FENCE_TTL         seconds before a cached fence is re-read (default 60)
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from services.pg import pg_connection
+from services.spatial_index import haversine_m
+
+GEOFENCE_EVALUATION = os.getenv("GEOFENCE_EVALUATION", "nokia").lower()
+LOCAL_FENCE_TTL_S = float(os.getenv("LOCAL_FENCE_TTL", "60"))
+
+LOCAL_SUBSCRIPTION_PREFIX = "local-"
+AREA_LEFT_EVENT = "org.camaraproject.geofencing-subscriptions.v0.area-left"
+AREA_ENTERED_EVENT = "org.camaraproject.geofencing-subscriptions.v0.area-entered"
+
+
+def local_evaluation_enabled():
+    return GEOFENCE_EVALUATION == "local"
+
+
+def new_local_subscription_id():
+    return LOCAL_SUBSCRIPTION_PREFIX + uuid.uuid4().hex
+
+
+def is_local_subscription(subscription_id):
+    return bool(subscription_id) and subscription_id.startswith(LOCAL_SUBSCRIPTION_PREFIX)
+
+
+def _load_fence(phone_number):
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT subscription_id, center_lat, center_lon, radius_m
+                FROM geofence_subscriptions
+                WHERE phone_number = %s;
+                """,
+                (phone_number,),
+            )
+            row = cursor.fetchone()
+    if row is None or not is_local_subscription(row[0]) or row[1] is None or row[3] is None:
+        return None
+    return row
+
+
+class LocalFenceIndex:
+    """phone number -> current fence, with the last known inside/outside state."""
+
+    def __init__(self, loader=_load_fence, ttl_s=LOCAL_FENCE_TTL_S):
+        self._loader = loader
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._fences = {}
+
+        self.evaluated = 0
+        self.emitted = 0
+
+    def set_fence(self, phone_number, subscription_id, lat, lon, radius_m):
+        """A fence is centered on the device's fix, so it starts inside."""
+        with self._lock:
+            self._fences[phone_number] = {
+                "subscription_id": subscription_id,
+                "lat": float(lat),
+                "lon": float(lon),
+                "radius": float(radius_m),
+                "inside": True,
+                "loaded_at": time.monotonic(),
+            }
+
+    def drop(self, phone_number):
+        with self._lock:
+            self._fences.pop(phone_number, None)
+
+    def _fence(self, phone_number):
+        with self._lock:
+            fence = self._fences.get(phone_number)
+        if fence is not None and time.monotonic() - fence["loaded_at"] < self.ttl_s:
+            return fence
+        row = self._loader(phone_number)
+        if row is None:
+            self.drop(phone_number)
+            return None
+        subscription_id, lat, lon, radius_m = row
+        if fence is not None and fence["subscription_id"] == subscription_id:
+            # same fence, keep its inside/outside state
+            with self._lock:
+                fence["loaded_at"] = time.monotonic()
+            return fence
+        self.set_fence(phone_number, subscription_id, lat, lon, radius_m)
+        with self._lock:
+            return self._fences.get(phone_number)
+
+    def evaluate(self, phone_number, lat, lon, accuracy_m=0, at=None):
+        """
+        Check one position against the device's fence. Returns the CloudEvent
+        to queue on a transition, otherwise None (also when the device has no
+        local fence yet).
+        """
+        fence = self._fence(phone_number)
+        if fence is None:
+            return None
+        distance = haversine_m(fence["lat"], fence["lon"], lat, lon)
+        accuracy_m = float(accuracy_m or 0)
+        with self._lock:
+            self.evaluated += 1
+            if fence["inside"] and distance - accuracy_m > fence["radius"]:
+                fence["inside"], event_type = False, AREA_LEFT_EVENT
+            elif not fence["inside"] and distance + accuracy_m < fence["radius"]:
+                fence["inside"], event_type = True, AREA_ENTERED_EVENT
+            else:
+                return None
+            self.emitted += 1
+            fence = dict(fence)
+        return _cloud_event(event_type, phone_number, fence, lat, lon, accuracy_m, at)
+
+    def status(self):
+        with self._lock:
+            return {
+                "mode": GEOFENCE_EVALUATION,
+                "fences": len(self._fences),
+                "evaluated": self.evaluated,
+                "emitted": self.emitted,
+            }
+
+
+def _cloud_event(event_type, phone_number, fence, lat, lon, accuracy_m, at):
+    at = at or datetime.utcnow()
+    time_iso = at.isoformat() + "Z"
+    return {
+        "id": uuid.uuid4().hex,
+        "source": "pinpoint/local-geofence",
+        "type": event_type,
+        "specversion": "1.0",
+        "time": time_iso,
+        "data": {
+            "subscriptionId": fence["subscription_id"],
+            "device": {"phoneNumber": phone_number},
+            "area": {
+                "areaType": "CIRCLE",
+                "center": {"latitude": fence["lat"], "longitude": fence["lon"]},
+                "radius": int(fence["radius"]),
+            },
+            # the position that crossed the fence; the handler uses it instead of a location call
+            "location": {
+                "latitude": lat,
+                "longitude": lon,
+                "radius": int(accuracy_m),
+                "lastLocationTime": time_iso,
+            },
+        },
+    }
+
+
+local_fences = LocalFenceIndex()
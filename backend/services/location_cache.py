@@ -0,0 +1,204 @@
+# services/location_cache.py
+"""
+Per-phone cache of Nokia location retrievals, consulted by
+NokiaClient.device_location (app/nokia_client.py) and its asyncio twin, so
+the sweep, the callback workers and /location/retrieve share results.
+
+Each entry keeps the retrieved area and its lastLocationTime. A request
+with maxAge N is answered from the cache when the entry's location is at
+most N seconds old. The age is counted from lastLocationTime, and never
+from later than the time the entry was fetched. maxAge 0 always goes to
+Nokia; a request without maxAge is held to LOCATION_CACHE_DEFAULT_MAX_AGE.
+
+Misses are single-flight: while one caller retrieves a phone's location,
+concurrent callers for the same phone wait for that call instead of
+making their own. Errors are handed to the waiters but not cached.
+
+The cache is per-process; entries are dropped after LOCATION_CACHE_TTL
+seconds and the cache is LRU-bounded.
+
+Settings (env):
+  LOCATION_CACHE_ENABLED          1 (default) | 0
+  LOCATION_CACHE_TTL              seconds an entry is kept (default 300)
+  LOCATION_CACHE_DEFAULT_MAX_AGE  tolerance for requests without maxAge (default 60)
+  LOCATION_CACHE_MAX_ENTRIES      LRU bound (default 50000)
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+LOCATION_CACHE_ENABLED = os.getenv("LOCATION_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+LOCATION_CACHE_TTL_S = float(os.getenv("LOCATION_CACHE_TTL", "300"))
+LOCATION_CACHE_DEFAULT_MAX_AGE_S = float(os.getenv("LOCATION_CACHE_DEFAULT_MAX_AGE", "60"))
+LOCATION_CACHE_MAX_ENTRIES = int(os.getenv("LOCATION_CACHE_MAX_ENTRIES", "50000"))
+
+
+def _location_epoch(value):
+    """lastLocationTime (ISO 8601) as epoch seconds, or None."""
+    if not value:
+        return None
+    try:
+        when = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+class _Flight:
+    """One retrieval in progress; waiters block on `done`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class LocationCache:
+    def __init__(self, ttl_s=LOCATION_CACHE_TTL_S, default_max_age_s=LOCATION_CACHE_DEFAULT_MAX_AGE_S,
+                 max_entries=LOCATION_CACHE_MAX_ENTRIES, enabled=LOCATION_CACHE_ENABLED):
+        self.ttl_s = ttl_s
+        self.default_max_age_s = default_max_age_s
+        self.max_entries = max(1, max_entries)
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # phone -> (fetched_at, located_at, location)
+        self._flights = {}             # phone -> _Flight (threads)
+        self._async_flights = {}       # (event loop, phone) -> asyncio.Future
+
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    # -- entries -----------------------------------------------------------------
+
+    def _age(self, entry, now):
+        fetched_at, located_at, _ = entry
+        since_fetch = now - fetched_at
+        if located_at is None:
+            return since_fetch
+        return max(since_fetch, now - located_at)
+
+    def lookup(self, phone_number, max_age=None):
+        """The cached location if it satisfies `max_age` (seconds), else None."""
+        tolerance = self.default_max_age_s if max_age is None else float(max_age)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(phone_number)
+            if entry is None:
+                return None
+            if now - entry[0] > self.ttl_s:
+                del self._entries[phone_number]
+                return None
+            if tolerance <= 0 or self._age(entry, now) > tolerance:
+                return None
+            self._entries.move_to_end(phone_number)
+            self.hits += 1
+            return dict(entry[2])
+
+    def store(self, phone_number, location):
+        """Remember a successful retrieval; error results are not cached."""
+        if not isinstance(location, dict) or "error" in location:
+            return
+        with self._lock:
+            self._entries.pop(phone_number, None)
+            self._entries[phone_number] = (time.time(), _location_epoch(location.get("lastLocationTime")), dict(location))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, phone_number):
+        with self._lock:
+            self._entries.pop(phone_number, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # -- single-flight reads ---------------------------------------------------
+
+    def get_or_fetch(self, phone_number, max_age, fetch):
+        """
+        The cached location when it satisfies `max_age`, otherwise `fetch()`'s
+        result, with concurrent misses for one phone sharing one fetch.
+        """
+        if not self.enabled:
+            return fetch()
+        cached = self.lookup(phone_number, max_age)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            flight = self._flights.get(phone_number)
+            leader = flight is None
+            if leader:
+                flight = self._flights[phone_number] = _Flight()
+                self.misses += 1
+            else:
+                self.joined += 1
+
+        if not leader:
+            flight.done.wait()
+            return dict(flight.result) if isinstance(flight.result, dict) else flight.result
+
+        try:
+            flight.result = fetch()
+            self.store(phone_number, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.result = {"error": str(e)}
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(phone_number, None)
+            flight.done.set()
+
+    async def aget_or_fetch(self, phone_number, max_age, fetch):
+        """get_or_fetch() for the asyncio client; `fetch` is an async function."""
+        if not self.enabled:
+            return await fetch()
+        cached = self.lookup(phone_number, max_age)
+        if cached is not None:
+            return cached
+
+        key = (asyncio.get_running_loop(), phone_number)
+        future = self._async_flights.get(key)
+        if future is not None:
+            with self._lock:
+                self.joined += 1
+            result = await asyncio.shield(future)
+            return dict(result) if isinstance(result, dict) else result
+
+        future = self._async_flights[key] = key[0].create_future()
+        with self._lock:
+            self.misses += 1
+        try:
+            result = await fetch()
+            self.store(phone_number, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # waiters get the leader's failure (cancellation included) as an error result
+            future.set_result({"error": str(e) or type(e).__name__})
+            raise
+        finally:
+            self._async_flights.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "joined": self.joined,
+                "inFlight": len(self._flights) + len(self._async_flights),
+                "ttlSeconds": self.ttl_s,
+                "defaultMaxAgeSeconds": self.default_max_age_s,
+            }
+
+
+location_cache = LocationCache()
@@ -0,0 +1,251 @@
+# services/location_history.py
+"""
+Buffered writer for the device location history
+(models/device_location_model.py, table device_locations).
+
+The sweep, the callback worker and POST /device/positions call
+location_history.record(); fixes are kept in memory and written in one
+batch per flush:
+
+  1. COPY of the whole batch into device_locations (partitioned by month;
+     missing month partitions are created on the way),
+  2. one UPDATE devices ... FROM (VALUES ...) with the newest fix per
+     device in the batch, so devices.latitude/longitude stay the "latest"
+     copy of the history (device_latest_locations is the same as a view).
+
+A background thread flushes every LOCATION_FLUSH_SECONDS, or as soon as
+LOCATION_FLUSH_ROWS fixes are waiting; callers that need the rows on disk
+(the sweep) call flush() themselves. A failed flush keeps the rows for the
+next attempt, up to LOCATION_BUFFER_MAX rows, after which the oldest are
+dropped and counted.
+
+Settings (env):
+  LOCATION_FLUSH_ROWS     rows that trigger an early flush (default 500)
+  LOCATION_FLUSH_SECONDS  flush interval (default 2)
+  LOCATION_BUFFER_MAX     rows kept while the database is unreachable (default 100000)
+"""
+import atexit
+import csv
+import io
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+from services.pg import pg_connection
+
+LOCATION_FLUSH_ROWS = int(os.getenv("LOCATION_FLUSH_ROWS", "500"))
+LOCATION_FLUSH_S = float(os.getenv("LOCATION_FLUSH_SECONDS", "2"))
+LOCATION_BUFFER_MAX = int(os.getenv("LOCATION_BUFFER_MAX", "100000"))
+
+_COPY_SQL = """
+COPY device_locations (phone_number, lat, lon, accuracy_m, c_status, source, recorded_at, received_at)
+FROM STDIN WITH (FORMAT csv)
+"""
+
+_LATEST_SQL = """
+UPDATE devices AS d
+SET latitude = v.lat,
+    longitude = v.lon,
+    c_status = COALESCE(v.c_status::connection_status_enum, d.c_status),
+    updated_at = v.recorded_at
+FROM (VALUES %s) AS v(phone_number, lat, lon, c_status, recorded_at)
+WHERE d.phone_number = v.phone_number
+  AND (d.updated_at IS NULL OR d.updated_at <= v.recorded_at);
+"""
+_LATEST_TEMPLATE = "(%s, %s::double precision, %s::double precision, %s, %s::timestamp)"
+
+
+def utc_naive(value):
+    """Naive UTC datetime, the way recorded_at is stored; naive input is taken as UTC already."""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _as_datetime(value, default):
+    """Fix times arrive as datetimes or ISO strings (Nokia lastLocationTime)."""
+    if isinstance(value, str):
+        try:
+            return utc_naive(datetime.fromisoformat(value.replace("Z", "+00:00")))
+        except ValueError:
+            return default
+    return utc_naive(value) or default
+
+
+def _month_bounds(month):
+    year, m = month
+    return datetime(year, m, 1), datetime(year + m // 12, m % 12 + 1, 1)
+
+
+class LocationHistoryWriter:
+    def __init__(self, flush_rows=LOCATION_FLUSH_ROWS, flush_s=LOCATION_FLUSH_S, max_buffer=LOCATION_BUFFER_MAX):
+        self.flush_rows = max(1, flush_rows)
+        self.flush_s = max(0.1, flush_s)
+        self.max_buffer = max(self.flush_rows, max_buffer)
+
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()   # one flush at a time
+        self._partitions = set()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.last_flush_ms = None
+        self.last_error = None
+
+    # -- producers -----------------------------------------------------------
+
+    def record(self, phone_number, lat, lon, accuracy_m=None, recorded_at=None, c_status=None, source=None):
+        self.record_many([(phone_number, lat, lon, accuracy_m, recorded_at, c_status, source)])
+
+    def record_many(self, fixes):
+        """fixes: [(phone_number, lat, lon, accuracy_m, recorded_at, c_status, source)]"""
+        now = datetime.utcnow()
+        rows = [
+            (phone, float(lat), float(lon), accuracy_m, c_status, source, _as_datetime(recorded_at, now), now)
+            for phone, lat, lon, accuracy_m, recorded_at, c_status, source in fixes
+        ]
+        if not rows:
+            return
+        with self._cond:
+            self._buffer.extend(rows)
+            self._trim()
+            if len(self._buffer) >= self.flush_rows:
+                self._cond.notify()
+        self.start()
+
+    def _trim(self):
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+
+    # -- flushing ------------------------------------------------------------
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="location-history", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            with self._cond:
+                if len(self._buffer) < self.flush_rows:
+                    self._cond.wait(self.flush_s)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Location history flush failed: {e}")
+
+    def flush(self):
+        """Write everything buffered so far. Returns the number of rows written."""
+        with self._flush_lock:
+            with self._cond:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            started = time.perf_counter()
+            try:
+                self._write(rows)
+            except Exception as e:
+                with self._cond:
+                    # keep them (oldest first) for the next flush
+                    self._buffer[:0] = rows
+                    self._trim()
+                    self.last_error = str(e)
+                raise
+            with self._cond:
+                self.written += len(rows)
+                self.flushes += 1
+                self.last_flush_ms = round((time.perf_counter() - started) * 1000.0, 1)
+                self.last_error = None
+            return len(rows)
+
+    def _ensure_partitions(self, cursor, rows):
+        """Create the missing month partitions; returns the months created."""
+        months = {(r[6].year, r[6].month) for r in rows} - self._partitions
+        created = set()
+        for month in sorted(months):
+            start, end = _month_bounds(month)
+            cursor.execute("SAVEPOINT device_locations_partition;")
+            try:
+                cursor.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS device_locations_{month[0]}_{month[1]:02d}
+                    PARTITION OF device_locations FOR VALUES FROM (%s) TO (%s);
+                    """,
+                    (start, end),
+                )
+                cursor.execute("RELEASE SAVEPOINT device_locations_partition;")
+                created.add(month)
+            except Exception as e:
+                # e.g. the default partition already holds rows of that month; they stay
+                # there, and the next flush with that month tries again
+                cursor.execute("ROLLBACK TO SAVEPOINT device_locations_partition;")
+                print(f"⚠️ Location partition {month[0]}-{month[1]:02d} not created: {e}")
+        return created
+
+    def _write(self, rows):
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+
+        latest = {}
+        for r in rows:
+            if r[0] not in latest or r[6] >= latest[r[0]][6]:
+                latest[r[0]] = r
+
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                created = self._ensure_partitions(cursor, rows)
+                cursor.copy_expert(_COPY_SQL, data)
+                execute_values(
+                    cursor,
+                    _LATEST_SQL,
+                    [(r[0], r[1], r[2], r[4], r[6]) for r in latest.values()],
+                    template=_LATEST_TEMPLATE,
+                )
+            conn.commit()
+        # only remembered once committed: a failed batch rolls the CREATE TABLE back too
+        self._partitions |= created
+
+    def status(self):
+        with self._cond:
+            return {
+                "buffered": len(self._buffer),
+                "written": self.written,
+                "flushes": self.flushes,
+                "dropped": self.dropped,
+                "lastFlushMs": self.last_flush_ms,
+                "lastError": self.last_error,
+            }
+
+
+location_history = LocationHistoryWriter()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        location_history.flush()
+    except Exception as e:
+        print(f"⚠️ Location history not flushed on exit: {e}")
@@ -0,0 +1,62 @@
+# services/ndjson.py
+"""
+Opt-in NDJSON streaming for the large list endpoints.
+
+A client that sends `Accept: application/x-ndjson` gets one JSON object per
+line instead of a single JSON document. Rows are read from a server-side
+cursor (`stream_results`) in chunks of STREAM_CHUNK_ROWS and written out as
+they arrive, so memory stays flat and the first line is sent before the
+query has finished. The default JSON responses are unchanged.
+"""
+import json
+import os
+
+from flask import Response, request, stream_with_context
+
+from database import db
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Row cap for a streamed response and the server-side cursor fetch size
+STREAM_MAX_ROWS = int(os.getenv("NDJSON_MAX_ROWS", "100000"))
+STREAM_CHUNK_ROWS = int(os.getenv("NDJSON_CHUNK_ROWS", "500"))
+
+
+def wants_ndjson():
+    """True when the client explicitly asked for NDJSON (a bare */* does not count)."""
+    return any(mimetype == NDJSON_MIMETYPE and quality > 0 for mimetype, quality in request.accept_mimetypes)
+
+
+def stream_limit(raw_limit):
+    """Row limit for a streamed response: the requested one, capped, or the cap if absent."""
+    try:
+        limit = int(raw_limit) if raw_limit is not None else STREAM_MAX_ROWS
+    except (TypeError, ValueError):
+        limit = STREAM_MAX_ROWS
+    return max(0, min(limit, STREAM_MAX_ROWS))
+
+
+def stream_execute(statement, params=None):
+    """
+    Execute `statement` on a server-side cursor; rows are fetched
+    STREAM_CHUNK_ROWS at a time while the caller iterates.
+
+    Call it from inside the generator handed to ndjson_response(), not in
+    the view itself: the request's session is removed when the view returns,
+    while stream_with_context re-pushes the app context (and gives the
+    generator a fresh session) for the duration of the stream.
+    """
+    return db.session.execute(
+        statement,
+        params or {},
+        execution_options={"stream_results": True, "yield_per": STREAM_CHUNK_ROWS},
+    )
+
+
+def ndjson_response(items, status=200):
+    """Stream an iterable of JSON-serializable dicts as NDJSON."""
+    def generate():
+        for item in items:
+            yield json.dumps(item, default=str) + "\n"
+
+    return Response(stream_with_context(generate()), status=status, mimetype=NDJSON_MIMETYPE)
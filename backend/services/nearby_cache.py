@@ -0,0 +1,264 @@
+# services/nearby_cache.py
+"""
+Geohash-keyed candidate cache for /shops/nearby and /shops/active_campaigns_nearby.
+
+Entries hold candidate sets, not responses. On a miss the query runs at
+the center of the caller's geohash cell (precision 7 is ~150 m), with the
+radius grown by the cell's half-diagonal and rounded up to a bucket, and
+twice the page size rounded up to a multiple of LIMIT_STEP. Everyone
+standing in the same cell with similar parameters then shares one entry.
+For every response the route recomputes the distances from the caller's
+own point, filters by the caller's radius, re-sorts and cuts to the page.
+An entry that hit its row limit is only complete up to its horizon (the
+farthest candidate's distance from the cell center); the route falls
+through to a direct query when the page would reach past it.
+Only first pages are cached; cursor pages always run directly.
+
+Entries expire after a TTL and the cache is LRU-bounded. Writes invalidate
+precisely: every entry remembers its (center, radius) circle and is filed
+under the coarse geohash cells its bounding box overlaps, so a shop or
+campaign write at a point only drops the entries whose circle contains it.
+
+The cache is per-process; the TTL bounds staleness across workers and for
+campaigns that start or expire on their own.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from services.spatial_index import haversine_m, METERS_PER_DEG_LAT
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+CACHE_ENABLED = os.getenv("NEARBY_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+CACHE_TTL_S = float(os.getenv("NEARBY_CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("NEARBY_CACHE_MAX_ENTRIES", "5000"))
+CACHE_PRECISION = int(os.getenv("NEARBY_CACHE_PRECISION", "7"))
+
+# coarse cells used for invalidation lookups (~4.9 km at precision 5)
+INVALIDATION_PRECISION = 5
+RADIUS_BUCKETS_M = (250, 500, 1000, 2000, 3000, 5000, 7500, 10000)
+LIMIT_STEP = 10
+
+
+def geohash_encode(lat, lon, precision):
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    chars = []
+    bits, ch, even = 0, 0, True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                ch = (ch << 1) | 1
+                lon_lo = mid
+            else:
+                ch <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(chars)
+
+
+def geohash_bbox(code):
+    """(min_lat, max_lat, min_lon, max_lon) of a geohash cell."""
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    even = True
+    for c in code:
+        val = _BASE32.index(c)
+        for shift in range(4, -1, -1):
+            bit = (val >> shift) & 1
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                if bit:
+                    lon_lo = mid
+                else:
+                    lon_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if bit:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+    return lat_lo, lat_hi, lon_lo, lon_hi
+
+
+def geohash_center(code):
+    lat_lo, lat_hi, lon_lo, lon_hi = geohash_bbox(code)
+    return (lat_lo + lat_hi) / 2, (lon_lo + lon_hi) / 2
+
+
+def _cell_size(precision):
+    """(height_deg, width_deg) of a geohash cell at `precision`."""
+    total = 5 * precision
+    return 180.0 / (1 << (total // 2)), 360.0 / (1 << ((total + 1) // 2))
+
+
+def covering_cells(lat, lon, radius_m, precision):
+    """Geohash cells at `precision` overlapping the bounding box of the circle."""
+    dlat = radius_m / METERS_PER_DEG_LAT
+    dlon = min(radius_m / (METERS_PER_DEG_LAT * max(math.cos(math.radians(lat)), 1e-6)), 180.0)
+    h, w = _cell_size(precision)
+    cells = set()
+    y = lat - dlat
+    while True:
+        x = lon - dlon
+        while True:
+            cells.add(geohash_encode(max(-90.0, min(90.0, y)), ((x + 180.0) % 360.0) - 180.0, precision))
+            if x >= lon + dlon:
+                break
+            x = min(x + w, lon + dlon)
+        if y >= lat + dlat:
+            break
+        y = min(y + h, lat + dlat)
+    return cells
+
+
+def cell_slack_m(code):
+    """Farthest a point in the geohash cell can be from its center, in meters."""
+    lat_lo, lat_hi, lon_lo, lon_hi = geohash_bbox(code)
+    c_lat, c_lon = geohash_center(code)
+    return max(haversine_m(c_lat, c_lon, lat, lon) for lat in (lat_lo, lat_hi) for lon in (lon_lo, lon_hi))
+
+
+def bucket_radius(radius_m):
+    for b in RADIUS_BUCKETS_M:
+        if radius_m <= b:
+            return float(b)
+    return float(math.ceil(radius_m / 1000.0) * 1000)
+
+
+def bucket_limit(limit):
+    return max(LIMIT_STEP, int(math.ceil(limit / LIMIT_STEP)) * LIMIT_STEP)
+
+
+class NearbyCache:
+    def __init__(self, ttl_s=CACHE_TTL_S, max_entries=CACHE_MAX_ENTRIES, precision=CACHE_PRECISION, enabled=CACHE_ENABLED):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.precision = precision
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value, lat, lon, radius_m, coarse_cells)
+        self._by_cell = {}              # coarse cell -> set(keys)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def normalize(self, kind, lat, lon, radius_m, limit):
+        """
+        Return (key, lat, lon, radius_m, limit, slack_m) -- the cache key, the
+        normalized parameters the candidate query should run with, and how
+        far the caller can be from the query point.
+        """
+        cell = geohash_encode(lat, lon, self.precision)
+        q_lat, q_lon = geohash_center(cell)
+        slack_m = cell_slack_m(cell)
+        q_radius = bucket_radius(radius_m + slack_m)
+        q_limit = bucket_limit(2 * limit)
+        return (kind, cell, q_radius, q_limit), q_lat, q_lon, q_radius, q_limit, slack_m
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < now:
+                self._drop_locked(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, lat, lon, radius_m):
+        cells = covering_cells(lat, lon, radius_m, INVALIDATION_PRECISION)
+        with self._lock:
+            self._drop_locked(key)
+            self._entries[key] = (time.time() + self.ttl_s, value, lat, lon, radius_m, cells)
+            for cell in cells:
+                self._by_cell.setdefault(cell, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop_locked(next(iter(self._entries)))
+
+    def invalidate_point(self, lat, lon):
+        """Drop every entry whose query circle contains (lat, lon)."""
+        if lat is None or lon is None:
+            return 0
+        lat, lon = float(lat), float(lon)
+        cell = geohash_encode(lat, lon, INVALIDATION_PRECISION)
+        dropped = 0
+        with self._lock:
+            for key in list(self._by_cell.get(cell, ())):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                _, _, e_lat, e_lon, e_radius, _ = entry
+                if haversine_m(e_lat, e_lon, lat, lon) <= e_radius:
+                    self._drop_locked(key)
+                    dropped += 1
+            self.invalidations += dropped
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_cell.clear()
+
+    def _drop_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for cell in entry[5]:
+            keys = self._by_cell.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_cell[cell]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "ttlSeconds": self.ttl_s,
+                "precision": self.precision,
+            }
+
+
+nearby_cache = NearbyCache()
+
+
+def invalidate_owner_shops(owner_uid):
+    """Campaign writes change results for every shop of the owner. Needs an app context."""
+    if not owner_uid or not nearby_cache.enabled:
+        return
+    from models.shop_model import ShopModel
+
+    rows = (
+        ShopModel.query.with_entities(ShopModel.lat, ShopModel.lon)
+        .filter(ShopModel.owner_uid == owner_uid)
+        .all()
+    )
+    for lat, lon in rows:
+        nearby_cache.invalidate_point(lat, lon)
@@ -0,0 +1,238 @@
+# services/notification_ledger.py
+"""
+Dedup ledger for campaign push notifications
+(models/notification_ledger_model.py, table notification_ledger).
+
+Before a campaign notification goes out, notification_ledger.claim() checks
+and records it:
+
+  * cooldown   -- the same (device, campaign) is not notified again within
+                  NOTIFY_COOLDOWN_HOURS,
+  * daily cap  -- a device gets at most NOTIFY_DAILY_CAP campaign
+                  notifications per UTC day (0 = no cap). The cap counts
+                  ledger rows sent today, so with a cooldown under a day a
+                  campaign re-sent the same day counts once.
+
+The decision is made in one transaction under a per-device advisory lock,
+so concurrent sweep workers and callback workers cannot both send the same
+notification. An in-memory front answers the repeat cases (already sent
+within the cooldown, cap already reached today) without a database round
+trip; its entries are evicted after NOTIFY_LEDGER_CACHE_TTL seconds, so
+sends recorded by other processes are seen after at most that long. If the
+send itself fails, release() gives the slot back.
+
+Settings (env):
+  NOTIFY_COOLDOWN_HOURS      per (device, campaign) cooldown (default 24)
+  NOTIFY_DAILY_CAP           notifications per device per day (default 5)
+  NOTIFY_LEDGER_CACHE_TTL    in-memory front TTL in seconds (default 300)
+  NOTIFY_LEDGER_CACHE_MAX    in-memory entries before expired ones are swept (default 100000)
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from services.campaign_discovery import campaign_notification
+from services.pg import pg_connection
+
+NOTIFY_COOLDOWN = timedelta(hours=float(os.getenv("NOTIFY_COOLDOWN_HOURS", "24")))
+NOTIFY_DAILY_CAP = int(os.getenv("NOTIFY_DAILY_CAP", "5"))
+NOTIFY_LEDGER_CACHE_TTL_S = float(os.getenv("NOTIFY_LEDGER_CACHE_TTL", "300"))
+NOTIFY_LEDGER_CACHE_MAX = int(os.getenv("NOTIFY_LEDGER_CACHE_MAX", "100000"))
+
+
+def _day_start(now):
+    return datetime(now.year, now.month, now.day)
+
+
+class NotificationLedger:
+    def __init__(self, cooldown=NOTIFY_COOLDOWN, daily_cap=NOTIFY_DAILY_CAP,
+                 cache_ttl_s=NOTIFY_LEDGER_CACHE_TTL_S, cache_max=NOTIFY_LEDGER_CACHE_MAX):
+        self.cooldown = cooldown
+        self.daily_cap = daily_cap
+        self.cache_ttl_s = cache_ttl_s
+        self.cache_max = max(1, cache_max)
+
+        self._lock = threading.Lock()
+        self._sent = {}    # (phone, campaign_id) -> (last_sent_at, expires)
+        self._capped = {}  # phone -> (day, expires): cap reached on that day
+
+        self.claimed = 0
+        self.suppressed_cooldown = 0
+        self.suppressed_cap = 0
+        self.front_hits = 0
+        self.released = 0
+
+    # -- in-memory front -----------------------------------------------------
+
+    def _get(self, table, key):
+        entry = table.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del table[key]
+            return None
+        return entry[0]
+
+    def _put(self, table, key, value):
+        if len(self._sent) + len(self._capped) >= self.cache_max:
+            self._evict_expired()
+        table[key] = (value, time.monotonic() + self.cache_ttl_s)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for table in (self._sent, self._capped):
+            for key in [k for k, (_, expires) in table.items() if expires <= now]:
+                del table[key]
+
+    def _front_decision(self, phone_number, campaign_id, now):
+        last_sent = self._get(self._sent, (phone_number, campaign_id))
+        if last_sent is not None and now - last_sent < self.cooldown:
+            return "cooldown"
+        if self.daily_cap and self._get(self._capped, phone_number) == _day_start(now):
+            return "cap"
+        return None
+
+    def _count(self, reason, front=False):
+        if reason == "cooldown":
+            self.suppressed_cooldown += 1
+        elif reason == "cap":
+            self.suppressed_cap += 1
+        if front:
+            self.front_hits += 1
+
+    # -- claims ----------------------------------------------------------------
+
+    def claim(self, phone_number, campaign_id):
+        """
+        Reserve the notification of `campaign_id` to `phone_number`. Returns a
+        claim token to pass to release() if the send fails, or None when the
+        notification is suppressed (cooldown or daily cap).
+        """
+        now = datetime.utcnow()
+        with self._lock:
+            reason = self._front_decision(phone_number, campaign_id, now)
+            if reason:
+                self._count(reason, front=True)
+                return None
+
+        day_start = _day_start(now)
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                # serializes claims per device across workers and processes
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (phone_number,))
+                cursor.execute(
+                    """
+                    SELECT last_sent_at FROM notification_ledger
+                    WHERE phone_number = %s AND campaign_id = %s;
+                    """,
+                    (phone_number, campaign_id),
+                )
+                row = cursor.fetchone()
+                previous = row[0] if row else None
+
+                reason = None
+                if previous is not None and now - previous < self.cooldown:
+                    reason = "cooldown"
+                elif self.daily_cap:
+                    cursor.execute(
+                        """
+                        SELECT count(*) FROM notification_ledger
+                        WHERE phone_number = %s AND last_sent_at >= %s;
+                        """,
+                        (phone_number, day_start),
+                    )
+                    if cursor.fetchone()[0] >= self.daily_cap:
+                        reason = "cap"
+
+                if reason is None:
+                    cursor.execute(
+                        """
+                        INSERT INTO notification_ledger (phone_number, campaign_id, last_sent_at, sent_count)
+                        VALUES (%s, %s, %s, 1)
+                        ON CONFLICT (phone_number, campaign_id)
+                        DO UPDATE SET last_sent_at = EXCLUDED.last_sent_at,
+                                      sent_count = notification_ledger.sent_count + 1;
+                        """,
+                        (phone_number, campaign_id, now),
+                    )
+            conn.commit()
+
+        with self._lock:
+            if reason == "cooldown":
+                self._put(self._sent, (phone_number, campaign_id), previous)
+            elif reason == "cap":
+                self._put(self._capped, phone_number, day_start)
+            else:
+                self._put(self._sent, (phone_number, campaign_id), now)
+                self.claimed += 1
+            self._count(reason)
+        return None if reason else (phone_number, campaign_id, previous)
+
+    def release(self, token):
+        """Undo a claim whose notification could not be sent."""
+        phone_number, campaign_id, previous = token
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                if previous is None:
+                    cursor.execute(
+                        "DELETE FROM notification_ledger WHERE phone_number = %s AND campaign_id = %s;",
+                        (phone_number, campaign_id),
+                    )
+                else:
+                    cursor.execute(
+                        """
+                        UPDATE notification_ledger
+                        SET last_sent_at = %s, sent_count = GREATEST(sent_count - 1, 0)
+                        WHERE phone_number = %s AND campaign_id = %s;
+                        """,
+                        (previous, phone_number, campaign_id),
+                    )
+            conn.commit()
+        with self._lock:
+            self._sent.pop((phone_number, campaign_id), None)
+            self._capped.pop(phone_number, None)
+            self.released += 1
+
+    def status(self):
+        with self._lock:
+            return {
+                "cooldownHours": self.cooldown.total_seconds() / 3600.0,
+                "dailyCap": self.daily_cap,
+                "claimed": self.claimed,
+                "suppressedCooldown": self.suppressed_cooldown,
+                "suppressedCap": self.suppressed_cap,
+                "frontHits": self.front_hits,
+                "released": self.released,
+                "cached": len(self._sent) + len(self._capped),
+            }
+
+
+notification_ledger = NotificationLedger()
+
+
+def _call(stage, fn, *args):
+    return fn(*args)
+
+
+def notify_campaign(phone_number, match, send, stage=_call):
+    """
+    Send the notification for one CampaignMatch unless the ledger suppresses
+    it. `stage(name, fn, *args)` wraps the ledger and send calls (the sweep
+    passes its timed stage runner). Returns True if sent, False if
+    suppressed; raises if the send failed (the claim is released first).
+    """
+    # built before the claim: a claim is only taken for a notification that can go out
+    title, poster_path = campaign_notification(match)
+    token = stage("dedup", notification_ledger.claim, phone_number, match.campaign_id)
+    if token is None:
+        return False
+    try:
+        result = stage("notify", send, phone_number, title, poster_path)
+    except Exception:
+        notification_ledger.release(token)
+        raise
+    if isinstance(result, dict) and result.get("success") is False:
+        notification_ledger.release(token)
+        raise RuntimeError(result.get("error", "notification failed"))
+    return True
@@ -0,0 +1,74 @@
+# services/pg.py
+"""
+Shared psycopg2 connection pool for code that runs outside a Flask app
+context (the geofence sweep workers, the standalone scheduler, the
+callback handlers).
+
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            ...
+        conn.commit()
+
+The connection goes back to the pool on exit; anything left uncommitted
+is rolled back. Pool size: PG_POOL_MIN / PG_POOL_MAX.
+
+psycopg2's pool raises PoolError as soon as it is exhausted; checkouts
+here wait for a free connection instead, up to PG_POOL_TIMEOUT seconds
+(or the `timeout` passed to pg_connection()), and only then raise
+PoolError.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "20"))
+PG_POOL_TIMEOUT_S = float(os.getenv("PG_POOL_TIMEOUT", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+# one slot per pool connection: checkouts queue here instead of failing
+_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+
+
+def database_dsn():
+    """DATABASE_URL in the form psycopg2 accepts."""
+    raw_dsn = os.getenv("DATABASE_URL")
+    if raw_dsn.startswith("postgresql+psycopg2://"):
+        raw_dsn = raw_dsn.replace("postgresql+psycopg2://", "postgresql://")
+    return raw_dsn
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, database_dsn())
+    return _pool
+
+
+@contextmanager
+def pg_connection(timeout=None):
+    """A pooled connection; waits up to `timeout` (PG_POOL_TIMEOUT) for one, then raises PoolError."""
+    pool = get_pool()
+    if not _slots.acquire(timeout=PG_POOL_TIMEOUT_S if timeout is None else timeout):
+        raise PoolError("connection pool exhausted")
+    try:
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            broken = bool(conn.closed)
+            try:
+                if not broken:
+                    conn.rollback()
+            except Exception:
+                # e.g. the server dropped the connection: don't hand it out again
+                broken = True
+            finally:
+                pool.putconn(conn, close=broken)
+    finally:
+        _slots.release()
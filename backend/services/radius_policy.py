@@ -0,0 +1,69 @@
+# services/radius_policy.py
+"""
+Geofence radius selection from the device's recent movement.
+
+A device leaves a circle of radius r around its last fix after travelling
+about r, so at speed v it produces roughly v * 3600 / r callbacks an hour.
+choose_radius() picks the smallest radius that keeps that at or below
+GEOFENCE_MAX_CALLBACKS_PER_HOUR: walkers get tight fences, vehicles wide
+ones. The radius is never below the fix accuracy (a fence inside the
+location error only produces noise) and is rounded up to one of
+RADIUS_STEPS, so small speed changes do not force a resubscribe.
+
+Speed is an exponentially smoothed estimate from consecutive fixes
+(estimate_speed()); the previous fix is kept on the device's
+geofence_subscriptions row by services/subscription_registry.py.
+
+Settings (env):
+  GEOFENCE_RADIUS_POLICY           speed (default) | accuracy (fence = fix accuracy, the old behaviour)
+  GEOFENCE_MAX_CALLBACKS_PER_HOUR  target upper bound per device (default 4)
+  GEOFENCE_RADIUS_MIN / _MAX       bounds in meters (default 200 / 20000)
+  GEOFENCE_SPEED_SMOOTHING         weight of the newest speed sample (default 0.5)
+"""
+import os
+
+from services.spatial_index import haversine_m
+
+GEOFENCE_RADIUS_POLICY = os.getenv("GEOFENCE_RADIUS_POLICY", "speed").lower()
+MAX_CALLBACKS_PER_HOUR = max(0.1, float(os.getenv("GEOFENCE_MAX_CALLBACKS_PER_HOUR", "4")))
+RADIUS_MIN_M = int(os.getenv("GEOFENCE_RADIUS_MIN", "200"))
+RADIUS_MAX_M = int(os.getenv("GEOFENCE_RADIUS_MAX", "20000"))
+SPEED_SMOOTHING = min(1.0, max(0.0, float(os.getenv("GEOFENCE_SPEED_SMOOTHING", "0.5"))))
+
+RADIUS_STEPS = (200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 50000)
+
+# fixes closer together than this say little about speed; older than this, the last estimate is stale
+MIN_SAMPLE_S = 30.0
+MAX_SAMPLE_S = 3600.0
+MAX_SPEED_MPS = 70.0  # ~250 km/h; anything faster is a bad fix
+
+
+def estimate_speed(prev_lat, prev_lon, prev_at, lat, lon, at, accuracy_m=0, prev_speed=None):
+    """
+    Smoothed speed (m/s) after a new fix at (lat, lon, at). Movement within
+    the fix accuracy is treated as jitter. Returns prev_speed unchanged when
+    the fixes are too close in time to measure.
+    """
+    if prev_lat is None or prev_lon is None or prev_at is None or at is None:
+        return prev_speed
+    dt = (at - prev_at).total_seconds()
+    if dt < MIN_SAMPLE_S:
+        return prev_speed
+    moved = max(0.0, haversine_m(prev_lat, prev_lon, lat, lon) - (accuracy_m or 0))
+    sample = min(moved / dt, MAX_SPEED_MPS)
+    if prev_speed is None or dt > MAX_SAMPLE_S:
+        return sample
+    return SPEED_SMOOTHING * sample + (1.0 - SPEED_SMOOTHING) * prev_speed
+
+
+def choose_radius(speed_mps, accuracy_m):
+    """Fence radius (m) for a device moving at `speed_mps` with a fix of `accuracy_m`."""
+    accuracy_m = int(accuracy_m or 0)
+    if GEOFENCE_RADIUS_POLICY != "speed":
+        return accuracy_m or RADIUS_MIN_M
+    wanted = max((speed_mps or 0.0) * 3600.0 / MAX_CALLBACKS_PER_HOUR, accuracy_m, RADIUS_MIN_M)
+    wanted = min(wanted, max(RADIUS_MAX_M, accuracy_m))
+    for step in RADIUS_STEPS:
+        if step >= wanted:
+            return min(step, max(RADIUS_MAX_M, accuracy_m))
+    return int(wanted)
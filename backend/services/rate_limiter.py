@@ -0,0 +1,336 @@
+# services/rate_limiter.py
+"""
+Client-side token buckets for the RapidAPI quota, one per Nokia endpoint
+family (location, connectivity, device_status, geofencing, sim_swap,
+verification). Both Nokia clients take a token before every attempt, so
+retries are counted too.
+
+The buckets live in Postgres (models/rate_limit_bucket_model.py, table
+rate_limit_buckets), one row per family: every worker process and
+every box on the same database draws from one budget. A take refills the
+row from the elapsed time and takes a token in one statement under the
+row lock. A take waits at most RATE_LIMIT_STORE_TIMEOUT seconds for a
+pooled connection (services/pg.py); a busy pool is back-pressure, and the
+call waits like it would for a token. If the table cannot be reached,
+the limiter falls back to in-process buckets with the same settings for
+RATE_LIMIT_STORE_RETRY seconds and says so each time it switches;
+status() reports the time spent on the fallback.
+
+Calls have a priority:
+
+  * interactive -- calls made while serving an HTTP request (redemption,
+                   /trigger, /location/retrieve, ...). They may use the
+                   whole bucket.
+  * background  -- everything else (the sweep, the callback workers). They
+                   leave NOKIA_RATE_INTERACTIVE_RESERVE of each bucket's
+                   burst to interactive calls. Within a process they also
+                   wait while an interactive call is waiting for a token.
+
+A call waits for its token up to NOKIA_RATE_WAIT_INTERACTIVE or
+NOKIA_RATE_WAIT_BACKGROUND seconds. If it would have to wait longer it is
+shed: RateLimitedError is raised before anything is sent, and the
+client methods turn it into their usual error result.
+
+Settings (env):
+  NOKIA_RATE_<FAMILY>                tokens per second, 0 = unlimited (location/connectivity 5, others 2)
+  NOKIA_BURST_<FAMILY>               bucket size (default 2x the rate, at least 1)
+  NOKIA_RATE_INTERACTIVE_RESERVE     share of the burst kept for interactive calls (default 0.2)
+  NOKIA_RATE_WAIT_INTERACTIVE        longest wait for a token in seconds (default 2)
+  NOKIA_RATE_WAIT_BACKGROUND         longest wait for a token in seconds (default 30)
+  RATE_LIMIT_STORE                   postgres (default) | local
+  RATE_LIMIT_STORE_RETRY             seconds on local buckets after a store failure (default 30)
+  RATE_LIMIT_STORE_TIMEOUT           longest wait for a pooled connection in seconds (default 1)
+"""
+import asyncio
+import os
+import threading
+import time
+
+from psycopg2.pool import PoolError
+
+from services.pg import pg_connection
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+NOKIA_RATE_LIMITS = {
+    family: (
+        float(os.getenv(f"NOKIA_RATE_{family.upper()}", rate)),
+        os.getenv(f"NOKIA_BURST_{family.upper()}"),
+    )
+    for family, rate in (
+        ("location", "5"),
+        ("connectivity", "5"),
+        ("device_status", "2"),
+        ("geofencing", "2"),
+        ("sim_swap", "2"),
+        ("verification", "2"),
+    )
+}
+NOKIA_RATE_INTERACTIVE_RESERVE = float(os.getenv("NOKIA_RATE_INTERACTIVE_RESERVE", "0.2"))
+NOKIA_RATE_WAIT_S = {
+    INTERACTIVE: float(os.getenv("NOKIA_RATE_WAIT_INTERACTIVE", "2")),
+    BACKGROUND: float(os.getenv("NOKIA_RATE_WAIT_BACKGROUND", "30")),
+}
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "postgres").lower()
+RATE_LIMIT_STORE_RETRY_S = float(os.getenv("RATE_LIMIT_STORE_RETRY", "30"))
+RATE_LIMIT_STORE_TIMEOUT_S = float(os.getenv("RATE_LIMIT_STORE_TIMEOUT", "1"))
+
+# re-check interval of a background call deferring to a waiting interactive one
+_YIELD_S = 0.05
+
+_INIT_SQL = """
+INSERT INTO rate_limit_buckets (name, tokens, updated_at)
+VALUES (%s, %s, clock_timestamp() AT TIME ZONE 'UTC')
+ON CONFLICT (name) DO NOTHING;
+"""
+
+# refill from the elapsed time, then take `cost` if at least `floor` is left afterwards
+_TAKE_SQL = """
+WITH b AS (
+    SELECT name,
+           LEAST(%(burst)s::float8,
+                 tokens + GREATEST(EXTRACT(EPOCH FROM (clock_timestamp() AT TIME ZONE 'UTC') - updated_at)::float8, 0)
+                          * %(rate)s::float8) AS refilled
+    FROM rate_limit_buckets
+    WHERE name = %(name)s
+    FOR UPDATE
+)
+UPDATE rate_limit_buckets AS r
+SET tokens = CASE WHEN b.refilled - %(cost)s >= %(floor)s THEN b.refilled - %(cost)s ELSE b.refilled END,
+    updated_at = clock_timestamp() AT TIME ZONE 'UTC'
+FROM b
+WHERE r.name = b.name
+RETURNING b.refilled - %(cost)s >= %(floor)s, b.refilled;
+"""
+
+
+class RateLimitedError(Exception):
+    """No token within the caller's wait limit; the call was shed unsent."""
+
+    def __init__(self, bucket, priority, wait_s):
+        super().__init__(f"{bucket} rate limit: {priority} call shed (next token in {wait_s:.1f}s)")
+        self.bucket = bucket
+        self.priority = priority
+        self.wait_s = wait_s
+
+
+def current_priority():
+    """Interactive while serving an HTTP request, background otherwise."""
+    try:
+        from flask import has_request_context
+    except ImportError:
+        return BACKGROUND
+    return INTERACTIVE if has_request_context() else BACKGROUND
+
+
+class _Bucket:
+    def __init__(self, name, rate, burst, reserve):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, float(burst) if burst else rate * 2)
+        self.reserve = self.burst * reserve
+
+    def floor(self, priority):
+        return 0.0 if priority == INTERACTIVE else self.reserve
+
+    def wait_for(self, available, cost, floor):
+        return max(0.0, (floor + cost - available) / self.rate)
+
+
+class LocalBucketStore:
+    """In-process buckets: the fallback, and RATE_LIMIT_STORE=local."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}  # name -> (tokens, updated monotonic)
+
+    def take(self, bucket, cost, floor):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._state.get(bucket.name, (bucket.burst, now))
+            refilled = min(bucket.burst, tokens + (now - updated) * bucket.rate)
+            granted = refilled - cost >= floor
+            self._state[bucket.name] = (refilled - cost if granted else refilled, now)
+        return granted, refilled
+
+
+class PostgresBucketStore:
+    """One rate_limit_buckets row per bucket, shared by every process."""
+
+    def __init__(self):
+        self._created = set()
+
+    def take(self, bucket, cost, floor):
+        with pg_connection(timeout=RATE_LIMIT_STORE_TIMEOUT_S) as conn:
+            with conn.cursor() as cursor:
+                if bucket.name not in self._created:
+                    cursor.execute(_INIT_SQL, (bucket.name, bucket.burst))
+                cursor.execute(_TAKE_SQL, {
+                    "name": bucket.name, "rate": bucket.rate, "burst": bucket.burst,
+                    "cost": cost, "floor": floor,
+                })
+                granted, refilled = cursor.fetchone()
+            conn.commit()
+        self._created.add(bucket.name)
+        return granted, refilled
+
+
+class RateLimiter:
+    def __init__(self, upstream, limits, reserve=NOKIA_RATE_INTERACTIVE_RESERVE, max_wait_s=None,
+                 store=None):
+        self.upstream = upstream
+        self.buckets = {
+            family: _Bucket(f"{upstream}:{family}", rate, burst, reserve)
+            for family, (rate, burst) in limits.items()
+            if rate > 0
+        }
+        self.max_wait_s = dict(NOKIA_RATE_WAIT_S, **(max_wait_s or {}))
+        if store is None:
+            store = LocalBucketStore() if RATE_LIMIT_STORE == "local" else PostgresBucketStore()
+        self.store = store
+        self._local = store if isinstance(store, LocalBucketStore) else LocalBucketStore()
+        self._store_down_until = 0.0
+        self._fallback_since = None  # start of the current stretch on local buckets
+        self._fallback_s = 0.0       # finished stretches
+
+        self._lock = threading.Lock()
+        self._interactive_waiting = 0
+        self.granted = 0
+        self.waited_ms = 0.0
+        self.shed = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.store_failures = 0
+        self.store_busy = 0
+        self.fallbacks = 0
+
+    # -- one attempt -------------------------------------------------------------
+
+    def _take(self, bucket, priority):
+        """(granted, seconds until a token would be available)"""
+        floor = bucket.floor(priority)
+        store = self.store
+        if store is not self._local and time.monotonic() < self._store_down_until:
+            store = self._local
+        try:
+            granted, available = store.take(bucket, 1.0, floor)
+        except PoolError:
+            # every pooled connection is busy: back-pressure, not an outage
+            with self._lock:
+                self.store_busy += 1
+            return False, _YIELD_S
+        except Exception as e:
+            now = time.monotonic()
+            with self._lock:
+                self.store_failures += 1
+                switched = self._fallback_since is None
+                if switched:
+                    self._fallback_since = now
+                    self.fallbacks += 1
+                self._store_down_until = now + RATE_LIMIT_STORE_RETRY_S
+            if switched:
+                print(f"⚠️ Shared rate limit store unavailable, using per-process buckets "
+                      f"for {RATE_LIMIT_STORE_RETRY_S:.0f}s: {e}")
+            granted, available = self._local.take(bucket, 1.0, floor)
+        else:
+            if store is not self._local and self._fallback_since is not None:
+                self._store_recovered()
+        return granted, (0.0 if granted else bucket.wait_for(available, 1.0, floor))
+
+    def _store_recovered(self):
+        with self._lock:
+            if self._fallback_since is not None:
+                self._fallback_s += max(0.0, self._store_down_until - self._fallback_since)
+                self._fallback_since = None
+        print("✅ Shared rate limit store reachable again")
+
+    def _fallback_seconds(self):
+        """Time spent on local buckets so far; call with the lock held."""
+        total = self._fallback_s
+        if self._fallback_since is not None:
+            total += max(0.0, min(time.monotonic(), self._store_down_until) - self._fallback_since)
+        return total
+
+    def _step(self, bucket, priority):
+        """Like _take(), but background calls defer while an interactive one waits here."""
+        if priority == BACKGROUND and self._interactive_waiting:
+            return False, _YIELD_S
+        return self._take(bucket, priority)
+
+    def _waiting(self, priority, delta):
+        if priority == INTERACTIVE:
+            with self._lock:
+                self._interactive_waiting += delta
+
+    def _done(self, started, priority, granted, wait_s=0.0):
+        with self._lock:
+            if granted:
+                self.granted += 1
+                self.waited_ms += (time.monotonic() - started) * 1000.0
+            else:
+                self.shed[priority] += 1
+        if not granted:
+            raise RateLimitedError(self.upstream, priority, wait_s)
+
+    # -- acquiring ---------------------------------------------------------------
+
+    def acquire(self, family, priority=None):
+        """Block until `family` has a token for this call, or raise RateLimitedError."""
+        bucket = self.buckets.get(family)
+        if bucket is None:
+            return
+        priority = priority or current_priority()
+        started = time.monotonic()
+        deadline = started + self.max_wait_s[priority]
+        self._waiting(priority, 1)
+        try:
+            while True:
+                granted, wait_s = self._step(bucket, priority)
+                if granted:
+                    return self._done(started, priority, True)
+                if time.monotonic() + wait_s > deadline:
+                    return self._done(started, priority, False, wait_s)
+                time.sleep(wait_s)
+        finally:
+            self._waiting(priority, -1)
+
+    async def aacquire(self, family, priority=BACKGROUND):
+        """acquire() for coroutines; the store round trip runs off the event loop."""
+        bucket = self.buckets.get(family)
+        if bucket is None:
+            return
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + self.max_wait_s[priority]
+        self._waiting(priority, 1)
+        try:
+            while True:
+                granted, wait_s = await loop.run_in_executor(None, self._step, bucket, priority)
+                if granted:
+                    return self._done(started, priority, True)
+                if time.monotonic() + wait_s > deadline:
+                    return self._done(started, priority, False, wait_s)
+                await asyncio.sleep(wait_s)
+        finally:
+            self._waiting(priority, -1)
+
+    def status(self):
+        with self._lock:
+            return {
+                "store": "local" if self.store is self._local else "postgres",
+                "onFallback": self.store is not self._local and time.monotonic() < self._store_down_until,
+                "fallbacks": self.fallbacks,
+                "fallbackSeconds": round(self._fallback_seconds(), 1),
+                "storeFailures": self.store_failures,
+                "storeBusy": self.store_busy,
+                "granted": self.granted,
+                "avgWaitMs": round(self.waited_ms / self.granted, 1) if self.granted else 0.0,
+                "shed": dict(self.shed),
+                "interactiveWaiting": self._interactive_waiting,
+                "buckets": {
+                    family: {"rate": b.rate, "burst": b.burst, "interactiveReserve": b.reserve}
+                    for family, b in self.buckets.items()
+                },
+            }
+
+
+nokia_rate_limiter = RateLimiter("nokia", NOKIA_RATE_LIMITS)
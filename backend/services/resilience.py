@@ -0,0 +1,352 @@
+# services/resilience.py
+"""
+Retries, backoff and circuit breaking for calls to upstream HTTP APIs
+(Nokia Network-as-Code in app/nokia_client.py and app/nokia_async_client.py,
+FCM in routes/notify.py).
+
+Every upstream has one Resilience object. Its call() (acall() for
+coroutines) wraps a single HTTP request:
+
+  * classified retries -- failures to connect, 429 and 503 are retried for
+                          every call, since the request was not processed.
+                          Other connection errors, read timeouts, 500, 502
+                          and 504 are retried only for idempotent calls: a
+                          subscription create may already have happened.
+  * backoff            -- full-jitter exponential backoff between attempts,
+                          never shorter than the response's Retry-After. A
+                          Retry-After above RETRY_MAX_DELAY is not waited
+                          out; the response goes back to the caller.
+  * retry budget       -- per upstream, retries in the last
+                          RETRY_BUDGET_WINDOW seconds may not exceed
+                          RETRY_BUDGET_RATIO of the first attempts
+                          (RETRY_BUDGET_MIN are always allowed), so a
+                          brownout is not multiplied by the retries.
+  * circuit breaker    -- per endpoint group. BREAKER_FAILURES consecutive
+                          failed calls open it. While open, calls raise
+                          CircuitOpenError at once instead of waiting on
+                          timeouts. After BREAKER_RESET_SECONDS one probe call
+                          is let through; its outcome closes or re-opens
+                          the breaker.
+
+A `pace` callable (services/rate_limiter.py) can be passed to call() and
+acall(); it runs before every attempt, retries included, and an exception
+it raises ends the call unsent without counting against the breaker.
+
+resilience_status() reports every upstream's breakers and counters
+(GET /api/geofence/sweep/upstreams).
+
+Settings (env):
+  RETRY_MAX_ATTEMPTS      attempts per call, first one included (default 3)
+  RETRY_BASE_DELAY        backoff base in seconds (default 0.2)
+  RETRY_MAX_DELAY         longest wait between attempts in seconds (default 5)
+  RETRY_BUDGET_RATIO      retries allowed per first attempt (default 0.2)
+  RETRY_BUDGET_MIN        retries always allowed per window (default 5)
+  RETRY_BUDGET_WINDOW     budget window in seconds (default 10)
+  BREAKER_FAILURES        consecutive failures that open a breaker (default 5)
+  BREAKER_RESET_SECONDS   seconds a breaker stays open before a probe (default 30)
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY", "5"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "5"))
+RETRY_BUDGET_WINDOW_S = float(os.getenv("RETRY_BUDGET_WINDOW", "10"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+# not processed upstream: safe to repeat for any call
+ALWAYS_RETRY_STATUS = {429, 503}
+# possibly processed: repeated only for idempotent calls
+IDEMPOTENT_RETRY_STATUS = {500, 502, 504}
+
+
+class CircuitOpenError(Exception):
+    """The endpoint's breaker is open; the call was not attempted."""
+
+    def __init__(self, upstream, endpoint, retry_in_s):
+        super().__init__(f"{upstream} {endpoint} unavailable (circuit open, retry in {retry_in_s:.0f}s)")
+        self.upstream = upstream
+        self.endpoint = endpoint
+        self.retry_in_s = retry_in_s
+
+
+def retry_after_seconds(value):
+    """Retry-After header value (delta seconds or HTTP date) in seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, reset_s=BREAKER_RESET_S):
+        self.failures = max(1, failures)
+        self.reset_s = reset_s
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at < self.reset_s:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        """0 if a call may go out now, else the seconds until the next probe."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            waited = time.monotonic() - self._opened_at
+            if waited >= self.reset_s and not self._probing:
+                self._probing = True  # this call is the probe
+                return 0
+            self.rejected += 1
+            return max(0.0, self.reset_s - waited)
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self._consecutive = 0
+                self._opened_at = None
+            else:
+                self._consecutive += 1
+                if self._probing or self._consecutive >= self.failures:
+                    if self._opened_at is None or self._probing:
+                        self.opened += 1
+                    self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def status(self):
+        with self._lock:
+            return {"state": self.state, "consecutiveFailures": self._consecutive,
+                    "opened": self.opened, "rejected": self.rejected}
+
+
+class RetryBudget:
+    """Retries allowed per upstream: a share of the recent first attempts."""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN, window_s=RETRY_BUDGET_WINDOW_S):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._requests = deque()
+        self._retries = deque()
+
+    def _trim(self, now):
+        for q in (self._requests, self._retries):
+            while q and now - q[0] > self.window_s:
+                q.popleft()
+
+    def request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_retry(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._retries) >= max(self.minimum, self.ratio * len(self._requests)):
+                return False
+            self._retries.append(now)
+            return True
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Resilience:
+    def __init__(self, upstream, attempts=RETRY_MAX_ATTEMPTS, base_delay_s=RETRY_BASE_DELAY_S,
+                 max_delay_s=RETRY_MAX_DELAY_S, budget=None, breaker_failures=BREAKER_FAILURES,
+                 breaker_reset_s=BREAKER_RESET_S):
+        self.upstream = upstream
+        self.attempts = max(1, attempts)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.budget = budget or RetryBudget()
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_s = breaker_reset_s
+
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self.calls = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        with _registry_lock:
+            _registry[upstream] = self
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self.breaker_failures, self.breaker_reset_s)
+            return self._breakers[endpoint]
+
+    # -- classification --------------------------------------------------------
+
+    def _outcome(self, response, error, idempotent):
+        """(ok for the breaker, retryable, Retry-After seconds)"""
+        if error is not None:
+            kind = _transport_error_kind(error)
+            if kind == "connect":
+                return False, True, None
+            if kind == "transport":
+                return False, idempotent, None
+            return True, False, None  # a bug on our side, not the upstream's health
+        status = getattr(response, "status_code", None) or getattr(response, "status", None)
+        retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+        if status in ALWAYS_RETRY_STATUS:
+            return False, True, retry_after
+        if status in IDEMPOTENT_RETRY_STATUS:
+            return False, idempotent, retry_after
+        return True, False, None
+
+    def _next_delay(self, attempt, retry_after):
+        """Seconds to wait before `attempt` (1-based retry), or None to stop retrying."""
+        if attempt >= self.attempts:
+            return None
+        if retry_after is not None and retry_after > self.max_delay_s:
+            return None
+        if not self.budget.try_retry():
+            with self._lock:
+                self.budget_exhausted += 1
+            return None
+        delay = random.uniform(0, min(self.max_delay_s, self.base_delay_s * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def _admit(self, endpoint):
+        breaker = self.breaker(endpoint)
+        wait_s = breaker.allow()
+        if wait_s:
+            raise CircuitOpenError(self.upstream, endpoint, wait_s)
+        with self._lock:
+            self.calls += 1
+        self.budget.request()
+        return breaker
+
+    # -- calls -------------------------------------------------------------------
+
+    def call(self, endpoint, send, idempotent=True, pace=None):
+        """
+        Run `send()` (one HTTP request returning a response) with retries.
+        Returns the last response; raises CircuitOpenError without calling
+        while the endpoint's breaker is open, or the last exception.
+        `pace()` runs before every attempt.
+        """
+        breaker = self._admit(endpoint)
+        attempt = 0
+        while True:
+            attempt += 1
+            if pace is not None:
+                try:
+                    pace()
+                except BaseException:
+                    breaker.release_probe()
+                    raise
+            response = error = None
+            try:
+                response = send()
+            except Exception as e:
+                error = e
+            ok, retryable, retry_after = self._outcome(response, error, idempotent)
+            delay = self._next_delay(attempt, retry_after) if retryable else None
+            if delay is None:
+                breaker.record(ok)
+                if error is not None:
+                    raise error
+                return response
+            time.sleep(delay)
+
+    async def acall(self, endpoint, send, idempotent=True, pace=None):
+        """call() for coroutines: `send` and `pace` are async functions."""
+        breaker = self._admit(endpoint)
+        attempt = 0
+        while True:
+            attempt += 1
+            if pace is not None:
+                try:
+                    await pace()
+                except BaseException:
+                    breaker.release_probe()
+                    raise
+            response = error = None
+            try:
+                response = await send()
+            except asyncio.CancelledError:
+                breaker.release_probe()  # cancelled by us: says nothing about the upstream
+                raise
+            except Exception as e:
+                error = e
+            ok, retryable, retry_after = self._outcome(response, error, idempotent)
+            delay = self._next_delay(attempt, retry_after) if retryable else None
+            if delay is None:
+                breaker.record(ok)
+                if error is not None:
+                    raise error
+                return response
+            await asyncio.sleep(delay)
+
+    def status(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+            counters = {"calls": self.calls, "retries": self.retries, "budgetExhausted": self.budget_exhausted}
+        return dict(counters, breakers={endpoint: b.status() for endpoint, b in breakers.items()})
+
+
+def _transport_error_kind(error):
+    """"connect" (request never sent), "transport" (may have reached the upstream) or None."""
+    if isinstance(error, requests.ConnectTimeout):
+        return "connect"
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, asyncio.TimeoutError)):
+        return "transport"
+    try:
+        import aiohttp
+    except ImportError:
+        return None
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return "connect"
+    if isinstance(error, aiohttp.ClientError):
+        return "transport"
+    return None
+
+
+def resilience_status():
+    with _registry_lock:
+        upstreams = dict(_registry)
+    return {name: r.status() for name, r in upstreams.items()}
@@ -0,0 +1,207 @@
+# services/spatial_index.py
+"""
+In-process grid index over (shop id, lat, lon) for nearby lookups.
+
+Points live in flat `array` columns; each grid cell keeps the slot numbers
+of the points that fall inside it. A nearby query only scans the cells that
+overlap the search circle's bounding box, computes exact haversine
+distances for those candidates and returns the K nearest ids, so the route
+only needs one `IN (...)` round trip to hydrate the rows.
+
+The index is per-process: it is loaded at startup, updated when shops are
+created through the API, and can be rebuilt on demand (POST /shops/index/rebuild).
+Moved or removed points leave a tombstoned slot behind; once tombstones
+make up `compact_ratio` of the slots (and at least `compact_min` of them)
+the arrays are compacted in place.
+"""
+import heapq
+import math
+import threading
+import time
+from array import array
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEG_LAT = 111320.0
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two lat/lon points."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+class GridSpatialIndex:
+    """
+    Uniform lat/lon grid. `cell_deg` of 0.01 is roughly 1.1 km at the equator,
+    which keeps a 10 km query to a few hundred cells at most.
+    """
+
+    def __init__(self, cell_deg=0.01, compact_ratio=0.25, compact_min=1024):
+        self.cell_deg = float(cell_deg)
+        self.compact_ratio = float(compact_ratio)
+        self.compact_min = int(compact_min)
+        self._lock = threading.RLock()
+        self._reset()
+        self.loaded = False
+        self.built_at = None
+
+    def _reset(self):
+        self._ids = array("q")
+        self._lats = array("d")
+        self._lons = array("d")
+        self._alive = array("b")
+        self._slot_by_id = {}
+        self._cells = {}
+        self._dead = 0
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg)))
+
+    def __len__(self):
+        return len(self._slot_by_id)
+
+    def _build(self, points):
+        """Fresh arrays for `points` ({id: (lat, lon)}), without tombstones."""
+        ids, lats, lons, alive = array("q"), array("d"), array("d"), array("b")
+        slot_by_id, cells = {}, {}
+        for sid, (lat, lon) in points.items():
+            slot = len(ids)
+            ids.append(int(sid))
+            lats.append(lat)
+            lons.append(lon)
+            alive.append(1)
+            slot_by_id[sid] = slot
+            cells.setdefault(self._cell(lat, lon), array("l")).append(slot)
+        return ids, lats, lons, alive, slot_by_id, cells
+
+    def rebuild(self, rows):
+        """Replace the index contents with `rows` (iterable of (id, lat, lon))."""
+        points = {}
+        for sid, lat, lon in rows:
+            if sid is None or lat is None or lon is None:
+                continue
+            # duplicate id in the feed: last one wins
+            points[sid] = (float(lat), float(lon))
+        built = self._build(points)
+
+        with self._lock:
+            self._ids, self._lats, self._lons, self._alive, self._slot_by_id, self._cells = built
+            self._dead = 0
+            self.loaded = True
+            self.built_at = time.time()
+        return len(points)
+
+    def compact(self):
+        """Drop tombstoned slots. Returns the number of slots reclaimed."""
+        with self._lock:
+            return self._compact_locked()
+
+    def _compact_locked(self):
+        dead = self._dead
+        if dead:
+            points = {sid: (self._lats[slot], self._lons[slot]) for sid, slot in self._slot_by_id.items()}
+            self._ids, self._lats, self._lons, self._alive, self._slot_by_id, self._cells = self._build(points)
+            self._dead = 0
+        return dead
+
+    def _maybe_compact_locked(self):
+        if self._dead >= self.compact_min and self._dead >= self.compact_ratio * len(self._ids):
+            self._compact_locked()
+
+    @property
+    def tombstones(self):
+        return self._dead
+
+    def upsert(self, sid, lat, lon):
+        """Add or move a single point. The old slot is tombstoned (see compact())."""
+        if sid is None:
+            return
+        with self._lock:
+            self._remove_locked(sid)
+            if lat is None or lon is None:
+                return
+            lat, lon = float(lat), float(lon)
+            slot = len(self._ids)
+            self._ids.append(int(sid))
+            self._lats.append(lat)
+            self._lons.append(lon)
+            self._alive.append(1)
+            self._slot_by_id[sid] = slot
+            self._cells.setdefault(self._cell(lat, lon), array("l")).append(slot)
+            self._maybe_compact_locked()
+
+    def remove(self, sid):
+        with self._lock:
+            self._remove_locked(sid)
+            self._maybe_compact_locked()
+
+    def _remove_locked(self, sid):
+        slot = self._slot_by_id.pop(sid, None)
+        if slot is not None:
+            self._alive[slot] = 0
+            self._dead += 1
+
+    def nearby(self, lat, lon, radius_m, limit=50, after=None):
+        """
+        Return [(id, distance_m), ...] for points within radius_m of (lat, lon),
+        nearest first, at most `limit` entries. `after` is an optional
+        (distance, id) keyset cursor: only points ordered after it are returned.
+        """
+        lat, lon, radius_m = float(lat), float(lon), float(radius_m)
+        dlat = radius_m / METERS_PER_DEG_LAT
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(radius_m / (METERS_PER_DEG_LAT * cos_lat), 180.0)
+
+        i0, j0 = self._cell(lat - dlat, lon - dlon)
+        i1, j1 = self._cell(lat + dlat, lon + dlon)
+
+        # columns past +-180 degrees wrap around the antimeridian
+        cols = int(round(360.0 / self.cell_deg))
+        half = cols // 2
+        if j1 - j0 + 1 >= cols:
+            j0, j1 = -half, cols - half - 1
+
+        hits = []
+        with self._lock:
+            cells, alive = self._cells, self._alive
+            ids, lats, lons = self._ids, self._lats, self._lons
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    slots = cells.get((i, ((j + half) % cols) - half))
+                    if not slots:
+                        continue
+                    for slot in slots:
+                        if not alive[slot]:
+                            continue
+                        d = haversine_m(lat, lon, lats[slot], lons[slot])
+                        if d <= radius_m and (after is None or (d, ids[slot]) > after):
+                            hits.append((d, ids[slot]))
+
+        return [(sid, d) for d, sid in heapq.nsmallest(limit, hits)]
+
+
+# Shared index for models.shop_model.ShopModel (the /shops blueprint).
+shop_index = GridSpatialIndex()
+
+
+def load_shop_index():
+    """(Re)build `shop_index` from the shops table. Needs an app context."""
+    from database import db
+    from models.shop_model import ShopModel
+
+    rows = (
+        db.session.query(ShopModel.id, ShopModel.lat, ShopModel.lon)
+        .filter(ShopModel.lat.isnot(None), ShopModel.lon.isnot(None))
+        .all()
+    )
+    return shop_index.rebuild(rows)
+
+
+def index_shop(shop):
+    """Keep `shop_index` in step after a shop row has been committed."""
+    if shop_index.loaded:
+        shop_index.upsert(shop.id, shop.lat, shop.lon)
@@ -0,0 +1,518 @@
+# services/spatial_queries.py
+"""
+Spatial statements shared by the nearby endpoints, the haversine engine and
+the app/ package, plus the row -> dict mapping they all respond with.
+
+Every statement is a module-level SpatialStatement: a `text()` construct
+with typed bind parameters, built once at import so SQLAlchemy's compiled
+cache is hit instead of re-parsing the SQL on every request.
+
+On PostgreSQL the statements are also server-side prepared: the first run
+on a pooled connection issues `PREPARE <name>(<types>) AS ...` and every
+run after that is `EXECUTE <name>(...)`, so the server parses and plans the
+statement once per connection instead of once per request (psycopg2 never
+prepares on its own). Streamed reads (server-side cursors) cannot DECLARE
+over an EXECUTE and use the plain statement. Set
+SPATIAL_PREPARED_STATEMENTS=0 to turn preparing off.
+
+Each run goes through the timing hooks: add_timing_hook(fn) registers
+fn(name, elapsed_ms, row_count), and query_stats() returns per-statement
+counters for GET /shops/spatial/stats. Runs slower than
+SPATIAL_SLOW_QUERY_MS are logged.
+"""
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import ARRAY, DateTime, Float, Integer, bindparam, text
+
+from database import db
+
+PREPARED_STATEMENTS = os.getenv("SPATIAL_PREPARED_STATEMENTS", "1").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SPATIAL_SLOW_QUERY_MS", "250"))
+
+log = logging.getLogger(__name__)
+
+# bind parameter types: (SQLAlchemy type, PostgreSQL type for PREPARE)
+FLOAT = (Float(), "double precision")
+INT = (Integer(), "integer")
+FLOATS = (ARRAY(Float()), "double precision[]")
+TIMESTAMP = (DateTime(), "timestamp")
+
+_NAMED_PARAM = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+# ---------------------------------------------------------------------
+# Timing hooks
+# ---------------------------------------------------------------------
+_timing_hooks = []
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def add_timing_hook(fn):
+    """Register fn(name, elapsed_ms, row_count), called after every statement run."""
+    _timing_hooks.append(fn)
+    return fn
+
+
+def _record(name, elapsed_ms, row_count):
+    with _stats_lock:
+        s = _stats.setdefault(name, {"calls": 0, "rows": 0, "totalMs": 0.0, "maxMs": 0.0})
+        s["calls"] += 1
+        s["rows"] += row_count or 0
+        s["totalMs"] += elapsed_ms
+        s["maxMs"] = max(s["maxMs"], elapsed_ms)
+    if elapsed_ms >= SLOW_QUERY_MS:
+        log.warning("slow spatial query %s: %.1f ms, %s rows", name, elapsed_ms, row_count)
+    for hook in _timing_hooks:
+        try:
+            hook(name, elapsed_ms, row_count)
+        except Exception:
+            log.exception("spatial timing hook failed")
+
+
+def query_stats():
+    with _stats_lock:
+        return {
+            name: dict(s, avgMs=round(s["totalMs"] / s["calls"], 3) if s["calls"] else 0.0)
+            for name, s in _stats.items()
+        }
+
+
+# ---------------------------------------------------------------------
+# Statements
+# ---------------------------------------------------------------------
+class SpatialStatement:
+    """
+    One named statement. `params` maps each bind name to FLOAT / INT /
+    FLOATS / TIMESTAMP; `expanding` names IN (...) list parameters, which
+    rule out preparing.
+    """
+
+    def __init__(self, name, sql, params, expanding=()):
+        self.name = name
+        self.sql = sql
+        self.params = dict(params)
+        binds = [bindparam(p, type_=t[0]) for p, t in self.params.items()]
+        binds += [bindparam(p, expanding=True) for p in expanding]
+        self.statement = text(sql).bindparams(*binds)
+
+        self.preparable = not expanding
+        if self.preparable:
+            order = list(self.params)
+            pg_sql = _NAMED_PARAM.sub(lambda m: "$%d" % (order.index(m.group(1)) + 1), sql)
+            types = ", ".join(self.params[p][1] for p in order)
+            args = ", ".join(f":{p}" for p in order)
+            self.prepare_sql = f"PREPARE {name}({types}) AS {pg_sql}" if order else f"PREPARE {name} AS {pg_sql}"
+            self.execute_statement = text(
+                f"EXECUTE {name}({args})" if order else f"EXECUTE {name}"
+            ).bindparams(*[bindparam(p, type_=self.params[p][0]) for p in order])
+
+    def _statement_for(self, session):
+        if not (PREPARED_STATEMENTS and self.preparable):
+            return self.statement
+        conn = session.connection()
+        if conn.dialect.name != "postgresql":
+            return self.statement
+        # conn.info lives as long as the DBAPI connection, like the prepared statement
+        prepared = conn.info.setdefault("spatial_prepared", set())
+        if self.name not in prepared:
+            conn.exec_driver_sql(self.prepare_sql)
+            prepared.add(self.name)
+        return self.execute_statement
+
+    def fetch(self, params, session=None):
+        """Run the statement and return all rows."""
+        session = session or db.session
+        started = time.perf_counter()
+        rows = session.execute(self._statement_for(session), params).fetchall()
+        _record(self.name, (time.perf_counter() - started) * 1000.0, len(rows))
+        return rows
+
+    def stream(self, params, chunk_rows, session=None):
+        """
+        Run the statement on a server-side cursor (never prepared). The
+        timing hook sees the time to the first chunk.
+        """
+        session = session or db.session
+        started = time.perf_counter()
+        result = session.execute(
+            self.statement, params,
+            execution_options={"stream_results": True, "yield_per": chunk_rows},
+        )
+        _record(self.name + ":stream", (time.perf_counter() - started) * 1000.0, None)
+        return result
+
+
+_SHOP_COLUMNS = """
+          s.id,
+          s.name,
+          s.category,
+          s.description,
+          s.address_line,
+          s.city,
+          s.lat,
+          s.lon,
+          s.avg_spend,
+          s.image_url,
+          s.owner_uid"""
+
+_OFFER_COLUMNS = """
+          s.id        AS shop_id,
+          s.owner_uid AS shop_owner_uid,
+          s.name      AS shop_name,
+          s.category  AS shop_category,
+          s.description AS shop_description,
+          s.address_line,
+          s.city,
+          s.lat,
+          s.lon,
+          s.avg_spend,
+          s.image_url,
+          c.id        AS campaign_id,
+          c.owner_uid AS campaign_owner_uid,
+          c.title     AS campaign_title,
+          c.offer     AS campaign_offer,
+          c.poster_path,
+          c.radius_km,
+          c.start     AS campaign_start,
+          c."end"     AS campaign_end"""
+
+_POINT = "ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography"
+
+_NEARBY_SHOPS_SQL = """
+        SELECT{columns},
+          -- distance in meters using geography
+          ST_Distance(s.geog, {point}) AS distance_m,
+          -- KNN sort key (index-assisted ordering), also the cursor distance
+          s.geog <-> {point} AS knn_m,
+          -- whether the shop has a running offer
+          EXISTS (
+            SELECT 1 FROM active_offers o
+            WHERE o.shop_id = s.id
+              AND o.start <= now() AT TIME ZONE 'utc'
+              AND o."end" >= now() AT TIME ZONE 'utc'
+          ) AS has_offer
+        FROM shops s
+        WHERE s.geog IS NOT NULL
+          AND ST_DWithin(s.geog, {point}, :radius_m)
+          {cursor_clause}
+        ORDER BY s.geog <-> {point}, s.id
+        LIMIT :limit
+"""
+
+_ACTIVE_CAMPAIGNS_SQL = """
+        SELECT{columns},
+          -- compute distance in meters using geography
+          ST_Distance(o.geog, {point}) AS distance_m,
+          -- KNN sort key (index-assisted ordering), also the cursor distance
+          o.geog <-> {point} AS knn_m
+        FROM active_offers o
+        JOIN shops s ON s.id = o.shop_id
+        JOIN campaigns c ON c.id = o.campaign_id
+        WHERE o.start <= now() AT TIME ZONE 'utc'
+          AND o."end" >= now() AT TIME ZONE 'utc'
+          AND ST_DWithin(o.geog, {point}, :radius_m)
+          {cursor_clause}
+        ORDER BY o.geog <-> {point}, o.campaign_id
+        LIMIT :limit
+"""
+
+_NEARBY_PARAMS = {"lat": FLOAT, "lon": FLOAT, "radius_m": FLOAT, "limit": INT}
+_CURSOR_PARAMS = dict(_NEARBY_PARAMS, after_d=FLOAT, after_id=INT)
+
+NEARBY_SHOPS = SpatialStatement(
+    "pp_nearby_shops",
+    _NEARBY_SHOPS_SQL.format(columns=_SHOP_COLUMNS, point=_POINT, cursor_clause=""),
+    _NEARBY_PARAMS,
+)
+NEARBY_SHOPS_AFTER = SpatialStatement(
+    "pp_nearby_shops_after",
+    _NEARBY_SHOPS_SQL.format(
+        columns=_SHOP_COLUMNS, point=_POINT,
+        cursor_clause=f"AND (s.geog <-> {_POINT}, s.id) > (:after_d, :after_id)",
+    ),
+    _CURSOR_PARAMS,
+)
+
+ACTIVE_CAMPAIGNS = SpatialStatement(
+    "pp_active_campaigns",
+    _ACTIVE_CAMPAIGNS_SQL.format(columns=_OFFER_COLUMNS, point=_POINT, cursor_clause=""),
+    _NEARBY_PARAMS,
+)
+ACTIVE_CAMPAIGNS_AFTER = SpatialStatement(
+    "pp_active_campaigns_after",
+    _ACTIVE_CAMPAIGNS_SQL.format(
+        columns=_OFFER_COLUMNS, point=_POINT,
+        cursor_clause=f"AND (o.geog <-> {_POINT}, o.campaign_id) > (:after_d, :after_id)",
+    ),
+    _CURSOR_PARAMS,
+)
+
+# GiST on the buffered reach polygon narrows the candidates,
+# ST_DWithin on the shop point is the exact radius_km test
+CAMPAIGNS_REACHING = SpatialStatement(
+    "pp_campaigns_reaching",
+    f"""
+        SELECT{_OFFER_COLUMNS},
+          ST_Distance(o.geog, {_POINT}) AS distance_m
+        FROM active_offers o
+        JOIN shops s ON s.id = o.shop_id
+        JOIN campaigns c ON c.id = o.campaign_id
+        WHERE o.start <= now() AT TIME ZONE 'utc'
+          AND o."end" >= now() AT TIME ZONE 'utc'
+          AND ST_Intersects(o.reach, {_POINT})
+          AND ST_DWithin(o.geog, {_POINT}, o.radius_km * 1000.0)
+        ORDER BY distance_m ASC, o.campaign_id
+        LIMIT :limit
+    """,
+    {"lat": FLOAT, "lon": FLOAT, "limit": INT},
+)
+
+# One statement for many points: LATERAL join over the unnested point arrays
+_BATCH_POINT = "ST_SetSRID(ST_MakePoint(p.lon, p.lat), 4326)::geography"
+ACTIVE_CAMPAIGNS_BATCH = SpatialStatement(
+    "pp_active_campaigns_batch",
+    f"""
+        SELECT
+          p.idx       AS point_idx,
+          x.*
+        FROM unnest(
+          CAST(:lats AS double precision[]),
+          CAST(:lons AS double precision[]),
+          CAST(:radii AS double precision[])
+        ) WITH ORDINALITY AS p(lat, lon, radius_m, idx)
+        CROSS JOIN LATERAL (
+          SELECT{_OFFER_COLUMNS},
+            ST_Distance(o.geog, {_BATCH_POINT}) AS distance_m
+          FROM active_offers o
+          JOIN shops s ON s.id = o.shop_id
+          JOIN campaigns c ON c.id = o.campaign_id
+          WHERE o.start <= now() AT TIME ZONE 'utc'
+            AND o."end" >= now() AT TIME ZONE 'utc'
+            AND ST_DWithin(o.geog, {_BATCH_POINT}, p.radius_m)
+          ORDER BY o.geog <-> {_BATCH_POINT}, o.campaign_id
+          LIMIT :limit
+        ) x
+        ORDER BY p.idx, x.distance_m
+    """,
+    {"lats": FLOATS, "lons": FLOATS, "radii": FLOATS, "limit": INT},
+)
+
+# campaigns_reaching for many points (the geofence sweep), same LATERAL shape
+CAMPAIGNS_REACHING_BATCH = SpatialStatement(
+    "pp_campaigns_reaching_batch",
+    f"""
+        SELECT
+          p.idx       AS point_idx,
+          x.*
+        FROM unnest(
+          CAST(:lats AS double precision[]),
+          CAST(:lons AS double precision[])
+        ) WITH ORDINALITY AS p(lat, lon, idx)
+        CROSS JOIN LATERAL (
+          SELECT{_OFFER_COLUMNS},
+            ST_Distance(o.geog, {_BATCH_POINT}) AS distance_m
+          FROM active_offers o
+          JOIN shops s ON s.id = o.shop_id
+          JOIN campaigns c ON c.id = o.campaign_id
+          WHERE o.start <= now() AT TIME ZONE 'utc'
+            AND o."end" >= now() AT TIME ZONE 'utc'
+            AND ST_Intersects(o.reach, {_BATCH_POINT})
+            AND ST_DWithin(o.geog, {_BATCH_POINT}, o.radius_km * 1000.0)
+          ORDER BY distance_m ASC, o.campaign_id
+          LIMIT :limit
+        ) x
+        ORDER BY p.idx, x.distance_m
+    """,
+    {"lats": FLOATS, "lons": FLOATS, "limit": INT},
+)
+
+# --- portable statements (haversine engine; SQLite and stock Postgres) ---
+
+HYDRATE_SHOPS = SpatialStatement(
+    "pp_hydrate_shops",
+    f"""
+        SELECT{_SHOP_COLUMNS},
+          EXISTS (
+            SELECT 1 FROM active_offers o
+            WHERE o.shop_id = s.id
+              AND o.start <= :now
+              AND o."end" >= :now
+          ) AS has_offer
+        FROM shops s
+        WHERE s.id IN :ids
+    """,
+    {"now": TIMESTAMP},
+    expanding=("ids",),
+)
+
+_BOX_PARAMS = {"min_lat": FLOAT, "max_lat": FLOAT, "min_lon": FLOAT, "max_lon": FLOAT}
+
+SHOPS_IN_BOX = SpatialStatement(
+    "pp_shops_in_box",
+    """
+        SELECT s.id, s.lat, s.lon
+        FROM shops s
+        WHERE s.lat BETWEEN :min_lat AND :max_lat
+          AND s.lon BETWEEN :min_lon AND :max_lon
+    """,
+    _BOX_PARAMS,
+)
+
+_OFFERS_FROM = """
+        FROM active_offers o
+        JOIN shops s ON s.id = o.shop_id
+        JOIN campaigns c ON c.id = o.campaign_id"""
+
+OFFERS_IN_BOX = SpatialStatement(
+    "pp_offers_in_box",
+    f"""
+        SELECT{_OFFER_COLUMNS}{_OFFERS_FROM}
+        WHERE o.lat BETWEEN :min_lat AND :max_lat
+          AND o.lon BETWEEN :min_lon AND :max_lon
+          AND o.start <= :now
+          AND o."end" >= :now
+    """,
+    dict(_BOX_PARAMS, now=TIMESTAMP),
+)
+
+OFFERS_REACH_BOX = SpatialStatement(
+    "pp_offers_reach_box",
+    f"""
+        SELECT{_OFFER_COLUMNS}{_OFFERS_FROM}
+        WHERE o.reach_min_lat <= :lat AND o.reach_max_lat >= :lat
+          AND o.reach_min_lon <= :lon AND o.reach_max_lon >= :lon
+          AND o.start <= :now
+          AND o."end" >= :now
+    """,
+    {"lat": FLOAT, "lon": FLOAT, "now": TIMESTAMP},
+)
+
+# --- app/ package (shops.location geography, no lat/lon columns) ---
+
+LOCATION_POINTS = SpatialStatement(
+    "pp_location_points",
+    """
+        SELECT id, ST_Y(location::geometry) AS lat, ST_X(location::geometry) AS lon
+        FROM shops WHERE location IS NOT NULL
+    """,
+    {},
+)
+
+LOCATION_HYDRATE = SpatialStatement(
+    "pp_location_hydrate",
+    """
+        SELECT id, name, address, ST_AsText(location) AS location_wkt
+        FROM shops WHERE id IN :ids
+    """,
+    {},
+    expanding=("ids",),
+)
+
+LOCATION_NEARBY = SpatialStatement(
+    "pp_location_nearby",
+    f"""
+        SELECT id, name, address, ST_AsText(location) AS location_wkt,
+          ST_Distance(location, {_POINT}) AS distance_m
+        FROM shops
+        WHERE ST_DWithin(location, {_POINT}, :radius)
+        ORDER BY distance_m ASC
+        LIMIT :limit
+    """,
+    {"lat": FLOAT, "lon": FLOAT, "radius": FLOAT, "limit": INT},
+)
+
+
+def nearby_shops_statement(after):
+    return NEARBY_SHOPS_AFTER if after else NEARBY_SHOPS
+
+
+def active_campaigns_statement(after):
+    return ACTIVE_CAMPAIGNS_AFTER if after else ACTIVE_CAMPAIGNS
+
+
+def nearby_params(lat, lon, radius_m, limit, after=None):
+    params = {"lat": lat, "lon": lon, "radius_m": radius_m, "limit": limit}
+    if after:
+        params.update(after_d=after[0], after_id=after[1])
+    return params
+
+
+# ---------------------------------------------------------------------
+# Row mapping
+# ---------------------------------------------------------------------
+def _float_or_none(value):
+    try:
+        return float(value) if value is not None else None
+    except Exception:
+        return None
+
+
+def shop_item(r, distance_m):
+    """Map one shop row to the nearby-shops item shape (the frontend Shop model)."""
+    # rows may be sqlalchemy Row/RowProxy — access by column name
+    return {
+        "id": getattr(r, "id", None),
+        "name": getattr(r, "name", None),
+        "category": getattr(r, "category", None),
+        "lat": _float_or_none(getattr(r, "lat", None)),
+        "lon": _float_or_none(getattr(r, "lon", None)),
+        "avgSpend": _float_or_none(getattr(r, "avg_spend", None)),
+        "hasOffer": bool(getattr(r, "has_offer", False)),
+        "distanceMeters": _float_or_none(distance_m),
+        "snippet": getattr(r, "description", None) or "",  # frontend expects snippet -> use description
+        "imageUrl": getattr(r, "image_url", None),
+        # Randomize rating (between 3.5 and 5.0, one decimal) — optional
+        "rating": round(random.uniform(3.5, 5.0), 1),
+        "ownerUid": getattr(r, "owner_uid", None),
+    }
+
+
+def campaign_item(r):
+    """Map one shop+campaign row to the active_campaigns_nearby item shape."""
+    campaign_start = getattr(r, "campaign_start", None)
+    campaign_end = getattr(r, "campaign_end", None)
+    return {
+        "shop": {
+            "id": getattr(r, "shop_id", None),
+            "owner_uid": getattr(r, "shop_owner_uid", None),
+            "name": getattr(r, "shop_name", None),
+            "category": getattr(r, "shop_category", None),
+            "description": getattr(r, "shop_description", None) or "",
+            "address_line": getattr(r, "address_line", None),
+            "city": getattr(r, "city", None),
+            "lat": _float_or_none(getattr(r, "lat", None)),
+            "lon": _float_or_none(getattr(r, "lon", None)),
+            "avgSpend": _float_or_none(getattr(r, "avg_spend", None)),
+            "imageUrl": getattr(r, "image_url", None),
+            # optional randomized rating for frontend
+            "rating": round(random.uniform(3.5, 5.0), 1),
+        },
+        "campaign": {
+            "id": getattr(r, "campaign_id", None),
+            "owner_uid": getattr(r, "campaign_owner_uid", None),
+            "title": getattr(r, "campaign_title", None),
+            "offer": getattr(r, "campaign_offer", None),
+            "poster_path": getattr(r, "poster_path", None),
+            "start": campaign_start.isoformat() if campaign_start else None,
+            "end": campaign_end.isoformat() if campaign_end else None,
+            "radius_km": getattr(r, "radius_km", None),
+        },
+        "distanceMeters": _float_or_none(getattr(r, "distance_m", None)),
+    }
+
+
+def location_item(r, distance_m):
+    """Map one app/ package shop row (location geography) to its nearby item."""
+    return {
+        "id": r.id,
+        "name": r.name,
+        "address": r.address,
+        "location_wkt": r.location_wkt,
+        "distance_m": float(distance_m),
+    }
@@ -0,0 +1,232 @@
+# services/subscription_registry.py
+"""
+Registry of Nokia geofencing subscriptions, one per device
+(models/geofence_subscription_model.py, table geofence_subscriptions).
+
+ensure_subscription() is what the sweep and the callback call instead of
+nokia.create_geofence_subscription():
+
+  * reused   -- the device already has a live subscription (not expired,
+                events left) with the same radius and a center within
+                SUBSCRIPTION_REUSE_DISTANCE_M (or SUBSCRIPTION_REUSE_FRACTION
+                of the radius) of the new point: no Nokia call
+  * created  -- no subscription yet: create one and record it
+  * replaced -- the device moved (or the old one is spent): create the new
+                subscription, then delete the old one on the Nokia side
+
+The fence radius comes from services/radius_policy.py: the row also keeps
+the device's previous fix and smoothed speed, so fast devices get wide
+fences (and fewer callbacks) and slow ones tight fences.
+
+With GEOFENCE_EVALUATION=local no Nokia subscription is made: the row
+holds a local fence (services/local_geofence.py) that positions are
+checked against on our side.
+
+The device's registry row is locked (SELECT ... FOR UPDATE) while the fix
+is recorded and the decision made; the transaction is committed before
+Nokia is called, so no row lock or pooled connection is held across the
+network call (with its retries, backoff and rate-limit wait). The new
+subscription is then applied with a compare-and-set on the subscription
+id read under the lock. If a concurrent sweep/callback replaced it in
+the meantime, that one wins and the subscription just created is
+deleted again (action "superseded").
+record_event() counts down events_remaining when a callback arrives.
+"""
+import os
+from datetime import datetime
+
+from app.nokia_client import nokia, SUBSCRIPTION_MAX_EVENTS, SUBSCRIPTION_EXPIRE_TIME
+from services.local_geofence import (
+    local_evaluation_enabled,
+    local_fences,
+    new_local_subscription_id,
+    is_local_subscription,
+)
+from services.location_history import utc_naive
+from services.pg import pg_connection
+from services.radius_policy import choose_radius, estimate_speed
+from services.spatial_index import haversine_m
+
+SUBSCRIPTION_REUSE_DISTANCE_M = float(os.getenv("SUBSCRIPTION_REUSE_DISTANCE_M", "100"))
+# wide fences tolerate proportionally more drift of the center before being moved
+SUBSCRIPTION_REUSE_FRACTION = float(os.getenv("SUBSCRIPTION_REUSE_FRACTION", "0.25"))
+
+SUBSCRIPTION_ENDS_EVENT = "org.camaraproject.geofencing-subscriptions.v0.subscription-ends"
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        return utc_naive(datetime.fromisoformat(value.replace("Z", "+00:00")))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _is_live(row, now):
+    subscription_id, _, _, _, expires_at, events_remaining = row
+    if not subscription_id:
+        return False
+    if expires_at is not None and expires_at <= now:
+        return False
+    return events_remaining is None or events_remaining > 0
+
+
+def _reusable(row, lat, lon, radius, now):
+    if not _is_live(row, now):
+        return False
+    if is_local_subscription(row[0]) != local_evaluation_enabled():
+        # the evaluation mode changed: move the device to the other kind of fence
+        return False
+    _, center_lat, center_lon, radius_m, _, _ = row
+    if center_lat is None or center_lon is None or radius_m != int(radius):
+        return False
+    reuse_m = max(SUBSCRIPTION_REUSE_DISTANCE_M, radius_m * SUBSCRIPTION_REUSE_FRACTION)
+    return haversine_m(center_lat, center_lon, lat, lon) <= reuse_m
+
+
+def _create(phone_number, lat, lon, radius):
+    if local_evaluation_enabled():
+        return {"id": new_local_subscription_id()}
+    return nokia.create_geofence_subscription(phone_number, lat, lon, radius)
+
+
+def ensure_subscription(phone_number, lat, lon, accuracy_m, fix_time=None):
+    """
+    Make sure `phone_number` has a subscription around its fix (lat, lon),
+    with the radius the speed policy picks for it. `accuracy_m` is the fix's
+    radius as reported by the location API, `fix_time` its lastLocationTime.
+    Returns {"action", "subscription_id", "radius", "speed_mps", ...}; on a
+    failed create the old subscription is kept and the Nokia error is
+    returned under "error".
+    """
+    now = datetime.utcnow()
+    fix_at = _parse_time(fix_time) or now
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO geofence_subscriptions (phone_number, created_at, updated_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (phone_number) DO NOTHING;
+                """,
+                (phone_number, now, now),
+            )
+            cursor.execute(
+                """
+                SELECT subscription_id, center_lat, center_lon, radius_m, expires_at, events_remaining,
+                       last_lat, last_lon, last_fix_at, speed_mps
+                FROM geofence_subscriptions
+                WHERE phone_number = %s
+                FOR UPDATE;
+                """,
+                (phone_number,),
+            )
+            row = cursor.fetchone()
+            subscription, (last_lat, last_lon, last_fix_at, speed) = row[:6], row[6:]
+
+            if last_fix_at is None or fix_at > last_fix_at:
+                speed = estimate_speed(last_lat, last_lon, last_fix_at, lat, lon, fix_at, accuracy_m, speed)
+                cursor.execute(
+                    """
+                    UPDATE geofence_subscriptions
+                    SET last_lat = %s, last_lon = %s, last_fix_at = %s, speed_mps = %s
+                    WHERE phone_number = %s;
+                    """,
+                    (lat, lon, fix_at, speed, phone_number),
+                )
+            radius = choose_radius(speed, accuracy_m)
+        conn.commit()
+
+    policy = {"radius": radius, "speed_mps": round(speed, 2) if speed is not None else None}
+    old_id = subscription[0]
+    if _reusable(subscription, lat, lon, radius, now):
+        return dict(policy, action="reused", subscription_id=old_id)
+
+    created = _create(phone_number, lat, lon, radius)
+    new_id = created.get("id") if isinstance(created, dict) else None
+    if not new_id:
+        # the fix/speed update is kept, the old subscription stays
+        return dict(policy, action="failed", subscription_id=old_id, error=created)
+
+    if is_local_subscription(new_id):
+        # local fences have no event budget or expiry
+        max_events, expires_at = None, None
+    else:
+        config = created.get("config") or {}
+        max_events = config.get("subscriptionMaxEvents", SUBSCRIPTION_MAX_EVENTS)
+        expires_at = _parse_time(
+            created.get("expiresAt") or config.get("subscriptionExpireTime") or SUBSCRIPTION_EXPIRE_TIME
+        )
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE geofence_subscriptions
+                SET subscription_id = %s,
+                    center_lat = %s,
+                    center_lon = %s,
+                    radius_m = %s,
+                    expires_at = %s,
+                    max_events = %s,
+                    events_remaining = %s,
+                    updated_at = %s
+                WHERE phone_number = %s
+                  -- unchanged since the decision, or ended by Nokia meanwhile (record_event)
+                  AND (subscription_id IS NOT DISTINCT FROM %s OR subscription_id IS NULL)
+                RETURNING subscription_id;
+                """,
+                (new_id, lat, lon, int(radius), expires_at, max_events, max_events, datetime.utcnow(),
+                 phone_number, old_id),
+            )
+            applied = cursor.fetchone() is not None
+            if not applied:
+                cursor.execute(
+                    "SELECT subscription_id FROM geofence_subscriptions WHERE phone_number = %s;",
+                    (phone_number,),
+                )
+                current = cursor.fetchone()
+        conn.commit()
+
+    if not applied:
+        # another sweep/callback replaced the subscription first: drop ours
+        if not is_local_subscription(new_id):
+            nokia.delete_geofence_subscription(new_id)
+        return dict(policy, action="superseded", subscription_id=current[0] if current else None)
+
+    if is_local_subscription(new_id):
+        local_fences.set_fence(phone_number, new_id, lat, lon, radius)
+
+    if old_id and old_id != new_id:
+        if not is_local_subscription(old_id):
+            # a spent/expired subscription may already be gone on the Nokia side; a 404 here is fine
+            nokia.delete_geofence_subscription(old_id)
+        return dict(policy, action="replaced", subscription_id=new_id, replaced=old_id)
+    return dict(policy, action="created", subscription_id=new_id)
+
+
+def record_event(subscription_id, event_type=None):
+    """Count down the subscription's remaining events; forget it once Nokia has ended it."""
+    if not subscription_id:
+        return
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            if event_type == SUBSCRIPTION_ENDS_EVENT:
+                cursor.execute(
+                    """
+                    UPDATE geofence_subscriptions
+                    SET subscription_id = NULL, events_remaining = 0, updated_at = %s
+                    WHERE subscription_id = %s;
+                    """,
+                    (datetime.utcnow(), subscription_id),
+                )
+            else:
+                cursor.execute(
+                    """
+                    UPDATE geofence_subscriptions
+                    SET events_remaining = GREATEST(events_remaining - 1, 0), updated_at = %s
+                    WHERE subscription_id = %s AND events_remaining IS NOT NULL;
+                    """,
+                    (datetime.utcnow(), subscription_id),
+                )
+        conn.commit()
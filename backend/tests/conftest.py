@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the backend modules import each other as top-level packages (routes, services, models, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
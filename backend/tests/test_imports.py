@@ -0,0 +1,40 @@
+"""
+Import smoke test: every backend module must import cleanly, so a name used
+before its import (or a typo at module level) fails here instead of at
+API / worker start-up. Modules whose third-party dependencies are not
+installed are skipped, not failed.
+"""
+import importlib
+import os
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGES = ("routes", "services", "models", "app", "app/routes")
+LOCAL_ROOTS = {"routes", "services", "models", "app", "database", "config", "db"}
+
+# modules that were already broken before this test existed
+KNOWN_BROKEN = {
+    "app.init": "imports routes.recommendation_route, which does not exist (app/routes/ has it)",
+}
+
+
+def _modules():
+    for package in PACKAGES:
+        for name in sorted(os.listdir(os.path.join(BACKEND_DIR, package))):
+            if name.endswith(".py") and name != "__init__.py":
+                module = f"{package.replace('/', '.')}.{name[:-3]}"
+                if module in KNOWN_BROKEN:
+                    yield pytest.param(module, marks=pytest.mark.xfail(reason=KNOWN_BROKEN[module], strict=True))
+                else:
+                    yield module
+
+
+@pytest.mark.parametrize("module", list(_modules()))
+def test_module_imports(module):
+    try:
+        importlib.import_module(module)
+    except ModuleNotFoundError as e:
+        if (e.name or "").split(".")[0] in LOCAL_ROOTS:
+            raise
+        pytest.skip(f"{module} needs {e.name}, which is not installed")